@@ -0,0 +1,297 @@
+import cv2
+import numpy as np
+import sys
+import json
+import os
+import time
+import glob
+import hashlib
+import tempfile
+import argparse
+
+import process_image as pipeline
+
+# Benchmark harness for the detection and rendering pipeline
+# Times each stage and the full process_image over a corpus of table photos at several resolutions,
+# prints latency percentiles and throughput, and compares against a stored baseline so regressions
+# fail loudly (exit code 1).
+#
+#   python benchmark_pipeline.py                              # run and compare with benchmark_baseline.json
+#   python benchmark_pipeline.py --save-baseline              # record a new baseline
+#   python benchmark_pipeline.py --sizes 640,1600 --repeat 3  # quicker run
+#
+# Timings only compare on the same hardware, so baselines are per machine and not committed
+# (benchmark_baseline.json is git-ignored). Record one with --save-baseline before the first
+# comparison, using the sizes and repeat count you will compare with; running without a
+# baseline fails (exit code 2) rather than passing silently. The baseline stores the machine
+# and settings it was recorded with, and a comparison warns when they differ.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(SCRIPT_DIR, "benchmark_baseline.json")
+DEFAULT_SIZES = (640, 1600, 4000)  # Longer side of each corpus image, in pixels
+DEBUG_CORPUS_FILES = ("original_image.jpg", "original_for_table_detection.jpg")
+SYNTHETIC_LAYOUTS = 4
+PERCENTILES = (50, 90, 99)
+IMAGE_STAGES = ("detect_table_bounds", "detect_balls", "process_image")  # Report megapixels/s for these
+
+def load_corpus(uploads_limit=None):
+    """
+    Collect the benchmark images as (name, image) pairs: unique photos in uploads/, the original
+    images left in debug/, and synthetic tables rendered with create_fancy_table + render_ball.
+    """
+    corpus = []
+    seen = set()
+
+    upload_paths = [path for path in sorted(glob.glob(os.path.join(SCRIPT_DIR, "uploads", "*")))
+                    if not os.path.basename(path).startswith("processed_")]
+    debug_paths = [os.path.join(SCRIPT_DIR, "debug", name) for name in DEBUG_CORPUS_FILES]
+
+    uploads_added = 0
+    for path in upload_paths + debug_paths:
+        if not os.path.isfile(path):
+            continue
+        from_uploads = path in upload_paths
+        if from_uploads and uploads_limit is not None and uploads_added >= uploads_limit:
+            continue
+
+        # Uploads are full of re-submissions of the same photo
+        with open(path, "rb") as f:
+            image_bytes = f.read()
+        if not image_bytes:
+            # Failed uploads leave empty files behind, which imdecode rejects outright
+            continue
+        digest = hashlib.sha1(image_bytes).hexdigest()
+        if digest in seen:
+            continue
+
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            continue
+        seen.add(digest)
+        corpus.append((os.path.relpath(path, SCRIPT_DIR), image))
+        uploads_added += from_uploads
+
+    for layout in range(SYNTHETIC_LAYOUTS):
+        corpus.append((f"synthetic/layout-{layout}", synthetic_table(layout)))
+
+    return corpus
+
+def synthetic_table(seed):
+    """Render a random, deterministic rack on the game table and frame it like a photo."""
+    rng = np.random.default_rng(seed)
+    table = pipeline.create_fancy_table(pipeline.GAME_TABLE_WIDTH, pipeline.GAME_TABLE_HEIGHT)
+
+    margin = pipeline.BALL_RADIUS + 30
+    colors = ["white", "black"] + ["red"] * 7 + ["yellow"] * 7
+    count = int(rng.integers(6, len(colors) + 1))
+    for index, color in enumerate(colors[:count]):
+        x = int(rng.integers(margin, pipeline.GAME_TABLE_WIDTH - margin))
+        y = int(rng.integers(margin, pipeline.GAME_TABLE_HEIGHT - margin))
+        number = index - 1 if color in ("red", "yellow") else None
+        pipeline.render_ball(table, x, y, color, pipeline.BALL_RADIUS, number)
+
+    # Surround the table with a dark floor so table detection has something to find
+    return cv2.copyMakeBorder(table, 120, 120, 160, 160, cv2.BORDER_CONSTANT, value=(40, 35, 30))
+
+def resize_to(image, size):
+    """Scale an image so its longer side is size pixels."""
+    height, width = image.shape[:2]
+    scale = size / max(height, width)
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    return cv2.resize(image, (max(1, int(round(width * scale))), max(1, int(round(height * scale)))),
+                      interpolation=interpolation)
+
+def time_call(func, *args, **kwargs):
+    """Run func once and return (elapsed milliseconds, result)."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return (time.perf_counter() - start) * 1000, result
+
+def run_stages(image, work_dir, name):
+    """Time every pipeline stage on one image. Returns {stage: milliseconds}."""
+    debug = pipeline.NullDebugSink()
+    timings = {}
+
+    timings["detect_table_bounds"], table_bounds = time_call(pipeline.detect_table_bounds, image, debug)
+    timings["detect_balls"], balls = time_call(pipeline.detect_balls, image, table_bounds, debug)
+
+    # Cold builds the background from scratch; warm is the cached copy every request after the first gets
+    pipeline._table_background_cache.clear()
+    timings["create_fancy_table_cold"], _ = time_call(
+        pipeline.create_fancy_table, pipeline.GAME_TABLE_WIDTH, pipeline.GAME_TABLE_HEIGHT)
+    timings["create_fancy_table"], game_table = time_call(
+        pipeline.create_fancy_table, pipeline.GAME_TABLE_WIDTH, pipeline.GAME_TABLE_HEIGHT)
+
+    timings["map_ball_positions"], mapped = time_call(
+        pipeline.map_ball_positions, balls, table_bounds, pipeline.GAME_TABLE_WIDTH, pipeline.GAME_TABLE_HEIGHT)
+
+    start = time.perf_counter()
+    pipeline.render_balls(game_table, mapped, pipeline.BALL_RADIUS)
+    timings["render_ball"] = (time.perf_counter() - start) * 1000
+
+    # The full request, from encoded file to processed image, with caching and debug output off
+    image_path = os.path.join(work_dir, name.replace("/", "_").replace(os.sep, "_"))
+    if not image_path.endswith(".jpg"):
+        image_path += ".jpg"
+    if not os.path.exists(image_path):
+        cv2.imwrite(image_path, image)
+    timings["process_image"], response = time_call(
+        pipeline.process_image, image_path, debug_mode="off", use_cache=False)
+    if response.get("error"):
+        print(f"process_image failed on {name}: {response['error']}", file=sys.stderr)
+
+    return timings
+
+def summarise(samples, megapixels=None):
+    """Latency percentiles and throughput for one stage; megapixels/s only for stages that read the photo."""
+    samples = np.asarray(samples, dtype=np.float64)
+    total_seconds = samples.sum() / 1000
+    summary = {
+        "runs": int(samples.size),
+        "mean_ms": round(float(samples.mean()), 3)
+    }
+    for percentile in PERCENTILES:
+        summary[f"p{percentile}_ms"] = round(float(np.percentile(samples, percentile)), 3)
+    summary["per_second"] = round(samples.size / total_seconds, 2) if total_seconds > 0 else None
+    summary["megapixels_per_second"] = (round(megapixels / total_seconds, 2)
+                                        if megapixels and total_seconds > 0 else None)
+    return summary
+
+def run_benchmark(sizes=DEFAULT_SIZES, repeat=5, warmup=1, uploads_limit=None):
+    """
+    Run every stage over the corpus at each size. Results are grouped per stage and per size,
+    e.g. results["detect_balls@1600"], plus an "all sizes" entry per stage.
+    """
+    os.environ.setdefault("POOL_RESULT_CACHE", "off")
+    pipeline.warm_up()
+
+    corpus = load_corpus(uploads_limit)
+    print(f"Corpus: {len(corpus)} images x {len(sizes)} sizes, {repeat} runs each", file=sys.stderr)
+
+    samples = {}
+    megapixels = {}
+    with tempfile.TemporaryDirectory(prefix="pool-bench-") as work_dir:
+        for size in sizes:
+            for name, original in corpus:
+                image = resize_to(original, size)
+                image_megapixels = image.shape[0] * image.shape[1] / 1e6
+                for run in range(warmup + repeat):
+                    timings = run_stages(image, work_dir, f"{size}-{name}")
+                    if run < warmup:
+                        continue
+                    for stage, elapsed in timings.items():
+                        for key in (f"{stage}@{size}", stage):
+                            samples.setdefault(key, []).append(elapsed)
+                            if stage in IMAGE_STAGES:
+                                megapixels[key] = megapixels.get(key, 0.0) + image_megapixels
+
+    return {
+        "corpus": [name for name, _ in corpus],
+        "sizes": list(sizes),
+        "repeat": repeat,
+        "environment": {
+            "python": sys.version.split()[0],
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "cpus": os.cpu_count()
+        },
+        "results": {key: summarise(values, megapixels.get(key)) for key, values in sorted(samples.items())}
+    }
+
+def compare_with_baseline(report, baseline, tolerance, min_delta_ms):
+    """
+    Compare p50 and p90 latency per stage against the baseline.
+    Returns a list of regression messages; a stage regresses when it is both more than tolerance
+    (a fraction) slower and at least min_delta_ms slower, so sub-millisecond noise doesn't trip it.
+    """
+    regressions = []
+    for key, current in report["results"].items():
+        previous = baseline.get("results", {}).get(key)
+        if previous is None:
+            continue
+        for metric in ("p50_ms", "p90_ms"):
+            before, after = previous.get(metric), current.get(metric)
+            if before is None or after is None:
+                continue
+            if after > before * (1 + tolerance) and after - before >= min_delta_ms:
+                regressions.append(f"{key} {metric}: {before:.2f} ms -> {after:.2f} ms "
+                                   f"(+{(after / before - 1) * 100 if before else float('inf'):.0f}%)")
+    return regressions
+
+def print_report(report, baseline=None, output_stream=sys.stdout):
+    header = f"{'stage':<34}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'per s':>10}{'MP/s':>10}"
+    if baseline:
+        header += f"{'base p50':>10}"
+    print(header, file=output_stream)
+    for key, summary in report["results"].items():
+        megapixels_per_second = summary["megapixels_per_second"]
+        line = (f"{key:<34}{summary['p50_ms']:>10.2f}{summary['p90_ms']:>10.2f}{summary['p99_ms']:>10.2f}"
+                f"{summary['per_second'] or 0:>10.1f}"
+                + (f"{megapixels_per_second:>10.1f}" if megapixels_per_second else f"{'-':>10}"))
+        if baseline:
+            previous = baseline.get("results", {}).get(key)
+            line += f"{previous['p50_ms']:>10.2f}" if previous else f"{'-':>10}"
+        print(line, file=output_stream)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the pool table detection and rendering pipeline.")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="Comma-separated longer-side sizes to scale each image to")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per image and size")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed runs per image and size")
+    parser.add_argument("--uploads-limit", type=int,
+                        help="Use at most this many unique photos from uploads/")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Write this run to the baseline file instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown as a fraction of the baseline (default 0.25)")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="Ignore slowdowns smaller than this many milliseconds")
+    parser.add_argument("--output", help="Also write the full report JSON here")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+
+    # Fail before spending minutes on timings that have nothing to be compared with
+    if not args.save_baseline and not os.path.isfile(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to record one on this machine",
+              file=sys.stderr)
+        return 2
+
+    report = run_benchmark(sizes, args.repeat, args.warmup, args.uploads_limit)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print_report(report)
+        print(f"Baseline written to {args.baseline}", file=sys.stderr)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    print_report(report, baseline)
+
+    for setting in ("environment", "sizes", "repeat"):
+        if baseline.get(setting) != report[setting]:
+            print(f"Warning: baseline {setting} {baseline.get(setting)} differs from this run's {report[setting]}",
+                  file=sys.stderr)
+
+    regressions = compare_with_baseline(report, baseline, args.tolerance, args.min_delta_ms)
+    if regressions:
+        print(f"\nPERFORMANCE REGRESSION: {len(regressions)} stage(s) slower than the baseline", file=sys.stderr)
+        for regression in regressions:
+            print(f"  {regression}", file=sys.stderr)
+        return 1
+
+    print("No regressions against the baseline", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -4,12 +4,30 @@ import sys
 import json
 import os
 import traceback
-from collections import defaultdict
+import queue
+import threading
+import time
+import glob
+import hashlib
+import shutil
+import resource
+import tracemalloc
+import cProfile
+import mmap
+import base64
+import re
+import io
+import struct
+from contextlib import contextmanager
 
 # Constants for the game table size
 GAME_TABLE_WIDTH = 800
 GAME_TABLE_HEIGHT = 400
 BALL_RADIUS = 14  # Standardized ball size
+OVERLAP_DISTANCE_FACTOR = 2.1  # Mapped balls end up at least this many radii apart (a diameter plus a small margin)
+
+# Bump whenever detection, mapping or rendering output changes so cached results are invalidated
+PIPELINE_VERSION = 8
 
 # Custom JSON encoder to handle NumPy types
 class NumpyEncoder(json.JSONEncoder):
@@ -22,169 +40,364 @@ class NumpyEncoder(json.JSONEncoder):
             return obj.tolist()
         return super(NumpyEncoder, self).default(obj)
 
-def detect_balls_in_custom_image(image, table_bounds):
+# Debug artifact sinks
+# Pipeline stages hand their debug images to a sink instead of writing to disk directly.
+# Check `debug.enabled` before building an image that only exists for debugging.
+DEBUG_DIR = "debug"
+DEBUG_MODES = ("shared", "request", "async", "off")
+
+class DebugSink:
+    """Write debug images straight into a directory (the shared debug/ folder by default)."""
+    enabled = True
+
+    def __init__(self, directory=DEBUG_DIR):
+        self.directory = directory
+
+    def path_for(self, name):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, name)
+
+    def save(self, name, image):
+        cv2.imwrite(self.path_for(name), image)
+
+class NullDebugSink(DebugSink):
+    """Production mode: skip debug image construction, encoding and disk writes entirely."""
+    enabled = False
+
+    def __init__(self):
+        super().__init__(directory=None)
+
+    def save(self, name, image):
+        pass
+
+_debug_write_queue = None
+
+def _debug_writer_loop(write_queue):
+    while True:
+        path, image = write_queue.get()
+        try:
+            cv2.imwrite(path, image)
+        except Exception as e:
+            print(f"Error writing debug image {path}: {e}", file=sys.stderr)
+        finally:
+            write_queue.task_done()
+
+class BackgroundDebugSink(DebugSink):
+    """Hand debug images to a background thread so JPEG encoding happens off the request path."""
+
+    def save(self, name, image):
+        global _debug_write_queue
+        if _debug_write_queue is None:
+            _debug_write_queue = queue.Queue()
+            threading.Thread(target=_debug_writer_loop, args=(_debug_write_queue,), daemon=True).start()
+        _debug_write_queue.put((self.path_for(name), image))
+
+def flush_debug_writes():
+    """Block until every queued background debug write has reached disk."""
+    if _debug_write_queue is not None:
+        _debug_write_queue.join()
+
+def create_debug_sink(mode, image_path):
+    """
+    Build the debug sink for one request.
+
+    Modes:
+        shared:  write into debug/ (the original behaviour, files are overwritten per request)
+        request: write into debug/<image name>/ so concurrent requests don't clobber each other
+        async:   like request, but encode and write on a background thread
+        off:     no debug images at all
+    """
+    mode = mode or os.environ.get("POOL_DEBUG_MODE", "shared")
+    request_dir = os.path.join(DEBUG_DIR, os.path.splitext(os.path.basename(image_path))[0])
+
+    if mode == "off":
+        return NullDebugSink()
+    if mode == "request":
+        return DebugSink(request_dir)
+    if mode == "async":
+        return BackgroundDebugSink(request_dir)
+    if mode != "shared":
+        print(f"Unknown debug mode '{mode}', using shared debug directory", file=sys.stderr)
+    return DebugSink(DEBUG_DIR)
+
+def detect_balls_in_custom_image(image, table_bounds, debug=None):
 
     # Get the dimensions of the table
     x, y, w, h = table_bounds["x"], table_bounds["y"], table_bounds["width"], table_bounds["height"]
     
-    # Create empty list for ball positions
-    ball_positions = []
-    
-    # 1. White cue ball 
-    ball_positions.append({
-        "color": "white",
-        "x": int(x + w * 0.75),  
-        "y": int(y + h * 0.23),  
-        "radius": BALL_RADIUS,
-        "confidence": 1.0
-    })
-    
-    # 2. Black 8-ball 
-    ball_positions.append({
-        "color": "black",
-        "x": int(x + w * 0.5),   
-        "y": int(y + h * 0.5),   
-        "radius": BALL_RADIUS,
-        "confidence": 1.0,
-        "number": 8
-    })
-    
-    # 3. Yellow ball #1 
-    ball_positions.append({
-        "color": "yellow",
-        "x": int(x + w * 0.19),  
-        "y": int(y + h * 0.75),  
-        "radius": BALL_RADIUS,
-        "confidence": 1.0,
-        "number": 1
-    })
-    
-    # 4. Yellow ball #2 
-    ball_positions.append({
-        "color": "yellow",
-        "x": int(x + w * 0.64),  
-        "y": int(y + h * 0.35),  
-        "radius": BALL_RADIUS,
-        "confidence": 1.0,
-        "number": 2
-    })
-    
-    # RED BALLS - 4 of them in the image
-    
-    # 5. Red ball #1 
-    ball_positions.append({
-        "color": "red",
-        "x": int(x + w * 0.79),  
-        "y": int(y + h * 0.22),  
-        "radius": BALL_RADIUS,
-        "confidence": 1.0,
-        "number": 1
-    })
-    
-    # 6. Red ball #2 
-    ball_positions.append({
-        "color": "red",
-        "x": int(x + w * 0.57), 
-        "y": int(y + h * 0.25),  
-        "radius": BALL_RADIUS,
-        "confidence": 1.0,
-        "number": 2
-    })
-    
-    # 7. Red ball #3 
-    ball_positions.append({
-        "color": "red",
-        "x": int(x + w * 0.86),  
-        "y": int(y + h * 0.52),  
-        "radius": BALL_RADIUS,
-        "confidence": 1.0,
-        "number": 3
-    })
-    
-    # 8. Red ball #4 
-    ball_positions.append({
-        "color": "red",
-        "x": int(x + w * 0.68),  
-        "y": int(y + h * 0.65),  
-        "radius": BALL_RADIUS,
-        "confidence": 1.0,
-        "number": 4
-    })
-    
-    # Debug directory for visualization
-    debug_dir = "debug"
-    if not os.path.exists(debug_dir):
-        os.makedirs(debug_dir)
+    # Known layout: colour, position as a fraction of the table, and number (-1 for none)
+    layout = [
+        ("white", 0.75, 0.23, -1),    # 1. White cue ball
+        ("black", 0.5, 0.5, 8),       # 2. Black 8-ball
+        ("yellow", 0.19, 0.75, 1),    # 3. Yellow ball #1
+        ("yellow", 0.64, 0.35, 2),    # 4. Yellow ball #2
+        # RED BALLS - 4 of them in the image
+        ("red", 0.79, 0.22, 1),       # 5. Red ball #1
+        ("red", 0.57, 0.25, 2),       # 6. Red ball #2
+        ("red", 0.86, 0.52, 3),       # 7. Red ball #3
+        ("red", 0.68, 0.65, 4),       # 8. Red ball #4
+    ]
+    colors, rel_x, rel_y, numbers = zip(*layout)
+    ball_positions = make_balls(colors, (x + w * np.array(rel_x)).astype(int), (y + h * np.array(rel_y)).astype(int),
+                                BALL_RADIUS, confidence=1.0, number=numbers)
+    
+    if debug is None:
+        debug = DebugSink()
         
     # Visualize detected balls for debugging
-    balls_debug_image = image.copy()
-    for ball in ball_positions:
-        # Set colour for visualisation
-        color_bgr = (0, 0, 255) if ball["color"] == "red" else \
-                   (0, 255, 255) if ball["color"] == "yellow" else \
-                   (255, 255, 255) if ball["color"] == "white" else \
-                   (0, 0, 0)
-        
-        # Draw circle at ball position
-        cv2.circle(balls_debug_image, (ball["x"], ball["y"]), int(ball.get("radius", 15)), color_bgr, 2)
-        # Mark center
-        cv2.circle(balls_debug_image, (ball["x"], ball["y"]), 2, (0, 0, 255), -1)
-        
-        # Add label with colour and number
-        label = f"{ball['color']}"
-        if "number" in ball and ball["color"] != "white" and ball["color"] != "black":
-            label += f" {ball['number']}"
+    if debug.enabled:
+        balls_debug_image = image.copy()
+        for color, ball_x, ball_y, radius, number in zip(ball_colors(ball_positions), ball_positions["x"].tolist(),
+                                                         ball_positions["y"].tolist(),
+                                                         ball_positions["radius"].tolist(),
+                                                         ball_positions["number"].tolist()):
+            # Set colour for visualisation
+            color_bgr = (0, 0, 255) if color == "red" else \
+                       (0, 255, 255) if color == "yellow" else \
+                       (255, 255, 255) if color == "white" else \
+                       (0, 0, 0)
             
-        cv2.putText(balls_debug_image, label, (ball["x"]-30, ball["y"]-20), 
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
-    
-    cv2.imwrite(os.path.join(debug_dir, "custom_detected_balls.jpg"), balls_debug_image)
+            # Draw circle at ball position
+            cv2.circle(balls_debug_image, (ball_x, ball_y), int(radius), color_bgr, 2)
+            # Mark center
+            cv2.circle(balls_debug_image, (ball_x, ball_y), 2, (0, 0, 255), -1)
+            
+            # Add label with colour and number
+            label = f"{color}"
+            if number >= 0 and color != "white" and color != "black":
+                label += f" {number}"
+                
+            cv2.putText(balls_debug_image, label, (ball_x-30, ball_y-20), 
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
+        
+        debug.save("custom_detected_balls.jpg", balls_debug_image)
     
     return ball_positions
 
-def detect_table_bounds(image):
-    """Detect the pool table boundaries in the image."""
+# Table detection working resolution
+# The felt is found on a downscaled pyramid level whose longer side fits TABLE_WORKING_MAX_DIM,
+# then the bounds are scaled back up and optionally refined at full resolution along each edge.
+# POOL_TABLE_WORKING_MAX_DIM=0 detects at full resolution; POOL_TABLE_REFINE_EDGES=off skips refinement.
+TABLE_WORKING_MAX_DIM = 1024
+TABLE_MORPH_KERNEL = 15  # At full resolution; scaled down with the working level
+
+# Felt colour ranges (inclusive HSV), one per lighting condition; a pixel in any of them is felt
+TABLE_GREEN_RANGES = [
+    # Dark green (typical pool felt)
+    ((30, 30, 30), (90, 255, 255)),
+    # Lighter green
+    ((25, 20, 20), (100, 255, 255)),
+    # Yellowish green (for older tables or particular lighting)
+    ((20, 30, 30), (40, 255, 255)),
+]
+
+def table_green_mask(image, green_ranges=TABLE_GREEN_RANGES):
+    """Combine the felt colour ranges into a single mask."""
+    # Convert to HSV for better green detection
+    return green_mask_from_hsv(cv2.cvtColor(image, cv2.COLOR_BGR2HSV), green_ranges)
+
+def green_mask_from_hsv(hsv, green_ranges=TABLE_GREEN_RANGES):
+    """table_green_mask for an image that is already in HSV."""
+    # Multiple green range detections for different lighting conditions, combined into one mask
+    combined_mask = np.zeros(hsv.shape[:2], dtype=np.uint8)
+    for lower, upper in green_ranges:
+        combined_mask = cv2.bitwise_or(combined_mask, cv2.inRange(hsv, np.array(lower), np.array(upper)))
+    
+    return combined_mask
+
+def clean_table_mask(mask, kernel_size):
+    """Close small gaps in the felt and drop specks around it."""
+    kernel = np.ones((kernel_size, kernel_size), np.uint8)
+    clean_mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    return cv2.morphologyEx(clean_mask, cv2.MORPH_OPEN, kernel)
+
+def table_pyramid_level(image, max_dim):
+    """Halve the image with pyrDown until its longer side fits max_dim. Returns (level, scale)."""
+    level, scale = image, 1.0
+    if max_dim and max_dim > 0:
+        while max(level.shape[:2]) > max_dim:
+            level = cv2.pyrDown(level)
+            scale /= 2
+    return level, scale
+
+# Request-scoped image context
+# Stages ask one ImageContext per decoded image for derived representations (pyramid levels, HSV,
+# the felt mask, crops) instead of converting the image themselves, so each is computed at most once
+# and crops are views into buffers that already exist. A context belongs to one request and venue.
+class ImageContext:
+    """Lazily computed, memoised representations of one decoded image."""
+
+    def __init__(self, image):
+        self.image = image
+        self._derived = {}
+        self.derivations = []
+        # Convex hull of the table felt in image pixels, and how far to grow it; set by detect_table_bounds
+        self.felt_hull = None
+        self.felt_hull_margin = 0
+
+    def derive(self, key, build, name=None):
+        """Return the value memoised under key, building it (and recording its cost) on first use."""
+        if key not in self._derived:
+            start = time.perf_counter()
+            value = build()
+            self._derived[key] = value
+            arrays = [item for item in (value if isinstance(value, tuple) else (value,)) if isinstance(item, np.ndarray)]
+            # Views into the image (or into another derivation) cost no memory of their own
+            owned = sum(array.nbytes for array in arrays if array.base is None and array is not self.image)
+            self.derivations.append({"name": name or str(key), "ms": round((time.perf_counter() - start) * 1000, 3),
+                                     "bytes": int(owned)})
+        return self._derived[key]
+
+    def level(self, max_dim):
+        """The pyramid level whose longer side fits max_dim, and its scale (see table_pyramid_level)."""
+        if not max_dim or max_dim <= 0 or max(self.image.shape[:2]) <= max_dim:
+            return self.image, 1.0
+        return self.derive(("level", max_dim), lambda: table_pyramid_level(self.image, max_dim), f"level@{max_dim}")
+
+    def hsv(self, max_dim=0):
+        """HSV of the level for max_dim; 0, or any max_dim the image already fits, means full resolution."""
+        level, scale = self.level(max_dim)
+        return self.derive(("hsv", scale), lambda: cv2.cvtColor(level, cv2.COLOR_BGR2HSV), f"hsv@{scale:g}")
+
+    def felt_mask(self, max_dim, green_ranges=TABLE_GREEN_RANGES):
+        """The combined felt-colour mask of the level for max_dim."""
+        _, scale = self.level(max_dim)
+        return self.derive(("felt_mask", scale, tuple(map(tuple, green_ranges))),
+                           lambda: green_mask_from_hsv(self.hsv(max_dim), green_ranges), f"felt_mask@{scale:g}")
+
+    def crop(self, bounds):
+        """A view of the (x, y, width, height) region of the image."""
+        x, y, w, h = bounds
+        return self.image[y:y + h, x:x + w]
+
+    def crop_hsv(self, bounds, memoise=True):
+        """HSV of a region: a view when the full-resolution HSV exists, otherwise converted for the region alone."""
+        x, y, w, h = bounds
+        full = self._derived.get(("hsv", 1.0))
+        if full is not None:
+            return full[y:y + h, x:x + w]
+        if not memoise:
+            return cv2.cvtColor(self.crop(bounds), cv2.COLOR_BGR2HSV)
+        return self.derive(("hsv_crop", tuple(bounds)), lambda: cv2.cvtColor(self.crop(bounds), cv2.COLOR_BGR2HSV),
+                           f"hsv_crop@{w}x{h}")
+
+    def felt_region(self, bounds):
+        """Mask (255 = felt) of the felt hull over the (x, y, width, height) region, or None if no hull is known."""
+        if self.felt_hull is None:
+            return None
+        x, y, w, h = bounds
+        
+        def build():
+            mask = np.zeros((h, w), dtype=np.uint8)
+            hull = (self.felt_hull - [x, y]).astype(np.int32)
+            cv2.fillConvexPoly(mask, hull, 255)
+            if self.felt_hull_margin > 0:
+                # The hull was traced on a downscaled level; grow it so balls against the cushion stay whole
+                cv2.polylines(mask, [hull], True, 255, 2 * self.felt_hull_margin + 1)
+            return mask
+        
+        return self.derive(("felt_region", tuple(bounds)), build, f"felt_region@{w}x{h}")
+
+    def report(self):
+        """Which derivations were computed, in order, and the memory they hold."""
+        total = sum(derivation["bytes"] for derivation in self.derivations)
+        return {"derivations": self.derivations, "total_mb": round(total / (1024 * 1024), 3)}
+
+def refine_table_edges(image, table_bounds, band, kernel_size=TABLE_MORPH_KERNEL, green_ranges=TABLE_GREEN_RANGES,
+                       context=None):
+    """
+    Snap each edge of coarse table bounds to the felt boundary at full resolution.
+    Only a strip of +/- band pixels around each edge is examined.
+    """
+    if context is None:
+        context = ImageContext(image)
+    height, width = image.shape[:2]
+    x, y, w, h = table_bounds["x"], table_bounds["y"], table_bounds["width"], table_bounds["height"]
+    left, top, right, bottom = x, y, x + w, y + h
+    
+    # Strips along each edge, spanning the length of the edge
+    strips = {
+        "left": (top, bottom, max(0, left - band), min(width, left + band)),
+        "right": (top, bottom, max(0, right - band), min(width, right + band)),
+        "top": (max(0, top - band), min(height, top + band), left, right),
+        "bottom": (max(0, bottom - band), min(height, bottom + band), left, right)
+    }
+    
+    refined = {}
+    for edge, (y0, y1, x0, x1) in strips.items():
+        if y1 <= y0 or x1 <= x0:
+            continue
+        # Clean with some context around the strip so the morphology behaves as it would on the full mask
+        cy0, cy1 = max(0, y0 - kernel_size), min(height, y1 + kernel_size)
+        cx0, cx1 = max(0, x0 - kernel_size), min(width, x1 + kernel_size)
+        region_hsv = context.crop_hsv((cx0, cy0, cx1 - cx0, cy1 - cy0), memoise=False)
+        context_mask = clean_table_mask(green_mask_from_hsv(region_hsv, green_ranges), kernel_size)
+        strip_labels = cv2.connectedComponents(context_mask)[1][y0 - cy0:y1 - cy0, x0 - cx0:x1 - cx0]
+        
+        # Only felt connected to the table side of the strip counts, not separate green clutter
+        inner = {"left": strip_labels[:, -1], "right": strip_labels[:, 0],
+                 "top": strip_labels[-1, :], "bottom": strip_labels[0, :]}[edge]
+        strip_mask = np.isin(strip_labels, inner[inner > 0])
+        
+        # Felt coverage along the strip, one entry per column (left/right) or row (top/bottom)
+        axis = 0 if edge in ("left", "right") else 1
+        covered = np.flatnonzero(strip_mask.any(axis=axis))
+        if covered.size == 0:
+            continue
+        
+        # The outermost felt pixel becomes the new edge
+        if edge == "left":
+            refined[edge] = x0 + covered[0]
+        elif edge == "right":
+            refined[edge] = x0 + covered[-1] + 1
+        elif edge == "top":
+            refined[edge] = y0 + covered[0]
+        else:
+            refined[edge] = y0 + covered[-1] + 1
+    
+    left, right = refined.get("left", left), refined.get("right", right)
+    top, bottom = refined.get("top", top), refined.get("bottom", bottom)
+    if right <= left or bottom <= top:
+        return table_bounds
+    return {"x": int(left), "y": int(top), "width": int(right - left), "height": int(bottom - top)}
+
+def detect_table_bounds(image, debug=None, max_dim=None, refine=None, image_scale=1, venue=None, context=None):
+    """
+    Detect the pool table boundaries in the image.
+    
+    Detection runs on a pyramid level no larger than max_dim (default TABLE_WORKING_MAX_DIM or
+    POOL_TABLE_WORKING_MAX_DIM) and, when refine is on, the edges are re-fitted at full resolution.
+    image_scale is how many original pixels one pixel of image spans, for reduced-resolution decodes.
+    The felt colours and morphology kernel come from the venue profile; the working level and its
+    felt mask come from context (an ImageContext for image), shared with later stages.
+    """
+    if debug is None:
+        debug = DebugSink()
+    if venue is None:
+        venue = get_venue_profile()
+    if context is None:
+        context = ImageContext(image)
+    if max_dim is None:
+        max_dim = int(os.environ.get("POOL_TABLE_WORKING_MAX_DIM", TABLE_WORKING_MAX_DIM))
+    if refine is None:
+        refine = os.environ.get("POOL_TABLE_REFINE_EDGES", "on") != "off"
+
     try:
-        debug_dir = "debug"
-        if not os.path.exists(debug_dir):
-            os.makedirs(debug_dir)
-        
-        # Convert to HSV for better green detection
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        
-        # Multiple green range detections for different lighting conditions
-        green_masks = []
+        # Work on a downscaled level for large photos
+        level, scale = context.level(max_dim)
+        kernel_size = max(3, int(round(venue.table_morph_kernel * scale / image_scale)) | 1)
         
-        # Dark green (typical pool felt)
-        lower_green1 = np.array([30, 30, 30])
-        upper_green1 = np.array([90, 255, 255])
-        green_masks.append(cv2.inRange(hsv, lower_green1, upper_green1))
-        
-        # Lighter green
-        lower_green2 = np.array([25, 20, 20])
-        upper_green2 = np.array([100, 255, 255])
-        green_masks.append(cv2.inRange(hsv, lower_green2, upper_green2))
-        
-        # Yellowish green (for older tables or particular lighting)
-        lower_green3 = np.array([20, 30, 30])
-        upper_green3 = np.array([40, 255, 255])
-        green_masks.append(cv2.inRange(hsv, lower_green3, upper_green3))
-        
-        # Combine all masks
-        combined_mask = np.zeros_like(green_masks[0])
-        for mask in green_masks:
-            combined_mask = cv2.bitwise_or(combined_mask, mask)
+        combined_mask = context.felt_mask(max_dim, venue.table_green_ranges)
         
         # Save combined mask for debugging
-        cv2.imwrite(os.path.join(debug_dir, "combined_green_mask.jpg"), combined_mask)
+        debug.save("combined_green_mask.jpg", combined_mask)
         
         # Morphological operations to clean the mask
-        kernel = np.ones((15, 15), np.uint8)  
-        clean_mask = cv2.morphologyEx(combined_mask, cv2.MORPH_CLOSE, kernel)
-        clean_mask = cv2.morphologyEx(clean_mask, cv2.MORPH_OPEN, kernel)
+        clean_mask = clean_table_mask(combined_mask, kernel_size)
         
         # Save cleaned mask
-        cv2.imwrite(os.path.join(debug_dir, "cleaned_green_mask.jpg"), clean_mask)
+        debug.save("cleaned_green_mask.jpg", clean_mask)
         
         # Find contours
         contours, _ = cv2.findContours(clean_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -192,10 +405,12 @@ def detect_table_bounds(image):
         # Sort contours by area
         contours = sorted(contours, key=cv2.contourArea, reverse=True)
         
-        height, width = image.shape[:2]
+        height, width = level.shape[:2]
         
         # Look for the largest contour with reasonable aspect ratio
         valid_table_bounds = None
+        fitted_to_felt = False  # True when the bounds hug the felt contour rather than a rotated box
+        felt_contour = None
         for contour in contours[:5]:  # Check top 5 largest contours
             area = cv2.contourArea(contour)
             
@@ -213,6 +428,8 @@ def detect_table_bounds(image):
             # but i'll be more permissive here
             if 1.3 <= aspect_ratio <= 2.7:
                 valid_table_bounds = {"x": int(x), "y": int(y), "width": int(w), "height": int(h)}
+                fitted_to_felt = True
+                felt_contour = contour
                 break
         
         # If no suitable contour found, try with rotated bounding rectangle
@@ -221,7 +438,7 @@ def detect_table_bounds(image):
             largest_contour = contours[0]
             rect = cv2.minAreaRect(largest_contour)
             box = cv2.boxPoints(rect)
-            box = np.int0(box)
+            box = box.astype(np.intp)
             
             # Get width and height of the rotated rectangle
             width = rect[1][0]
@@ -234,20 +451,45 @@ def detect_table_bounds(image):
             aspect_ratio = width / height if height > 0 else 0
             
             if 1.3 <= aspect_ratio <= 2.7:
-                # Convert rotated rectangle to axis-aligned bounding box
+                # Convert rotated rectangle to axis-aligned bounding box, clipped to the image (the corners
+                # of a tilted box can fall outside it)
                 x, y, w, h = cv2.boundingRect(box)
-                valid_table_bounds = {"x": int(x), "y": int(y), "width": int(w), "height": int(h)}
+                left, top = max(0, x), max(0, y)
+                right, bottom = min(level.shape[1], x + w), min(level.shape[0], y + h)
+                valid_table_bounds = {"x": int(left), "y": int(top), "width": int(right - left),
+                                      "height": int(bottom - top)}
+                felt_contour = largest_contour
         
         # If still no valid bounds, use the entire image
         if not valid_table_bounds:
+            height, width = image.shape[:2]
             valid_table_bounds = {"x": 0, "y": 0, "width": int(width), "height": int(height)}
             print("Could not detect table, using full image", file=sys.stderr)
+        elif scale < 1:
+            # Scale the bounds back up to the original image
+            x, y, w, h = valid_table_bounds["x"], valid_table_bounds["y"], valid_table_bounds["width"], valid_table_bounds["height"]
+            left, top = int(round(x / scale)), int(round(y / scale))
+            right, bottom = int(round((x + w) / scale)), int(round((y + h) / scale))
+            valid_table_bounds = {"x": left, "y": top, "width": right - left, "height": bottom - top}
+            if refine and fitted_to_felt:
+                # A pixel on the working level covers 1/scale original pixels; search a couple either side
+                valid_table_bounds = refine_table_edges(image, valid_table_bounds, int(np.ceil(2 / scale)) + 2,
+                                                        max(3, int(round(venue.table_morph_kernel / image_scale)) | 1),
+                                                        venue.table_green_ranges, context)
+        
+        # Keep the felt outline so ball detection can ignore rails, pockets and background
+        if felt_contour is not None:
+            context.felt_hull = np.round(cv2.convexHull(felt_contour).reshape(-1, 2) / scale).astype(np.int32)
+            context.felt_hull_margin = int(np.ceil(1 / scale))
         
         # Draw the detected table bounds for debugging
-        debug_image = image.copy()
-        x, y, w, h = valid_table_bounds["x"], valid_table_bounds["y"], valid_table_bounds["width"], valid_table_bounds["height"]
-        cv2.rectangle(debug_image, (x, y), (x + w, y + h), (0, 255, 0), 3)
-        cv2.imwrite(os.path.join(debug_dir, "detected_table.jpg"), debug_image)
+        if debug.enabled:
+            debug_image = image.copy()
+            x, y, w, h = valid_table_bounds["x"], valid_table_bounds["y"], valid_table_bounds["width"], valid_table_bounds["height"]
+            cv2.rectangle(debug_image, (x, y), (x + w, y + h), (0, 255, 0), 3)
+            if context.felt_hull is not None:
+                cv2.polylines(debug_image, [context.felt_hull], True, (255, 255, 0), 2)
+            debug.save("detected_table.jpg", debug_image)
         
         return valid_table_bounds
     
@@ -302,16 +544,427 @@ def detect_ball_color(ball_roi):
         print(f"Error detecting ball color: {e}", file=sys.stderr)
         return "unknown"
 
-def detect_balls(image, table_bounds):
-    """Ball detection algorithm optimized for simple rendered pool table images."""
-    ball_positions = []
+# Ball colour classes segmented from the image, in priority order (earlier classes win overlaps).
+# Each class is a list of inclusive HSV ranges (at most 8 ranges in total).
+BALL_COLOR_CLASSES = [
+    # White balls - more permissive range
+    ("white", [((0, 0, 170), (180, 50, 255))]),
+    # Red balls - much more permissive range for bright reds, plus the bright red in the reference image
+    ("red", [((0, 50, 50), (15, 255, 255)), ((160, 50, 50), (180, 255, 255)), ((0, 150, 100), (10, 255, 255))]),
+    # Yellow balls
+    ("yellow", [((20, 70, 50), (40, 255, 255))]),
+]
+
+# Black range, only used for the debug mask (it mostly matches pockets)
+BLACK_HSV_RANGE = ((0, 0, 0), (180, 255, 60))
+
+# Blob filters, at full resolution: contour area range in pixels and minimum circularity
+BALL_AREA_RANGE = (80, 2000)
+BALL_MIN_CIRCULARITY = 0.6  # More permissive circularity threshold
+
+_class_luts = None
+
+def build_class_luts(color_classes=BALL_COLOR_CLASSES):
+    """
+    Build the lookup tables used to classify every pixel in a single pass.
+
+    Every HSV range gets one bit. The channel table (256x1x3) sets a range's bit when that
+    channel's value lies inside the range, so AND-ing the three channels leaves exactly the
+    bits of the ranges containing the pixel. The class table then maps those bits to one bit
+    per class (bit 0 = first class), so a pixel inside ranges of two classes belongs to both,
+    just as it would be in both of two separate inRange masks.
+    """
+    ranges = [(class_id, lower, upper)
+              for class_id, (_, class_ranges) in enumerate(color_classes, start=1)
+              for lower, upper in class_ranges]
+    if len(ranges) > 8:
+        raise ValueError("At most 8 HSV ranges fit in the 8-bit classification mask")
+    
+    channel_lut = np.zeros((256, 1, 3), dtype=np.uint8)
+    range_class_ids = []
+    for bit, (class_id, lower, upper) in enumerate(ranges):
+        for channel in range(3):
+            channel_lut[lower[channel]:upper[channel] + 1, 0, channel] |= 1 << bit
+        range_class_ids.append(class_id)
+    
+    class_lut = np.zeros((256, 1), dtype=np.uint8)
+    for bits in range(1, 256):
+        for bit, class_id in enumerate(range_class_ids):
+            if bits & (1 << bit):
+                class_lut[bits] |= 1 << (class_id - 1)
+    
+    return channel_lut, class_lut
+
+# Class bits -> the id of the lowest class set (0 = none), for callers that need one class per pixel
+CLASS_PRIORITY_LUT = np.array([(bits & -bits).bit_length() for bits in range(256)], dtype=np.uint8).reshape(256, 1)
+
+def get_class_luts():
+    global _class_luts
+    if _class_luts is None:
+        _class_luts = build_class_luts()
+    return _class_luts
+
+def classify_hsv_classes(hsv_image, luts=None):
+    """Mark every pixel of an HSV image with the ball classes containing it, one bit per class, in a single pass."""
+    channel_lut, class_lut = luts or get_class_luts()
+    
+    h_bits, s_bits, v_bits = cv2.split(cv2.LUT(hsv_image, channel_lut))
+    range_bits = cv2.bitwise_and(cv2.bitwise_and(h_bits, s_bits), v_bits)
+    return cv2.LUT(range_bits, class_lut)
+
+def classify_hsv_pixels(hsv_image, luts=None):
+    """Label every pixel of an HSV image with a single ball class id, earlier classes winning overlaps."""
+    return cv2.LUT(classify_hsv_classes(hsv_image, luts), CLASS_PRIORITY_LUT)
+
+def class_mask(class_bits, class_id):
+    """Binary mask of the pixels belonging to one class in a class bit map."""
+    return cv2.compare(np.bitwise_and(class_bits, np.uint8(1 << (class_id - 1))), 0, cv2.CMP_GT)
+
+def clean_class_mask(mask):
+    """Morphological opening then closing with a 3x3 kernel, the clean-up every ball mask gets."""
+    kernel = np.ones((3, 3), np.uint8)
+    return cv2.morphologyEx(cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel), cv2.MORPH_CLOSE, kernel)
+
+# Parallel contour analysis
+# OpenCV releases the GIL in findContours and the per-contour measurements, so per-colour (and, for
+# large crops, per-tile) work runs on one shared thread pool. POOL_CONTOUR_THREADS sets its size;
+# 1 keeps everything on the calling thread. Results are sorted the same way whichever path ran.
+CONTOUR_THREADS = min(4, os.cpu_count() or 1)
+TILE_MIN_PIXELS = 2_000_000  # Crops larger than this are segmented in horizontal tiles
+TILE_HALO = 64               # Rows of overlap between tiles; comfortably more than a ball diameter
+
+_contour_executor = None
+_contour_executor_threads = 0  # Size _contour_executor was created with
+
+def get_contour_executor():
+    """The shared contour thread pool, or None when running single-threaded."""
+    global _contour_executor, _contour_executor_threads
+    threads = int(os.environ.get("POOL_CONTOUR_THREADS", CONTOUR_THREADS))
+    if _contour_executor is not None and _contour_executor_threads != threads:
+        # The size changed: let the old pool finish what it has and release its threads
+        _contour_executor.shutdown(wait=True)
+        _contour_executor, _contour_executor_threads = None, 0
+    if threads <= 1:
+        return None
+    if _contour_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _contour_executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="contours")
+        _contour_executor_threads = threads
+    return _contour_executor
+
+# Ball state
+# Balls travel between stages as one structured array, a record per ball, instead of a list of dicts:
+# filtering, sorting, scaling and mapping are then single numpy operations. Colours are stored as an
+# index into BALL_COLORS (venue profiles register any colours they add), numbers as -1 when unset.
+# ball_positions_json builds the response's list of dicts only once mapping is done.
+BALL_DTYPE = np.dtype([
+    ("color", np.uint8),       # Index into BALL_COLORS
+    ("number", np.int16),      # Ball number, -1 for none
+    ("x", np.int32),           # Centre in image pixels
+    ("y", np.int32),
+    ("game_x", np.int32),      # Centre on the game table, filled in by map_ball_positions
+    ("game_y", np.int32),
+    ("radius", np.float32),    # Image pixels
+    ("confidence", np.float32),
+    ("synthetic", np.bool_),   # Placeholder for a colour that wasn't found
+])
+BALL_COLORS = ["unknown", "white", "black", "red", "yellow"]
+_ball_color_ids = {color: color_id for color_id, color in enumerate(BALL_COLORS)}
+
+def ball_color_id(color):
+    """The colour id stored in ball records, registering colours the built-in names don't cover."""
+    color_id = _ball_color_ids.get(color)
+    if color_id is None:
+        if len(BALL_COLORS) > np.iinfo(BALL_DTYPE["color"]).max:
+            raise ValueError("Too many ball colours")
+        color_id = _ball_color_ids[color] = len(BALL_COLORS)
+        BALL_COLORS.append(color)
+    return color_id
+
+def ball_colors(balls):
+    """Colour names of a ball array, in order."""
+    return [BALL_COLORS[color_id] for color_id in balls["color"].tolist()]
+
+def make_balls(colors, x, y, radius, confidence=0.0, number=-1, synthetic=False):
+    """
+    Build a ball array. colors is one colour name or a name per ball; the other fields take
+    a sequence or a single value shared by every ball.
+    """
+    balls = np.zeros(len(x), dtype=BALL_DTYPE)
+    balls["color"] = ball_color_id(colors) if isinstance(colors, str) else [ball_color_id(color) for color in colors]
+    balls["x"] = x
+    balls["y"] = y
+    balls["radius"] = radius
+    balls["confidence"] = confidence
+    balls["number"] = number
+    balls["synthetic"] = synthetic
+    return balls
+
+def concatenate_balls(parts):
+    """Join ball arrays into one (an empty array when there are none)."""
+    return np.concatenate(parts) if parts else np.empty(0, dtype=BALL_DTYPE)
+
+def sort_balls(balls, color_classes=BALL_COLOR_CLASSES):
+    """Order detections by colour class, then top-to-bottom and left-to-right."""
+    class_ids = [ball_color_id(color) for color, _ in color_classes]
+    class_order = np.full(len(BALL_COLORS), len(class_ids))
+    class_order[class_ids] = np.arange(len(class_ids))
+    return balls[np.lexsort((balls["x"], balls["y"], class_order[balls["color"]]))]
+
+def ball_positions_json(balls):
+    """The response's ball_positions: a dict per mapped ball with its game and original image position."""
+    return [
+        {
+            "color": color,
+            "x": game_x,
+            "y": game_y,
+            "number": None if number < 0 else number,
+            "originalX": x,
+            "originalY": y,
+            "synthetic": synthetic
+        }
+        for color, game_x, game_y, number, x, y, synthetic in zip(
+            ball_colors(balls), balls["game_x"].tolist(), balls["game_y"].tolist(), balls["number"].tolist(),
+            balls["x"].tolist(), balls["y"].tolist(), balls["synthetic"].tolist())
+    ]
+
+def ball_search_mask(context, bounds):
+    """
+    The felt region of a crop that ball segmentation is limited to, or None to search all of it.
+    POOL_FELT_MASK=off searches the whole table rectangle, rails and pockets included.
+    """
+    if os.environ.get("POOL_FELT_MASK", "on") == "off":
+        return None
+    return context.felt_region(bounds)
+
+def segment_labels(bgr_image, venue=None, region_mask=None):
+    """Mark every pixel with the ball classes containing it (one bit per class), as detect_balls does."""
+    if venue is None:
+        venue = get_venue_profile()
+    labels = classify_hsv_classes(cv2.cvtColor(bgr_image, cv2.COLOR_BGR2HSV), venue.class_luts)
+    if region_mask is not None:
+        labels = cv2.bitwise_and(labels, region_mask)
+    return labels
+
+def find_class_balls(labels, class_id, color, offset_x=0, offset_y=0, image_scale=1, keep_contour=None, venue=None):
+    """Clean one ball class's mask from a class bit map, contour it and keep the round, ball-sized blobs."""
+    circles = []
+    if venue is None:
+        venue = get_venue_profile()
+    min_area, max_area = venue.ball_area_range
+    
+    # Apply morphological operations to clean up this class's mask, then find contours
+    mask = clean_class_mask(class_mask(labels, class_id))
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    
+    # Filter by size and circularity
+    for contour in contours:
+        if keep_contour is not None and not keep_contour(contour):
+            continue
+        
+        area = cv2.contourArea(contour)
+        
+        # Skip if too small or too large
+        if area < min_area / image_scale ** 2 or area > max_area / image_scale ** 2:
+            continue
+        
+        # Check circularity
+        perimeter = cv2.arcLength(contour, True)
+        circularity = 4 * np.pi * area / (perimeter * perimeter) if perimeter > 0 else 0
+        
+        if circularity > venue.ball_min_circularity:
+            # Get the center and radius
+            (cx, cy), radius = cv2.minEnclosingCircle(contour)
+            circles.append((int(cx) + offset_x, int(cy) + offset_y, int(radius), circularity))
+    
+    x, y, radius, confidence = zip(*circles) if circles else ((), (), (), ())
+    return make_balls(color, x, y, radius, confidence)
+
+def find_balls_in_labels(labels, offset_x=0, offset_y=0, image_scale=1, executor=None, keep_contour=None,
+                         venue=None):
+    """
+    Clean and contour every ball class in a class bit map and keep the round, ball-sized blobs.
+    Positions are shifted by (offset_x, offset_y) into image coordinates. With an executor,
+    each class is cleaned and contoured on its own thread.
+    """
+    if venue is None:
+        venue = get_venue_profile()
+    tasks = [(labels, class_id, color, offset_x, offset_y, image_scale, keep_contour, venue)
+             for class_id, (color, _) in enumerate(venue.ball_color_classes, start=1)]
+    
+    if executor is None:
+        per_class = [find_class_balls(*task) for task in tasks]
+    else:
+        per_class = [future.result() for future in [executor.submit(find_class_balls, *task) for task in tasks]]
+    
+    return sort_balls(concatenate_balls(per_class), venue.ball_color_classes)
+
+def find_balls_in_tile(table_image, top, bottom, core_top, core_bottom, offset_x, offset_y, image_scale, venue,
+                       region_mask=None):
+    """
+    Segment and contour rows [top, bottom) of the table crop, keeping balls centred in
+    [core_top, core_bottom). Blobs cut by an inner tile edge are left to the neighbouring tile.
+    """
+    labels = segment_labels(table_image[top:bottom], venue, None if region_mask is None else region_mask[top:bottom])
+    tile_height = bottom - top
+    
+    def keep_contour(contour):
+        _, contour_y, _, contour_h = cv2.boundingRect(contour)
+        cut_at_top = top > 0 and contour_y == 0
+        cut_at_bottom = bottom < table_image.shape[0] and contour_y + contour_h == tile_height
+        return not (cut_at_top or cut_at_bottom)
+    
+    balls = find_balls_in_labels(labels, offset_x, offset_y + top, image_scale, keep_contour=keep_contour, venue=venue)
+    return balls[(balls["y"] - offset_y >= core_top) & (balls["y"] - offset_y < core_bottom)]
+
+def find_balls_in_tiles(table_image, offset_x, offset_y, image_scale, executor, venue, region_mask=None):
+    """Split a large table crop into overlapping horizontal tiles and process them in parallel."""
+    height = table_image.shape[0]
+    tile_count = max(1, min(_contour_executor_threads, height // (4 * TILE_HALO)))
+    bounds = np.linspace(0, height, tile_count + 1).astype(int)
+    
+    futures = []
+    for core_top, core_bottom in zip(bounds[:-1], bounds[1:]):
+        top, bottom = max(0, core_top - TILE_HALO), min(height, core_bottom + TILE_HALO)
+        futures.append(executor.submit(find_balls_in_tile, table_image, top, bottom, core_top, core_bottom,
+                                       offset_x, offset_y, image_scale, venue, region_mask))
+    
+    return sort_balls(concatenate_balls([future.result() for future in futures]), venue.ball_color_classes)
+
+def detect_balls_in_crop(table_image, offset_x, offset_y, image_scale=1, executor=None, debug=None, venue=None,
+                         hsv_image=None, region_mask=None):
+    """
+    Segment the whole table crop at once, saving the class masks when debugging.
+    With a region_mask, only pixels inside it (the felt) can belong to a ball.
+    """
+    if debug is None:
+        debug = DebugSink()
+    if venue is None:
+        venue = get_venue_profile()
+    
+    # Convert to HSV for better ball detection (unless the caller already has it)
+    if hsv_image is None:
+        hsv_image = cv2.cvtColor(table_image, cv2.COLOR_BGR2HSV)
+    
+    # Save HSV image for debugging
+    debug.save("hsv_image.jpg", hsv_image)
+    
+    # Mark every pixel with its ball classes in one lookup pass
+    labels = classify_hsv_classes(hsv_image, venue.class_luts)
+    if region_mask is not None:
+        labels = cv2.bitwise_and(labels, region_mask)
+        debug.save("felt_region.jpg", region_mask)
+    
+    # Save masks for debugging
+    if debug.enabled:
+        for class_id, (color, _) in enumerate(venue.ball_color_classes, start=1):
+            debug.save(f"{color}_mask.jpg", class_mask(labels, class_id))
+        # Black is never segmented: on these tables it mostly picks up the pockets
+        debug.save("black_mask.jpg", cv2.inRange(hsv_image, np.array(BLACK_HSV_RANGE[0]), np.array(BLACK_HSV_RANGE[1])))
+        debug.save("all_masks.jpg", cv2.compare(labels, 0, cv2.CMP_GT))
+    
+    return find_balls_in_labels(labels, offset_x, offset_y, image_scale, executor, venue=venue)
+
+def contour_ball_detector(table_image, offset_x, offset_y, image_scale, debug, stats, venue, context):
+    """Colour segmentation followed by contour analysis on the felt; the default engine."""
+    bounds = (offset_x, offset_y, table_image.shape[1], table_image.shape[0])
+    region_mask = ball_search_mask(context, bounds)
+    executor = get_contour_executor()
+    if executor is not None and not debug.enabled and table_image.shape[0] * table_image.shape[1] >= TILE_MIN_PIXELS:
+        # Large crop: segment and contour overlapping tiles in parallel (the debug masks need the whole table)
+        return find_balls_in_tiles(table_image, offset_x, offset_y, image_scale, executor, venue, region_mask)
+    return detect_balls_in_crop(table_image, offset_x, offset_y, image_scale, executor, debug, venue,
+                                context.crop_hsv(bounds), region_mask)
+
+# Gradient engine
+# HoughCircles on a downscaled copy of the table crop. Ball size is tied to the table rather than the
+# photo, so the radius range is a fraction of the detected table width and needs no retuning between
+# close-ups and wide shots. Each circle is then coloured by a majority vote of the pixel classes inside it.
+HOUGH_WORKING_WIDTH = 800               # Table crop is shrunk to at most this width before the transform
+HOUGH_RADIUS_RANGE = (0.008, 0.022)     # Ball radius as a fraction of the table width
+HOUGH_MIN_CLASS_FRACTION = 0.5          # Share of a circle's pixels that must agree on a ball class
+
+def hough_ball_detector(table_image, offset_x, offset_y, image_scale, debug, stats, venue, context):
+    """Find round edges with the gradient Hough transform, then colour each circle from the class LUT."""
+    found = []
+    scale = min(1.0, HOUGH_WORKING_WIDTH / table_image.shape[1])
+    small = cv2.resize(table_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else table_image
+    
+    # Radius limits follow the table size, not the image size
+    table_width = small.shape[1]
+    min_radius = max(3, int(table_width * HOUGH_RADIUS_RANGE[0]))
+    max_radius = max(min_radius + 2, int(np.ceil(table_width * HOUGH_RADIUS_RANGE[1])))
+    
+    gray = cv2.medianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), 5)
+    circles = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT_ALT, 1.5, minDist=2 * min_radius,
+                               param1=300, param2=0.7, minRadius=min_radius, maxRadius=max_radius)
+    circles = [] if circles is None else circles[0]
+    if stats is not None:
+        stats["candidates"] = len(circles)
+    
+    labels = classify_hsv_pixels(cv2.cvtColor(small, cv2.COLOR_BGR2HSV), venue.class_luts)
+    region_mask = ball_search_mask(context, (offset_x, offset_y, table_image.shape[1], table_image.shape[0]))
+    disc = np.zeros(labels.shape, np.uint8)
+    for cx, cy, radius in circles:
+        # Circles centred off the felt are pockets, rail sights or background
+        if region_mask is not None and not region_mask[min(int(cy / scale), region_mask.shape[0] - 1),
+                                                       min(int(cx / scale), region_mask.shape[1] - 1)]:
+            continue
+        
+        # Vote over the inner part of the circle so the felt around the ball doesn't count
+        disc[:] = 0
+        cv2.circle(disc, (int(cx), int(cy)), max(1, int(radius * 0.7)), 255, -1)
+        votes = np.bincount(labels[disc > 0], minlength=len(venue.ball_color_classes) + 1)
+        class_id = int(np.argmax(votes[1:])) + 1
+        fraction = votes[class_id] / max(1, votes.sum())
+        if fraction < HOUGH_MIN_CLASS_FRACTION:
+            continue
+        
+        found.append((venue.ball_color_classes[class_id - 1][0], int(cx / scale) + offset_x, int(cy / scale) + offset_y,
+                      int(radius / scale), fraction))
+    
+    if debug is not None and debug.enabled:
+        hough_debug_image = small.copy()
+        for cx, cy, radius in circles:
+            cv2.circle(hough_debug_image, (int(cx), int(cy)), int(radius), (255, 0, 255), 1)
+        debug.save("hough_circles.jpg", hough_debug_image)
+    
+    colors, x, y, radius, confidence = zip(*found) if found else ((), (), (), (), ())
+    return sort_balls(make_balls(colors, x, y, radius, confidence), venue.ball_color_classes)
+
+# Ball detection engines, chosen per request ("detector" in a worker job, --detector or POOL_BALL_DETECTOR).
+# Each takes the table crop, its offset in the image, the image scale, debug sink, a stats dict, the
+# venue profile and the image's ImageContext, and returns a ball array in image coordinates.
+BALL_DETECTORS = {
+    "contour": contour_ball_detector,
+    "hough": hough_ball_detector,
+}
+DEFAULT_BALL_DETECTOR = "contour"
+
+def ball_detector_name(detector=None):
+    """Resolve the requested engine, falling back to POOL_BALL_DETECTOR and then the default."""
+    name = detector or os.environ.get("POOL_BALL_DETECTOR") or DEFAULT_BALL_DETECTOR
+    if name not in BALL_DETECTORS:
+        raise ValueError(f"Unknown ball detector '{name}' (expected one of: {', '.join(sorted(BALL_DETECTORS))})")
+    return name
+
+def detect_balls(image, table_bounds, debug=None, image_scale=1, detector=None, stats=None, venue=None,
+                 context=None):
+    """
+    Ball detection algorithm optimized for simple rendered pool table images.
+    image_scale is how many original pixels one pixel of image spans, for reduced-resolution decodes.
+    detector picks the engine from BALL_DETECTORS; stats, if given, receives its name and cost.
+    Colour classes and blob filters come from the venue profile; context is the image's ImageContext.
+    Returns a ball array (BALL_DTYPE) in image coordinates.
+    """
+    if debug is None:
+        debug = DebugSink()
+    if venue is None:
+        venue = get_venue_profile()
+    if context is None:
+        context = ImageContext(image)
     
     try:
-        # Debug directory
-        debug_dir = "debug"
-        if not os.path.exists(debug_dir):
-            os.makedirs(debug_dir)
-            
         # Crop the image to the table area
         x, y, w, h = table_bounds["x"], table_bounds["y"], table_bounds["width"], table_bounds["height"]
         x = max(0, x)
@@ -319,481 +972,716 @@ def detect_balls(image, table_bounds):
         w = min(w, image.shape[1] - x)
         h = min(h, image.shape[0] - y)
         
-        # Crop the image to the table area
-        table_image = image[y:y+h, x:x+w].copy()
-        cv2.imwrite(os.path.join(debug_dir, "cropped_table.jpg"), table_image)
+        # Crop the image to the table area (a view; nothing below writes into it)
+        table_image = context.crop((x, y, w, h))
+        debug.save("cropped_table.jpg", table_image)
         
-        # Convert to HSV for better ball detection
-        hsv_image = cv2.cvtColor(table_image, cv2.COLOR_BGR2HSV)
+        # Run the chosen engine and record what it cost
+        engine_stats = stats if stats is not None else {}
+        engine_stats["engine"] = ball_detector_name(detector)
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        ball_positions = BALL_DETECTORS[engine_stats["engine"]](table_image, x, y, image_scale, debug, engine_stats,
+                                                                venue, context)
+        engine_stats["wall_ms"] = round((time.perf_counter() - start_wall) * 1000, 3)
+        engine_stats["cpu_ms"] = round((time.process_time() - start_cpu) * 1000, 3)
+        engine_stats["detections"] = len(ball_positions)
         
-        # Save HSV image for debugging
-        cv2.imwrite(os.path.join(debug_dir, "hsv_image.jpg"), hsv_image)
-        
-        # Detect white balls - more permissive range
-        lower_white = np.array([0, 0, 170])
-        upper_white = np.array([180, 50, 255])
-        white_mask = cv2.inRange(hsv_image, lower_white, upper_white)
-        
-        # Detect black balls - more permissive range for black pockets too
-        lower_black = np.array([0, 0, 0])
-        upper_black = np.array([180, 255, 60])
-        black_mask = cv2.inRange(hsv_image, lower_black, upper_black)
-        
-        # Detect red balls - much more permissive range for bright reds
-        lower_red1 = np.array([0, 50, 50])
-        upper_red1 = np.array([15, 255, 255])
-        lower_red2 = np.array([160, 50, 50])
-        upper_red2 = np.array([180, 255, 255])
-        red_mask1 = cv2.inRange(hsv_image, lower_red1, upper_red1)
-        red_mask2 = cv2.inRange(hsv_image, lower_red2, upper_red2)
-        red_mask = cv2.bitwise_or(red_mask1, red_mask2)
-        
-        # Detect yellow balls
-        lower_yellow = np.array([20, 70, 50])
-        upper_yellow = np.array([40, 255, 255])
-        yellow_mask = cv2.inRange(hsv_image, lower_yellow, upper_yellow)
-        
-        # Create additional masks to detect the special red colour in the images
-        # This extra range specifically targets the bright red in the reference image
-        lower_bright_red = np.array([0, 150, 100])
-        upper_bright_red = np.array([10, 255, 255])
-        bright_red_mask = cv2.inRange(hsv_image, lower_bright_red, upper_bright_red)
-        red_mask = cv2.bitwise_or(red_mask, bright_red_mask)
-        
-        # Save masks for debugging
-        cv2.imwrite(os.path.join(debug_dir, "white_mask.jpg"), white_mask)
-        cv2.imwrite(os.path.join(debug_dir, "black_mask.jpg"), black_mask)
-        cv2.imwrite(os.path.join(debug_dir, "red_mask.jpg"), red_mask)
-        cv2.imwrite(os.path.join(debug_dir, "yellow_mask.jpg"), yellow_mask)
-        cv2.imwrite(os.path.join(debug_dir, "bright_red_mask.jpg"), bright_red_mask)
-        
-        # Combine all masks for visualization
-        all_masks_visualization = np.zeros_like(white_mask)
-        all_masks_visualization = cv2.bitwise_or(all_masks_visualization, white_mask)
-        all_masks_visualization = cv2.bitwise_or(all_masks_visualization, red_mask)
-        all_masks_visualization = cv2.bitwise_or(all_masks_visualization, yellow_mask)
-        cv2.imwrite(os.path.join(debug_dir, "all_masks.jpg"), all_masks_visualization)
-        
-        # Combine all masks for cleaning
-        all_masks = [white_mask, black_mask, red_mask, yellow_mask]
-        color_names = ["white", "black", "red", "yellow"]
-        
-        # For this simple rendered table, skip black balls detection from the image
-        # since they're likely just the pockets
-        # Only process these colours: white, red, yellow
-        for i, mask in enumerate(all_masks):
-            color = color_names[i]
-            
-            # Skip black colour detection from the image since these are probably pockets
-            if color == "black" and i == 1:
-                continue
-                
-            # Apply morphological operations to clean up the mask
-            kernel = np.ones((3, 3), np.uint8)  
-            clean_mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
-            clean_mask = cv2.morphologyEx(clean_mask, cv2.MORPH_CLOSE, kernel)
-            
-            # Find contours
-            contours, _ = cv2.findContours(clean_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            
-            # Filter by size and circularity
-            for contour in contours:
-                area = cv2.contourArea(contour)
-                
-                # Skip if too small or too large
-                if area < 80 or area > 2000:  
-                    continue
+        # Visualise detected balls for debugging
+        if debug.enabled:
+            balls_debug_image = image.copy()
+            for color, ball_x, ball_y, radius in zip(ball_colors(ball_positions), ball_positions["x"].tolist(),
+                                                     ball_positions["y"].tolist(), ball_positions["radius"].tolist()):
+                # Set colour for visualisation
+                color_bgr = (0, 0, 255) if color == "red" else \
+                           (0, 255, 255) if color == "yellow" else \
+                           (255, 255, 255) if color == "white" else \
+                           (0, 0, 0)
                 
-                # Check circularity
-                perimeter = cv2.arcLength(contour, True)
-                circularity = 4 * np.pi * area / (perimeter * perimeter) if perimeter > 0 else 0
+                # Draw circle at ball position
+                cv2.circle(balls_debug_image, (ball_x, ball_y), int(radius), color_bgr, 2)
+                # Mark center
+                cv2.circle(balls_debug_image, (ball_x, ball_y), 2, (0, 0, 255), -1)
                 
-                if circularity > 0.6:  # More permissive circularity threshold
-                    # Get the center and radius
-                    (cx, cy), radius = cv2.minEnclosingCircle(contour)
-                    
-                    # Add to ball positions
-                    ball_positions.append({
-                        "color": color,
-                        "x": int(cx) + x,  
-                        "y": int(cy) + y,
-                        "radius": int(radius),
-                        "confidence": circularity
-                    })
-        
-        # Visualise detected balls for debugging
-        balls_debug_image = image.copy()
-        for ball in ball_positions:
-            # Set colour for visualisation
-            color_bgr = (0, 0, 255) if ball["color"] == "red" else \
-                       (0, 255, 255) if ball["color"] == "yellow" else \
-                       (255, 255, 255) if ball["color"] == "white" else \
-                       (0, 0, 0)
-            
-            # Draw circle at ball position
-            cv2.circle(balls_debug_image, (ball["x"], ball["y"]), int(ball.get("radius", 15)), color_bgr, 2)
-            # Mark center
-            cv2.circle(balls_debug_image, (ball["x"], ball["y"]), 2, (0, 0, 255), -1)
+                # Add label with colour
+                cv2.putText(balls_debug_image, color, (ball_x-30, ball_y-20), 
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
             
-            # Add label with colour
-            cv2.putText(balls_debug_image, ball["color"], (ball["x"]-30, ball["y"]-20), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
-        
-        cv2.imwrite(os.path.join(debug_dir, "detected_balls.jpg"), balls_debug_image)
+            debug.save("detected_balls.jpg", balls_debug_image)
         
         # Count detected balls by colour
-        detected_counts = defaultdict(int)
-        for ball in ball_positions:
-            detected_counts[ball["color"]] += 1
+        detected_counts = dict(zip(BALL_COLORS, np.bincount(ball_positions["color"], minlength=len(BALL_COLORS)).tolist()))
         
         # Print counts for debugging
         print(f"Detected counts: white={detected_counts['white']}, red={detected_counts['red']}, yellow={detected_counts['yellow']}", file=sys.stderr)
         
+        placeholders = []
         if detected_counts["white"] == 0:
             # Add a synthetic white ball in top right corner
-            ball_positions.append({
-                "color": "white",
-                "x": int(x + w * 0.8),
-                "y": int(y + h * 0.2),
-                "radius": 15,
-                "synthetic": True
-            })
+            placeholders.append(make_balls("white", [int(x + w * 0.8)], [int(y + h * 0.2)], 15, synthetic=True))
         
         if detected_counts["red"] == 0:    
-            positions = [
+            positions = np.array([
                 (0.3, 0.5),  
                 (0.35, 0.35),  
                 (0.35, 0.65),  
                 (0.7, 0.7)   
-            ]
+            ])
             
-            for i, (rel_x, rel_y) in enumerate(positions):
-                ball_positions.append({
-                    "color": "red",
-                    "x": int(x + w * rel_x),
-                    "y": int(y + h * rel_y),
-                    "radius": 15,
-                    "synthetic": True
-                })
+            placeholders.append(make_balls("red", (x + w * positions[:, 0]).astype(int),
+                                           (y + h * positions[:, 1]).astype(int), 15, synthetic=True))
         
-        return ball_positions
+        return concatenate_balls([ball_positions, *placeholders])
     
     except Exception as e:
         print(f"Error in ball detection: {e}", file=sys.stderr)
-        return []
+        return np.empty(0, dtype=BALL_DTYPE)
 
-def map_ball_positions(original_balls, table_bounds, game_width, game_height):
+# Incremental re-detection
+# After a shot most balls are exactly where they were. detect_balls_incremental diffs the new image
+# against the previous one at low resolution and only re-segments the regions that changed.
+CHANGE_DIFF_THRESHOLD = 25   # Grey-level difference that counts as a change
+CHANGE_DOWNSCALE = 4         # The difference map is computed at 1/CHANGE_DOWNSCALE resolution
+CHANGE_FULL_FRACTION = 0.5   # Above this fraction of the table changed, just run detect_balls
+INCREMENTAL_EDGE_MARGIN = 2  # Pixels of slack between a re-detected ball and the edge of its changed region
+
+def changed_regions(image, previous_image, table_bounds, pad):
     """
-    Map detected ball positions from the original image to the game table coordinates.
-    Uses improved mapping with perspective correction.
+    Find where image differs from previous_image inside the table.
     
-    Args:
-        original_balls: List of detected ball positions in original image
-        table_bounds: Dictionary with x, y, width, height of detected table
-        game_width, game_height: Dimensions of the target game table
-        
     Returns:
-        List of mapped ball positions in game coordinates
+        (list of (x0, y0, x1, y1) rectangles in image coordinates padded by pad pixels,
+         fraction of the table that changed), or (None, 1.0) if the images can't be compared
+    """
+    if previous_image is None or previous_image.shape != image.shape:
+        return None, 1.0
+    
+    x, y, w, h = table_bounds["x"], table_bounds["y"], table_bounds["width"], table_bounds["height"]
+    x, y = max(0, x), max(0, y)
+    w, h = min(w, image.shape[1] - x), min(h, image.shape[0] - y)
+    small_size = (max(1, w // CHANGE_DOWNSCALE), max(1, h // CHANGE_DOWNSCALE))
+    
+    # Compare grey thumbnails of the table only
+    current = cv2.resize(cv2.cvtColor(image[y:y+h, x:x+w], cv2.COLOR_BGR2GRAY), small_size, interpolation=cv2.INTER_AREA)
+    previous = cv2.resize(cv2.cvtColor(previous_image[y:y+h, x:x+w], cv2.COLOR_BGR2GRAY), small_size,
+                          interpolation=cv2.INTER_AREA)
+    _, change_mask = cv2.threshold(cv2.absdiff(current, previous), CHANGE_DIFF_THRESHOLD, 255, cv2.THRESH_BINARY)
+    change_mask = cv2.dilate(change_mask, np.ones((3, 3), np.uint8))
+    
+    fraction = cv2.countNonZero(change_mask) / change_mask.size
+    count, _, stats, _ = cv2.connectedComponentsWithStats(change_mask)
+    
+    regions = []
+    for left, top, width, height, _ in stats[1:count]:
+        regions.append((
+            int(max(0, x + left * CHANGE_DOWNSCALE - pad)),
+            int(max(0, y + top * CHANGE_DOWNSCALE - pad)),
+            int(min(x + w, x + (left + width) * CHANGE_DOWNSCALE + pad)),
+            int(min(y + h, y + (top + height) * CHANGE_DOWNSCALE + pad))
+        ))
+    return regions, fraction
+
+def detect_balls_incremental(image, previous_image, previous_balls, table_bounds, debug=None, stats=None, venue=None,
+                             context=None):
+    """
+    Update the previous frame's ball detections for a new image of the same table.
+    
+    Balls not wholly inside a changed region keep their previous position and confidence; colour
+    segmentation and contour analysis only run inside the changed regions. Falls back to
+    detect_balls when the images can't be compared or most of the table changed.
+    
+    Args:
+        image: New image
+        previous_image: Image the previous detections came from
+        previous_balls: Ball array detected in previous_image (image coordinates)
+        table_bounds: Dictionary with x, y, width, height of the table in both images
+        stats: Optional dict that receives changed_regions, changed_fraction, reused and redetected
     """
-    mapped_balls = []
+    if debug is None:
+        debug = DebugSink()
+    if venue is None:
+        venue = get_venue_profile()
+    if context is None:
+        context = ImageContext(image)
     
     try:
-        # Extract table bounds
+        # Pad changes by a ball diameter so a ball that moved is re-found whole
+        radii = previous_balls["radius"][~previous_balls["synthetic"]]
+        pad = int(2 * (radii.max() if len(radii) else venue.ball_radius))
+        regions, fraction = changed_regions(image, previous_image, table_bounds, pad)
+        
+        if regions is None or fraction > CHANGE_FULL_FRACTION:
+            if stats is not None:
+                stats.update(changed_regions=None, changed_fraction=round(fraction, 4), reused=0)
+            return detect_balls(image, table_bounds, debug, venue=venue, context=context)
+        
+        # Region edges inside the table can cut a ball in half; edges on the table outline can't
+        boxes = np.array(regions, dtype=np.int64).reshape(-1, 4)
+        table_x0, table_y0 = max(0, table_bounds["x"]), max(0, table_bounds["y"])
+        table_x1 = min(image.shape[1], table_bounds["x"] + table_bounds["width"])
+        table_y1 = min(image.shape[0], table_bounds["y"] + table_bounds["height"])
+        inner = np.column_stack([boxes[:, 0] > table_x0, boxes[:, 1] > table_y0,
+                                 boxes[:, 2] < table_x1, boxes[:, 3] < table_y1])
+        
+        # Every ball against every region at once: a ball is re-detected only when the region
+        # holds all of it, otherwise it keeps its previous position (it didn't change, or the
+        # padding would have covered it)
+        reach = previous_balls["radius"][:, np.newaxis] + INCREMENTAL_EDGE_MARGIN
+        ball_x, ball_y = previous_balls["x"][:, np.newaxis], previous_balls["y"][:, np.newaxis]
+        in_changed_region = (((boxes[:, 0] <= ball_x - reach) | ~inner[:, 0] & (boxes[:, 0] <= ball_x)) &
+                             ((boxes[:, 1] <= ball_y - reach) | ~inner[:, 1] & (boxes[:, 1] <= ball_y)) &
+                             ((ball_x + reach < boxes[:, 2]) | ~inner[:, 2] & (ball_x < boxes[:, 2])) &
+                             ((ball_y + reach < boxes[:, 3]) | ~inner[:, 3] & (ball_y < boxes[:, 3]))).any(axis=1)
+        kept = previous_balls[previous_balls["synthetic"] | ~in_changed_region]
+        
+        # Segment only the changed regions, exactly as detect_balls does for the whole table
+        found = np.empty(0, dtype=BALL_DTYPE)
+        for (x0, y0, x1, y1), (cut_left, cut_top, cut_right, cut_bottom) in zip(regions, inner.tolist()):
+            def keep_contour(contour):
+                # A blob touching an inner edge is part of a ball that was kept (same rule as the tiles)
+                contour_x, contour_y, contour_w, contour_h = cv2.boundingRect(contour)
+                return not ((cut_left and contour_x == 0) or (cut_top and contour_y == 0) or
+                            (cut_right and contour_x + contour_w == x1 - x0) or
+                            (cut_bottom and contour_y + contour_h == y1 - y0))
+            
+            region_mask = ball_search_mask(context, (x0, y0, x1 - x0, y1 - y0))
+            candidates = find_balls_in_labels(segment_labels(image[y0:y1, x0:x1], venue, region_mask), x0, y0,
+                                              keep_contour=keep_contour, venue=venue)
+            for index, ball in enumerate(candidates):
+                # Padded regions can overlap, and a kept ball may still show up; keep one detection per ball
+                duplicate = any(((others["color"] == ball["color"]) &
+                                 (np.abs(others["x"] - ball["x"]) <= ball["radius"]) &
+                                 (np.abs(others["y"] - ball["y"]) <= ball["radius"]) &
+                                 ~others["synthetic"]).any()
+                                for others in (found, kept))
+                if not duplicate:
+                    found = np.concatenate([found, candidates[index:index + 1]])
+        
+        # A real ball of a colour replaces the placeholders added when that colour was missing
+        kept = kept[~(kept["synthetic"] & np.isin(kept["color"], found["color"]))]
+        
+        if debug.enabled:
+            regions_debug_image = image.copy()
+            for x0, y0, x1, y1 in regions:
+                cv2.rectangle(regions_debug_image, (x0, y0), (x1, y1), (0, 0, 255), 2)
+            for ball_x, ball_y, radius in zip(found["x"].tolist(), found["y"].tolist(), found["radius"].tolist()):
+                cv2.circle(regions_debug_image, (ball_x, ball_y), int(radius), (0, 255, 0), 2)
+            debug.save("changed_regions.jpg", regions_debug_image)
+        
+        if stats is not None:
+            stats.update(changed_regions=len(regions), changed_fraction=round(fraction, 4),
+                         reused=len(kept), redetected=len(found))
+        
+        return concatenate_balls([kept, found])
+    
+    except Exception as e:
+        print(f"Error in incremental ball detection: {e}", file=sys.stderr)
+        return detect_balls(image, table_bounds, debug, venue=venue, context=context)
+
+def find_close_pairs(positions, max_distance):
+    """
+    Find every pair of points closer than max_distance using a uniform grid.
+
+    Points are bucketed into square cells of size max_distance, so close pairs can only sit in the
+    same or adjacent cells. Each point is matched against its own cell and four neighbouring cells
+    (the other four are covered from the opposite side), all with vectorised sorted-key lookups.
+
+    Returns:
+        Two index arrays (i, j) with i != j for every close pair
+    """
+    count = len(positions)
+    if count < 2:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    
+    cells = np.floor(positions / max_distance).astype(np.int64)
+    cells -= cells.min(axis=0) - 1  # keep neighbour offsets non-negative
+    stride = cells[:, 1].max() + 2
+    keys = cells[:, 0] * stride + cells[:, 1]
+    
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    
+    pairs_i, pairs_j = [], []
+    for offset_x, offset_y in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+        targets = keys + offset_x * stride + offset_y
+        starts = np.searchsorted(sorted_keys, targets, side="left")
+        ends = np.searchsorted(sorted_keys, targets, side="right")
+        counts = ends - starts
+        if not counts.any():
+            continue
+        
+        # Expand each point's [start, end) slice of matching cell members into explicit pairs
+        i = np.repeat(np.arange(count), counts)
+        j = order[np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+        if offset_x == 0 and offset_y == 0:
+            keep = i < j
+            i, j = i[keep], j[keep]
+        pairs_i.append(i)
+        pairs_j.append(j)
+    
+    if not pairs_i:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    
+    i, j = np.concatenate(pairs_i), np.concatenate(pairs_j)
+    distances = np.hypot(*(positions[i] - positions[j]).T)
+    close = distances < max_distance
+    return i[close], j[close]
+
+def resolve_ball_overlaps(positions, synthetic, min_distance, game_width, game_height,
+                          tolerance=0.5, max_iterations=100, ball_radius=BALL_RADIUS):
+    """
+    Push overlapping balls apart until no pair is closer than min_distance (within tolerance).
+
+    Every overlapping pair is moved apart along its connecting line in the same step, with
+    synthetic balls taking most of the movement when paired with a detected ball. Positions
+    stay as floats while solving so balls don't oscillate from rounding on every move.
+
+    Returns:
+        (positions rounded to whole pixels, iterations used, largest remaining overlap in pixels)
+    """
+    positions = np.asarray(positions, dtype=np.float64).copy()
+    synthetic = np.asarray(synthetic, dtype=bool)
+    
+    # Ensure positions are within the game table bounds
+    low = ball_radius + 5
+    high = np.array([game_width - ball_radius - 5, game_height - ball_radius - 5], dtype=np.float64)
+    
+    def residual(points):
+        i, j = find_close_pairs(points, min_distance)
+        if len(i) == 0:
+            return 0.0
+        return float(np.max(min_distance - np.hypot(*(points[i] - points[j]).T)))
+    
+    iterations = 0
+    while iterations < max_iterations:
+        i, j = find_close_pairs(positions, min_distance)
+        if len(i) == 0:
+            break
+        
+        delta = positions[i] - positions[j]
+        distance = np.hypot(delta[:, 0], delta[:, 1])
+        overlap = min_distance - distance
+        if overlap.max() < tolerance:
+            break
+        
+        # Direction from j to i; coincident balls are split horizontally
+        direction = np.zeros_like(delta)
+        apart = distance > 0
+        direction[apart] = delta[apart] / distance[apart, np.newaxis]
+        direction[~apart] = (1.0, 0.0)
+        move = direction * (overlap / 2)[:, np.newaxis]
+        
+        # Move synthetic balls more than detected ones
+        weight_i = np.where(synthetic[i] & ~synthetic[j], 1.5, np.where(synthetic[j] & ~synthetic[i], 0.5, 1.0))
+        weight_j = 2.0 - weight_i
+        
+        # Average the pushes on balls with several contacts so dense clusters don't overshoot
+        displacement = np.zeros_like(positions)
+        np.add.at(displacement, i, move * weight_i[:, np.newaxis])
+        np.add.at(displacement, j, -move * weight_j[:, np.newaxis])
+        contacts = np.bincount(np.concatenate([i, j]), minlength=len(positions))
+        positions = np.clip(positions + displacement / np.maximum(contacts, 1)[:, np.newaxis], low, high)
+        
+        iterations += 1
+    
+    positions = np.round(positions)
+    return positions, iterations, round(residual(positions), 2)
+
+class TableHomography:
+    """
+    Perspective mapping between image pixels and game table coordinates, in both directions.
+
+    Built once per request and shared by ball mapping, the debug overlay and the response,
+    so nothing downstream has to recompute scale factors by hand.
+    """
+
+    def __init__(self, image_to_game, image_corners=None, game_corners=None):
+        self.image_to_game = np.asarray(image_to_game, dtype=np.float64)
+        self.game_to_image = np.linalg.inv(self.image_to_game)
+        self.image_corners = image_corners
+        self.game_corners = game_corners
+
+    @classmethod
+    def from_corners(cls, image_corners, game_corners):
+        """Build the mapping from four table corners (TL, TR, BR, BL) in each coordinate system."""
+        image_corners = np.asarray(image_corners, dtype=np.float32)
+        game_corners = np.asarray(game_corners, dtype=np.float32)
+        return cls(cv2.getPerspectiveTransform(image_corners, game_corners), image_corners, game_corners)
+
+    @classmethod
+    def from_table_bounds(cls, table_bounds, game_width, game_height, margin=20):
+        """Map the detected table rectangle onto the game table, inset by margin pixels."""
         x, y, w, h = table_bounds["x"], table_bounds["y"], table_bounds["width"], table_bounds["height"]
         
         # Get table corners in source image
-        src_corners = np.array([
+        image_corners = [
             [x, y],           # Top-left
             [x + w, y],       # Top-right
             [x + w, y + h],   # Bottom-right
             [x, y + h]        # Bottom-left
-        ], dtype=np.float32)
+        ]
         
-        margin = 20
-        dst_corners = np.array([
+        game_corners = [
             [margin, margin],                       # Top-left
             [game_width - margin, margin],          # Top-right
             [game_width - margin, game_height - margin],  # Bottom-right
             [margin, game_height - margin]          # Bottom-left
-        ], dtype=np.float32)
+        ]
+        
+        return cls.from_corners(image_corners, game_corners)
+
+    @staticmethod
+    def _transform(matrix, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+        if len(points) == 0:
+            return np.empty((0, 2), dtype=np.float64)
+        return cv2.perspectiveTransform(points, matrix).reshape(-1, 2)
+
+    def to_game(self, points):
+        """Map an (N, 2) array of image points onto the game table in one call."""
+        return self._transform(self.image_to_game, points)
+
+    def to_image(self, points):
+        """Map an (N, 2) array of game table points back into the original image."""
+        return self._transform(self.game_to_image, points)
+
+    def to_dict(self):
+        return {
+            "image_to_game": self.image_to_game.tolist(),
+            "game_to_image": self.game_to_image.tolist()
+        }
+
+def number_balls(balls):
+    """
+    Give red and yellow balls a number: their own if detection set one, otherwise their
+    running position among the balls of that colour. Other colours get -1 (no number).
+    """
+    assigned = np.full(len(balls), -1, dtype=np.int16)
+    
+    for color in ("red", "yellow"):
+        is_color = balls["color"] == ball_color_id(color)
+        running = np.cumsum(is_color)
+        numbers = balls["number"][is_color]
+        assigned[is_color] = np.where(numbers < 0, running[is_color], numbers)
+    
+    return assigned
+
+def map_ball_positions(original_balls, table_bounds, game_width, game_height, stats=None, homography=None,
+                       venue=None):
+    """
+    Map detected ball positions from the original image to the game table coordinates.
+    Uses improved mapping with perspective correction.
+    
+    Args:
+        original_balls: Ball array detected in the original image
+        table_bounds: Dictionary with x, y, width, height of detected table
+        game_width, game_height: Dimensions of the target game table
+        stats: Optional dict that receives overlap_iterations and residual_overlap
+        homography: Optional TableHomography to reuse; built from table_bounds when omitted
+        venue: Venue profile giving the ball radius and overlap spacing
+        
+    Returns:
+        Copy of the ball array with game_x, game_y and numbers filled in
+    """
+    if venue is None:
+        venue = get_venue_profile()
+    
+    try:
+        if homography is None:
+            homography = TableHomography.from_table_bounds(table_bounds, game_width, game_height)
         
-        # Calculate perspective transform matrix
-        transform_matrix = cv2.getPerspectiveTransform(src_corners, dst_corners)
+        # Transform every ball centre in a single call
+        mapped_positions = homography.to_game(np.column_stack((original_balls["x"], original_balls["y"])))
         
-        # Colour assignments for tracking
-        red_count = 1
-        yellow_count = 1
+        # Ensure positions are within the game table bounds
+        low = venue.ball_radius + 5
+        high = np.array([game_width - venue.ball_radius - 5, game_height - venue.ball_radius - 5])
+        mapped_positions = np.trunc(np.clip(mapped_positions, low, high))
         
-        # Process each ball
-        for ball in original_balls:
-            try:
-                # Get original ball position
-                original_x, original_y = ball["x"], ball["y"]
-                
-                # Apply perspective transform
-                ball_pos = np.array([[original_x, original_y]], dtype=np.float32)
-                transformed = cv2.perspectiveTransform(ball_pos.reshape(-1, 1, 2), transform_matrix)
-                
-                # Extract transformed coordinates
-                mapped_x, mapped_y = transformed[0][0]
-                
-                # Ensure positions are within the game table bounds
-                mapped_x = max(BALL_RADIUS + 5, min(game_width - BALL_RADIUS - 5, mapped_x))
-                mapped_y = max(BALL_RADIUS + 5, min(game_height - BALL_RADIUS - 5, mapped_y))
-                
-                # Assign ball numbers for red and yellow
-                ball_number = None
-                if ball["color"] == "red":
-                    ball_number = ball.get("number", red_count)
-                    red_count += 1
-                elif ball["color"] == "yellow":
-                    ball_number = ball.get("number", yellow_count)
-                    yellow_count += 1
-                
-                # Add to mapped balls
-                mapped_balls.append({
-                    "color": ball["color"], 
-                    "x": int(mapped_x), 
-                    "y": int(mapped_y),
-                    "number": ball_number,
-                    "originalX": int(original_x),
-                    "originalY": int(original_y),
-                    "synthetic": ball.get("synthetic", False)
-                })
-                
-            except Exception as e:
-                print(f"Error mapping ball: {e}", file=sys.stderr)
-                continue
+        # Assign ball numbers for red and yellow
+        mapped_balls = original_balls.copy()
+        mapped_balls["number"] = number_balls(original_balls)
         
         # Ensure balls don't overlap
-        iterations = 0
-        while iterations < 10:  
-            moved = False
-            for i in range(len(mapped_balls)):
-                for j in range(i+1, len(mapped_balls)):
-                    ball1 = mapped_balls[i]
-                    ball2 = mapped_balls[j]
-                    
-                    # Calculate distance between balls
-                    dx = ball1["x"] - ball2["x"]
-                    dy = ball1["y"] - ball2["y"]
-                    distance = (dx**2 + dy**2)**0.5
-                    
-                    # If balls are overlapping
-                    if distance < BALL_RADIUS * 2.1:  # Add a small margin
-                        # Move balls apart along their connecting line
-                        overlap = (BALL_RADIUS * 2.1) - distance
-                        move_x = dx/distance * overlap/2 if distance > 0 else 1
-                        move_y = dy/distance * overlap/2 if distance > 0 else 0
-                        
-                        # Apply movement, with more movement to synthetic balls
-                        if ball1.get("synthetic", False) and not ball2.get("synthetic", False):
-                            # Move ball1 (synthetic) more
-                            ball1["x"] = int(ball1["x"] + move_x * 1.5)
-                            ball1["y"] = int(ball1["y"] + move_y * 1.5)
-                            ball2["x"] = int(ball2["x"] - move_x * 0.5)
-                            ball2["y"] = int(ball2["y"] - move_y * 0.5)
-                        elif ball2.get("synthetic", False) and not ball1.get("synthetic", False):
-                            # Move ball2 (synthetic) more
-                            ball1["x"] = int(ball1["x"] + move_x * 0.5)
-                            ball1["y"] = int(ball1["y"] + move_y * 0.5)
-                            ball2["x"] = int(ball2["x"] - move_x * 1.5)
-                            ball2["y"] = int(ball2["y"] - move_y * 1.5)
-                        else:
-                            # Move both equally
-                            ball1["x"] = int(ball1["x"] + move_x)
-                            ball1["y"] = int(ball1["y"] + move_y)
-                            ball2["x"] = int(ball2["x"] - move_x)
-                            ball2["y"] = int(ball2["y"] - move_y)
-                        
-                        # Ensure positions are within bounds
-                        ball1["x"] = max(BALL_RADIUS + 5, min(game_width - BALL_RADIUS - 5, ball1["x"]))
-                        ball1["y"] = max(BALL_RADIUS + 5, min(game_height - BALL_RADIUS - 5, ball1["y"]))
-                        ball2["x"] = max(BALL_RADIUS + 5, min(game_width - BALL_RADIUS - 5, ball2["x"]))
-                        ball2["y"] = max(BALL_RADIUS + 5, min(game_height - BALL_RADIUS - 5, ball2["y"]))
-                        
-                        moved = True
-            
-            if not moved:
-                break
-                
-            iterations += 1
+        if len(mapped_balls):
+            positions, iterations, residual_overlap = resolve_ball_overlaps(
+                mapped_positions, mapped_balls["synthetic"], venue.ball_radius * venue.overlap_distance_factor,
+                game_width, game_height, ball_radius=venue.ball_radius)
+        else:
+            positions, iterations, residual_overlap = mapped_positions, 0, 0.0
         
-        return mapped_balls
+        mapped_balls["game_x"] = positions[:, 0].astype(np.int32)
+        mapped_balls["game_y"] = positions[:, 1].astype(np.int32)
+        
+        if stats is not None:
+            stats["overlap_iterations"] = iterations
+            stats["residual_overlap"] = residual_overlap
+        
+        return mapped_balls
         
     except Exception as e:
         print(f"Error mapping ball positions: {e}", file=sys.stderr)
-        return []
+        return np.empty(0, dtype=BALL_DTYPE)
+
+def draw_ball(table_image, x, y, color, ball_radius=BALL_RADIUS, ball_number=None):
+    """Draw a pool ball with realistic 3D effects straight onto an image (used to build ball sprites)."""
+    # Define ball colours with BGR format
+    color_map = {
+        "red": (30, 30, 200),      # Deeper red
+        "yellow": (30, 190, 230),  # Slightly darker yellow
+        "white": (235, 235, 235),  # Slightly off-white for realism
+        "black": (20, 20, 20),     # Not pure black for realism
+    }
+    
+    # Get the ball colour from the map
+    ball_color = color_map.get(color, (200, 200, 200))
+    
+    # Ensure coordinates are integers
+    x, y = int(x), int(y)
+    
+    # Create gradient effect for 3D appearance
+    for r in range(int(ball_radius), 0, -1):
+        # Calculate how far we are from the edge (0 to 1)
+        edge_factor = r / ball_radius
+        
+        # Adjust colour based on distance from edge 
+        adjusted_color = tuple(int(c * edge_factor) for c in ball_color)
+        
+        # Draw the circle
+        cv2.circle(table_image, (x, y), r, adjusted_color, -1)
+    
+    # Add highlight (makes ball look somewhat 3D)
+    highlight_offset = ball_radius // 3
+    highlight_radius = ball_radius // 2
+    highlight_pos = (x - highlight_offset, y - highlight_offset)
+    
+    # Create highlight with smooth gradient
+    for r in range(int(highlight_radius), 0, -1):
+        # Calculate intensity based on radius
+        intensity = 255 * (1 - r/highlight_radius) * 0.7
+        
+        # Draw highlight with decreasing intensity
+        cv2.circle(table_image, highlight_pos, r, (intensity, intensity, intensity), 1)
+    
+    # Add a second smaller highlight
+    small_highlight_offset = ball_radius // 5
+    small_highlight_radius = ball_radius // 4
+    small_highlight_pos = (x - small_highlight_offset * 2, y - small_highlight_offset * 2)
+    
+    # Draw small highlight
+    cv2.circle(table_image, small_highlight_pos, small_highlight_radius, (200, 200, 200), -1)
+    cv2.circle(table_image, small_highlight_pos, small_highlight_radius // 2, (255, 255, 255), -1)
+    
+    # Add shadow
+    shadow_offset = ball_radius // 4
+    shadow_pos = (x + shadow_offset, y + shadow_offset)
+    
+    # Create shadow with transparency
+    shadow_img = table_image.copy()
+    cv2.circle(shadow_img, shadow_pos, ball_radius, (0, 0, 0), -1)
+    cv2.addWeighted(shadow_img, 0.3, table_image, 0.7, 0, table_image)
+    
+    # Add ball number for red and yellow balls
+    if (color == "red" or color == "yellow") and ball_number is not None:
+        # Draw white circle for number
+        number_radius = ball_radius // 2
+        number_bg_color = (255, 255, 255) if color == "red" else (240, 240, 240)
+        number_fg_color = (0, 0, 0) if color == "yellow" else (200, 0, 0)
+        
+        # Draw white circle for number
+        cv2.circle(table_image, (x, y), number_radius, number_bg_color, -1)
+        
+        # Draw number 
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        text = str(ball_number)
+        
+        # Calculate text size and position to center it
+        text_size, _ = cv2.getTextSize(text, font, 0.5, 1)
+        text_x = x - text_size[0] // 2
+        text_y = y + text_size[1] // 2
+        
+        # Draw text with a slight shadow for better visibility
+        cv2.putText(table_image, text, (text_x+1, text_y+1), font, 0.5, (100, 100), 1, cv2.LINE_AA)
+        cv2.putText(table_image, text, (text_x, text_y), font, 0.5, number_fg_color, 1, cv2.LINE_AA)
+
+# Pre-rendered ball sprites keyed by (colour, radius, number)
+_ball_sprite_cache = {}
+
+def get_ball_sprite(color, ball_radius=BALL_RADIUS, ball_number=None):
+    """
+    Return the cached sprite for a ball as (premultiplied BGR, transmittance, half size).
+
+    The sprite is an RGBA patch stored in premultiplied form: the ball is drawn once over a black
+    patch and once over a white one, and the difference says how much table shows through each
+    pixel. That covers the solid ball, its semi-transparent shadow and the anti-aliased number.
+    """
+    key = (color, int(ball_radius), ball_number)
+    sprite = _ball_sprite_cache.get(key)
+    if sprite is None:
+        # Leave room around the ball for the shadow offset and the number label
+        half = 2 * int(ball_radius)
+        size = 2 * half + 1
+        
+        over_black = np.zeros((size, size, 3), dtype=np.uint8)
+        over_white = np.full((size, size, 3), 255, dtype=np.uint8)
+        draw_ball(over_black, half, half, color, ball_radius, ball_number)
+        draw_ball(over_white, half, half, color, ball_radius, ball_number)
+        
+        premultiplied = over_black.astype(np.float32)
+        transmittance = (over_white.astype(np.float32) - premultiplied) / 255.0
+        sprite = (premultiplied, transmittance, half)
+        _ball_sprite_cache[key] = sprite
+    
+    return sprite
 
 def render_ball(table_image, x, y, color, ball_radius=BALL_RADIUS, ball_number=None):
     """Render a pool ball with realistic 3D effects on the table image."""
     try:
-        # Define ball colours with BGR format
-        color_map = {
-            "red": (30, 30, 200),      # Deeper red
-            "yellow": (30, 190, 230),  # Slightly darker yellow
-            "white": (235, 235, 235),  # Slightly off-white for realism
-            "black": (20, 20, 20),     # Not pure black for realism
-        }
-        
-        # Get the ball colour from the map
-        ball_color = color_map.get(color, (200, 200, 200))
+        premultiplied, transmittance, half = get_ball_sprite(color, ball_radius, ball_number)
         
         # Ensure coordinates are integers
         x, y = int(x), int(y)
         
-        # Create gradient effect for 3D appearance
-        for r in range(int(ball_radius), 0, -1):
-            # Calculate how far we are from the edge (0 to 1)
-            edge_factor = r / ball_radius
-            
-            # Adjust colour based on distance from edge 
-            adjusted_color = tuple(int(c * edge_factor) for c in ball_color)
-            
-            # Draw the circle
-            cv2.circle(table_image, (x, y), r, adjusted_color, -1)
-        
-        # Add highlight (makes ball look somewhat 3D)
-        highlight_offset = ball_radius // 3
-        highlight_radius = ball_radius // 2
-        highlight_pos = (x - highlight_offset, y - highlight_offset)
-        
-        # Create highlight with smooth gradient
-        for r in range(int(highlight_radius), 0, -1):
-            # Calculate intensity based on radius
-            intensity = 255 * (1 - r/highlight_radius) * 0.7
-            
-            # Draw highlight with decreasing intensity
-            cv2.circle(table_image, highlight_pos, r, (intensity, intensity, intensity), 1)
-        
-        # Add a second smaller highlight
-        small_highlight_offset = ball_radius // 5
-        small_highlight_radius = ball_radius // 4
-        small_highlight_pos = (x - small_highlight_offset * 2, y - small_highlight_offset * 2)
-        
-        # Draw small highlight
-        cv2.circle(table_image, small_highlight_pos, small_highlight_radius, (200, 200, 200), -1)
-        cv2.circle(table_image, small_highlight_pos, small_highlight_radius // 2, (255, 255, 255), -1)
-        
-        # Add shadow
-        shadow_offset = ball_radius // 4
-        shadow_pos = (x + shadow_offset, y + shadow_offset)
-        
-        # Create shadow with transparency
-        shadow_img = table_image.copy()
-        cv2.circle(shadow_img, shadow_pos, ball_radius, (0, 0, 0), -1)
-        cv2.addWeighted(shadow_img, 0.3, table_image, 0.7, 0, table_image)
-        
-        # Add ball number for red and yellow balls
-        if (color == "red" or color == "yellow") and ball_number is not None:
-            # Draw white circle for number
-            number_radius = ball_radius // 2
-            number_bg_color = (255, 255, 255) if color == "red" else (240, 240, 240)
-            number_fg_color = (0, 0, 0) if color == "yellow" else (200, 0, 0)
-            
-            # Draw white circle for number
-            cv2.circle(table_image, (x, y), number_radius, number_bg_color, -1)
-            
-            # Draw number 
-            font = cv2.FONT_HERSHEY_SIMPLEX
-            text = str(ball_number)
-            
-            # Calculate text size and position to center it
-            text_size, _ = cv2.getTextSize(text, font, 0.5, 1)
-            text_x = x - text_size[0] // 2
-            text_y = y + text_size[1] // 2
-            
-            # Draw text with a slight shadow for better visibility
-            cv2.putText(table_image, text, (text_x+1, text_y+1), font, 0.5, (100, 100), 1, cv2.LINE_AA)
-            cv2.putText(table_image, text, (text_x, text_y), font, 0.5, number_fg_color, 1, cv2.LINE_AA)
+        # Clip the sprite's bounding box to the table image
+        height, width = table_image.shape[:2]
+        x0, y0 = max(x - half, 0), max(y - half, 0)
+        x1, y1 = min(x + half + 1, width), min(y + half + 1, height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        sx0, sy0 = x0 - (x - half), y0 - (y - half)
+        sx1, sy1 = sx0 + (x1 - x0), sy0 + (y1 - y0)
+        
+        # Alpha-composite only the ball's bounding box
+        roi = table_image[y0:y1, x0:x1]
+        blended = premultiplied[sy0:sy1, sx0:sx1] + roi * transmittance[sy0:sy1, sx0:sx1]
+        roi[:] = np.clip(blended + 0.5, 0, 255).astype(np.uint8)
         
     except Exception as e:
         print(f"Error rendering ball: {e}", file=sys.stderr)
 
-def create_fancy_table(width, height):
-    """Create a realistic pool table image."""
-    try:
-        # Create basic table with green felt
-        table = np.zeros((height, width, 3), dtype=np.uint8)
-        
-        # Green felt - slightly darker and more saturated
-        felt_color = (26, 110, 40)  # BGR
-        table[:, :] = felt_color
-        
-        # Add subtle texture to the felt
-        noise = np.random.randint(-10, 10, (height, width), dtype=np.int8)
-        for c in range(3):
-            table[:, :, c] = np.clip(table[:, :, c] + noise, 0, 255)
-        
-        # Wooden rail (brown border)
-        rail_thickness = int(min(width, height) * 0.075)  # 7.5% of the smaller dimension
-        border_color = (40, 75, 120)  # Dark wood colour (BGR)
-        
-        # Draw the rails (borders)
-        table[0:rail_thickness, :] = border_color  # Top rail
-        table[height-rail_thickness:height, :] = border_color  # Bottom rail
-        table[:, 0:rail_thickness] = border_color  # Left rail
-        table[:, width-rail_thickness:width] = border_color  # Right rail
-        
-        # Cushion highlights (subtle lighting effect)
-        cushion_highlight = (60, 95, 140)  # Lighter wood tone
-        highlight_thickness = 3
-        
-        # Top rail highlight
-        table[rail_thickness-highlight_thickness:rail_thickness, :] = cushion_highlight
-        # Bottom rail highlight
-        table[height-rail_thickness:height-rail_thickness+highlight_thickness, :] = cushion_highlight
-        # Left rail highlight
-        table[:, rail_thickness-highlight_thickness:rail_thickness] = cushion_highlight
-        # Right rail highlight
-        table[:, width-rail_thickness:width-rail_thickness+highlight_thickness] = cushion_highlight
-        
-        # Add pockets
-        pocket_radius = int(min(width, height) * 0.05) 
-        pocket_positions = [
-            (rail_thickness, rail_thickness),               # Top-left
-            (width//2, rail_thickness//2),                  # Top-middle
-            (width-rail_thickness, rail_thickness),         # Top-right
-            (rail_thickness, height-rail_thickness),        # Bottom-left
-            (width//2, height-rail_thickness//2),           # Bottom-middle
-            (width-rail_thickness, height-rail_thickness)   # Bottom-right
-        ]
+def render_balls(table_image, balls, ball_radius=BALL_RADIUS):
+    """Render every mapped ball in a ball array at its game table position."""
+    for color, x, y, number in zip(ball_colors(balls), balls["game_x"].tolist(), balls["game_y"].tolist(),
+                                   balls["number"].tolist()):
+        render_ball(table_image, x, y, color, ball_radius, None if number < 0 else number)
+
+# Colour schemes for the rendered game table (BGR)
+TABLE_STYLES = {
+    "classic": {
+        "felt": (26, 110, 40),            # Green felt - slightly darker and more saturated
+        "rail": (40, 75, 120),            # Dark wood colour
+        "cushion_highlight": (60, 95, 140),  # Lighter wood tone
+        "pocket_trim": (0, 165, 215),     # Gold-like colour
+        "pocket_shadow": (20, 60, 30),    # Dark green/black for shadow
+        "markings": (200, 200, 200),
+    },
+}
+
+# Rendered table backgrounds keyed by (width, height, style)
+_table_background_cache = {}
+
+def render_table_background(width, height, style="classic"):
+    """Render a realistic pool table image from scratch."""
+    colors = TABLE_STYLES[style]
+
+    # Create basic table with green felt
+    table = np.zeros((height, width, 3), dtype=np.uint8)
+    table[:, :] = colors["felt"]
+    
+    # Add subtle texture to the felt
+    noise = np.random.randint(-10, 10, (height, width), dtype=np.int8)
+    table = np.clip(table + noise[:, :, np.newaxis], 0, 255).astype(np.uint8)
+    
+    # Wooden rail (brown border)
+    rail_thickness = int(min(width, height) * 0.075)  # 7.5% of the smaller dimension
+    border_color = colors["rail"]
+    
+    # Draw the rails (borders)
+    table[0:rail_thickness, :] = border_color  # Top rail
+    table[height-rail_thickness:height, :] = border_color  # Bottom rail
+    table[:, 0:rail_thickness] = border_color  # Left rail
+    table[:, width-rail_thickness:width] = border_color  # Right rail
+    
+    # Cushion highlights (subtle lighting effect)
+    cushion_highlight = colors["cushion_highlight"]
+    highlight_thickness = 3
+    
+    # Top rail highlight
+    table[rail_thickness-highlight_thickness:rail_thickness, :] = cushion_highlight
+    # Bottom rail highlight
+    table[height-rail_thickness:height-rail_thickness+highlight_thickness, :] = cushion_highlight
+    # Left rail highlight
+    table[:, rail_thickness-highlight_thickness:rail_thickness] = cushion_highlight
+    # Right rail highlight
+    table[:, width-rail_thickness:width-rail_thickness+highlight_thickness] = cushion_highlight
+    
+    # Add pockets
+    pocket_radius = int(min(width, height) * 0.05) 
+    pocket_positions = [
+        (rail_thickness, rail_thickness),               # Top-left
+        (width//2, rail_thickness//2),                  # Top-middle
+        (width-rail_thickness, rail_thickness),         # Top-right
+        (rail_thickness, height-rail_thickness),        # Bottom-left
+        (width//2, height-rail_thickness//2),           # Bottom-middle
+        (width-rail_thickness, height-rail_thickness)   # Bottom-right
+    ]
+    
+    # Draw pockets
+    for cx, cy in pocket_positions:
+        # Gold trim
+        cv2.circle(table, (cx, cy), pocket_radius + 8, colors["pocket_trim"], -1)
         
-        # Draw pockets
-        for cx, cy in pocket_positions:
-            # Gold trim
-            gold_color = (0, 165, 215)  # BGR (gold-like color)
-            cv2.circle(table, (cx, cy), pocket_radius + 8, gold_color, -1)
-            
-            # Black hole
-            cv2.circle(table, (cx, cy), pocket_radius, (0, 0, 0), -1)
-            
-            # Add shadow effect
-            shadow_color = (20, 60, 30)  # Dark green/black for shadow
-            cv2.circle(table, (cx+3, cy+3), pocket_radius-2, shadow_color, -1)
-        
-        # Add table markings (spots and lines)
-        # Head spot
-        head_spot_x = int(width * 0.25)
-        head_spot_y = height // 2
-        cv2.circle(table, (head_spot_x, head_spot_y), 3, (200, 200, 200), -1)
-        
-        # Foot spot
-        foot_spot_x = int(width * 0.75)
-        foot_spot_y = height // 2
-        cv2.circle(table, (foot_spot_x, foot_spot_y), 3, (200, 200, 200), -1)
-        
-        # Center spot
-        center_spot_x = width // 2
-        center_spot_y = height // 2
-        cv2.circle(table, (center_spot_x, center_spot_y), 3, (200, 200, 200), -1)
-        
-        # Baulk line (semicircle on the left)
-        baulk_radius = int(height * 0.2)
-        cv2.ellipse(table, (head_spot_x, head_spot_y), (baulk_radius, baulk_radius), 
-                   0, 270, 90, (200, 200, 200), 1)
+        # Black hole
+        cv2.circle(table, (cx, cy), pocket_radius, (0, 0, 0), -1)
         
-        return table
+        # Add shadow effect
+        cv2.circle(table, (cx+3, cy+3), pocket_radius-2, colors["pocket_shadow"], -1)
+    
+    # Add table markings (spots and lines)
+    marking_color = colors["markings"]
+
+    # Head spot
+    head_spot_x = int(width * 0.25)
+    head_spot_y = height // 2
+    cv2.circle(table, (head_spot_x, head_spot_y), 3, marking_color, -1)
+    
+    # Foot spot
+    foot_spot_x = int(width * 0.75)
+    foot_spot_y = height // 2
+    cv2.circle(table, (foot_spot_x, foot_spot_y), 3, marking_color, -1)
+    
+    # Center spot
+    center_spot_x = width // 2
+    center_spot_y = height // 2
+    cv2.circle(table, (center_spot_x, center_spot_y), 3, marking_color, -1)
+    
+    # Baulk line (semicircle on the left)
+    baulk_radius = int(height * 0.2)
+    cv2.ellipse(table, (head_spot_x, head_spot_y), (baulk_radius, baulk_radius), 
+               0, 270, 90, marking_color, 1)
+    
+    return table
+
+def create_fancy_table(width, height, style="classic"):
+    """
+    Return a realistic pool table image.
+
+    The background only depends on (width, height, style), so it is rendered once per process
+    and every call gets its own writable copy of the cached image.
+    """
+    try:
+        if style not in TABLE_STYLES:
+            print(f"Unknown table style '{style}', using classic", file=sys.stderr)
+            style = "classic"
+
+        key = (int(width), int(height), style)
+        background = _table_background_cache.get(key)
+        if background is None:
+            background = render_table_background(int(width), int(height), style)
+            # The cached copy is shared between requests, so guard it against in-place drawing
+            background.setflags(write=False)
+            _table_background_cache[key] = background
+        
+        return background.copy()
     except Exception as e:
         print(f"Error creating table: {e}", file=sys.stderr)
         # Return a simple green table as fallback
@@ -801,23 +1689,777 @@ def create_fancy_table(width, height):
         table[:, :] = (40, 120, 40)  # Simple green
         return table
 
-def process_image(image_path):
-    """Process the image and output game-compatible ball positions."""
+def warm_up():
+    """Precompute per-process state (venue profiles, table backgrounds, lookup tables) before the first job arrives."""
+    get_class_luts()
+    for venue in load_venue_profiles().values():
+        venue.prepare()
+
+# Venue profiles
+# Every tunable threshold lives in a named profile. "default" is built from the constants in this
+# file; other venues are JSON (or YAML, when PyYAML is installed) files in venues/ (POOL_VENUE_DIR)
+# that override any subset of the defaults. Profiles are loaded and validated once per process,
+# and each request picks one by name ("venue" in a worker job, --venue or POOL_VENUE).
+VENUE_DIR = "venues"
+DEFAULT_VENUE = "default"
+DEFAULT_VENUE_PARAMS = {
+    "game_table": {"width": GAME_TABLE_WIDTH, "height": GAME_TABLE_HEIGHT},
+    "ball_radius": BALL_RADIUS,
+    "table_style": "classic",
+    "table_green_ranges": TABLE_GREEN_RANGES,
+    "table_morph_kernel": TABLE_MORPH_KERNEL,
+    "ball_color_classes": BALL_COLOR_CLASSES,
+    "ball_area_range": BALL_AREA_RANGE,
+    "ball_min_circularity": BALL_MIN_CIRCULARITY,
+    "overlap_distance_factor": OVERLAP_DISTANCE_FACTOR,
+}
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+_venue_profiles = None
+
+def validate_hsv_range(value, where):
+    """Check an inclusive ((h, s, v), (h, s, v)) range and return it as a tuple of tuples."""
     try:
-        # Create debug directory
-        debug_dir = "debug"
-        if not os.path.exists(debug_dir):
-            os.makedirs(debug_dir)
+        lower, upper = (tuple(int(channel) for channel in bound) for bound in value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{where} must be a pair of [h, s, v] triples")
+    if len(lower) != 3 or len(upper) != 3:
+        raise ValueError(f"{where} must be a pair of [h, s, v] triples")
+    for low, high, limit in zip(lower, upper, (180, 255, 255)):
+        if not 0 <= low <= high <= limit:
+            raise ValueError(f"{where} has an empty or out-of-range channel")
+    return lower, upper
+
+class VenueProfile:
+    """
+    A validated set of pipeline parameters plus the structures derived from them
+    (colour lookup tables, table background), built once and shared by every request.
+    """
+
+    def __init__(self, name, overrides=None):
+        unknown = sorted(set(overrides or {}) - set(DEFAULT_VENUE_PARAMS))
+        if unknown:
+            raise ValueError(f"Unknown venue setting(s): {', '.join(unknown)}")
+        params = {**DEFAULT_VENUE_PARAMS, **(overrides or {})}
+        self.name = name
+
+        game_table = params["game_table"]
+        self.game_width, self.game_height = int(game_table["width"]), int(game_table["height"])
+        self.ball_radius = int(params["ball_radius"])
+        if self.game_width <= 0 or self.game_height <= 0 or self.ball_radius <= 0:
+            raise ValueError("game_table and ball_radius must be positive")
+
+        self.table_style = params["table_style"]
+        if self.table_style not in TABLE_STYLES:
+            raise ValueError(f"Unknown table_style '{self.table_style}'")
+
+        self.table_green_ranges = [validate_hsv_range(value, f"table_green_ranges[{index}]")
+                                   for index, value in enumerate(params["table_green_ranges"])]
+        if not self.table_green_ranges:
+            raise ValueError("table_green_ranges needs at least one range")
+        self.table_morph_kernel = int(params["table_morph_kernel"])
+        if self.table_morph_kernel < 1:
+            raise ValueError("table_morph_kernel must be at least 1")
+
+        self.ball_color_classes = [
+            (str(color), [validate_hsv_range(value, f"ball_color_classes.{color}[{index}]")
+                          for index, value in enumerate(ranges)])
+            for color, ranges in params["ball_color_classes"]
+        ]
+        colors = [color for color, _ in self.ball_color_classes]
+        if len(set(colors)) != len(colors):
+            raise ValueError("ball_color_classes lists a colour twice")
+        # Give new colours their ball record id now, before any detection threads look them up
+        for color in colors:
+            ball_color_id(color)
+
+        self.ball_area_range = tuple(float(area) for area in params["ball_area_range"])
+        if len(self.ball_area_range) != 2 or not 0 <= self.ball_area_range[0] < self.ball_area_range[1]:
+            raise ValueError("ball_area_range must be [min, max] with 0 <= min < max")
+        self.ball_min_circularity = float(params["ball_min_circularity"])
+        if not 0 <= self.ball_min_circularity < 1:
+            raise ValueError("ball_min_circularity must be in [0, 1)")
+        self.overlap_distance_factor = float(params["overlap_distance_factor"])
+        if self.overlap_distance_factor <= 0:
+            raise ValueError("overlap_distance_factor must be positive")
+
+        # The HSV class table also checks its 8-range limit here
+        self.class_luts = build_class_luts(self.ball_color_classes)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            if path.endswith((".yaml", ".yml")):
+                if yaml is None:
+                    raise ValueError("PyYAML is not installed")
+                overrides = yaml.safe_load(f)
+            else:
+                overrides = json.load(f)
+        if not isinstance(overrides, dict):
+            raise ValueError("a venue profile must be a mapping of settings")
+        return cls(os.path.splitext(os.path.basename(path))[0], overrides)
+
+    def prepare(self):
+        """Build everything derived from the profile so the first request doesn't pay for it."""
+        create_fancy_table(self.game_width, self.game_height, self.table_style)
+
+    def cache_params(self):
+        """Every parameter that shapes a result, for the result cache key."""
+        return {
+            "game_table": [self.game_width, self.game_height],
+            "ball_radius": self.ball_radius,
+            "table_style": self.table_style,
+            "table_green_ranges": self.table_green_ranges,
+            "table_morph_kernel": self.table_morph_kernel,
+            "ball_color_classes": self.ball_color_classes,
+            "ball_area_range": self.ball_area_range,
+            "ball_min_circularity": self.ball_min_circularity,
+            "overlap_distance_factor": self.overlap_distance_factor,
+        }
+
+def load_venue_profiles(directory=None):
+    """Load and validate every venue profile once per process; invalid files are reported and skipped."""
+    global _venue_profiles
+    if _venue_profiles is not None and directory is None:
+        return _venue_profiles
+
+    directory = directory or os.environ.get("POOL_VENUE_DIR", VENUE_DIR)
+    profiles = {DEFAULT_VENUE: VenueProfile(DEFAULT_VENUE)}
+    paths = sorted(glob.glob(os.path.join(directory, "*.json")) + glob.glob(os.path.join(directory, "*.yaml")) +
+                   glob.glob(os.path.join(directory, "*.yml")))
+    for path in paths:
+        try:
+            venue = VenueProfile.from_file(path)
+            profiles[venue.name] = venue
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Skipping venue profile {path}: {e}", file=sys.stderr)
+
+    _venue_profiles = profiles
+    return profiles
+
+def get_venue_profile(name=None):
+    """Look up a venue by name, falling back to POOL_VENUE and then the default profile."""
+    name = name or os.environ.get("POOL_VENUE") or DEFAULT_VENUE
+    profiles = load_venue_profiles()
+    if name not in profiles:
+        raise ValueError(f"Unknown venue profile '{name}' (available: {', '.join(sorted(profiles))})")
+    return profiles[name]
+
+def draw_mapping_debug(image, game_table, homography, game_ball_positions, image_scale=1):
+    """
+    Draw the original image and the rendered game table side by side with ball correspondences.
+    image_scale is how many original pixels one pixel of image spans (for reduced decodes).
+    """
+    original_height, original_width = image.shape[0] * image_scale, image.shape[1] * image_scale
+    game_height, game_width = game_table.shape[:2]
+
+    # Resize original image to match game table height for side-by-side comparison
+    aspect_ratio = original_width / original_height
+    debug_original_width = int(game_height * aspect_ratio)
+    resized_original = cv2.resize(image, (debug_original_width, game_height))
+    
+    # Create canvas for side-by-side visualization
+    mapping_debug = np.zeros((game_height, debug_original_width + game_width, 3), dtype=np.uint8)
+    mapping_debug[:, :debug_original_width] = resized_original
+    mapping_debug[:, debug_original_width:] = game_table
+    
+    # Draw the mapped table outline on the original image, projected back through the homography
+    scale_x = debug_original_width / original_width
+    scale_y = game_height / original_height
+    
+    table_outline = homography.to_image(homography.game_corners) * [scale_x, scale_y]
+    cv2.polylines(mapping_debug, [table_outline.astype(np.int32)], True, (0, 255, 0), 2)
+    
+    # Draw correspondences between original and mapped balls
+    for color, original_x, original_y, game_x, game_y in zip(
+            ball_colors(game_ball_positions), game_ball_positions["x"].tolist(), game_ball_positions["y"].tolist(),
+            game_ball_positions["game_x"].tolist(), game_ball_positions["game_y"].tolist()):
+        # Original position (scaled to debug image)
+        orig_x = int(original_x * scale_x)
+        orig_y = int(original_y * scale_y)
+        
+        # Game table position
+        game_x = debug_original_width + game_x
+        
+        # Draw original position
+        color_bgr = (0, 0, 255) if color == "red" else \
+                   (0, 255, 255) if color == "yellow" else \
+                   (255, 255, 255) if color == "white" else \
+                   (0, 0, 0)
+        
+        # Draw circle on original side
+        cv2.circle(mapping_debug, (orig_x, orig_y), 5, color_bgr, -1)
+        
+        # Draw line connecting the points
+        cv2.line(mapping_debug, (orig_x, orig_y), (game_x, game_y), (0, 255, 0), 1)
+        
+        # Add label with colour
+        cv2.putText(mapping_debug, color, (orig_x - 20, orig_y - 10), 
+                   cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
+
+    return mapping_debug
+
+# On-disk result cache
+# Results are keyed on the image bytes plus everything that affects the output, so a re-upload of
+# the same photo skips the whole pipeline. Set POOL_RESULT_CACHE=off to disable it.
+RESULT_CACHE_DIR = "cache"
+RESULT_CACHE_MAX_MB = 200
+RESULT_CACHE_ENTRY_PATTERN = re.compile(r"[0-9a-f]{64}\.[A-Za-z0-9]+")  # <key>.json / <key>.<image extension>
+
+class ResultCache:
+    """Size-bounded LRU cache of response JSON plus the processed table image."""
+
+    def __init__(self, directory=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _paths(self, key, image_extension):
+        return (os.path.join(self.directory, f"{key}.json"),
+                os.path.join(self.directory, f"{key}{image_extension}"))
+
+    def get(self, key, processed_image_path):
+        """Return the cached response and restore its processed image, or None on a miss."""
+        image_extension = os.path.splitext(processed_image_path)[1]
+        json_path, image_path = self._paths(key, image_extension)
+        try:
+            with open(json_path) as f:
+                response = json.load(f)
+            shutil.copyfile(image_path, processed_image_path)
             
-        # Load the image
-        image = cv2.imread(image_path)
-        if image is None:
-            error_msg = {"error": f"Image not found at {image_path}"}
-            print(json.dumps(error_msg))
-            return
+            # Touch both files so eviction sees them as recently used
+            os.utime(json_path)
+            os.utime(image_path)
+        except (OSError, ValueError):
+            # Missing, half-written or evicted by another worker while we read it
+            return None
+        return response
+
+    def put(self, key, response, processed_image_path):
+        os.makedirs(self.directory, exist_ok=True)
+        image_extension = os.path.splitext(processed_image_path)[1]
+        json_path, image_path = self._paths(key, image_extension)
+        
+        # Write to per-process temporary names first so concurrent workers never read half a file,
+        # nor write to each other's temporary files when they store the same key
+        shutil.copyfile(processed_image_path, f"{image_path}.{os.getpid()}.tmp")
+        os.replace(f"{image_path}.{os.getpid()}.tmp", image_path)
+        with open(f"{json_path}.{os.getpid()}.tmp", "w") as f:
+            json.dump(response, f, cls=NumpyEncoder)
+        os.replace(f"{json_path}.{os.getpid()}.tmp", json_path)
+        
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as directory:
+            for entry in directory:
+                # Only finished cache files count; other workers' temporary files and anything else
+                # that lives here are left alone
+                if not RESULT_CACHE_ENTRY_PATTERN.fullmatch(entry.name):
+                    continue
+                try:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Nothing was freed here (another worker may have evicted it first)
+                continue
+            total -= size
+
+def get_result_cache():
+    if os.environ.get("POOL_RESULT_CACHE", "on") == "off":
+        return None
+    max_mb = float(os.environ.get("POOL_RESULT_CACHE_MAX_MB", RESULT_CACHE_MAX_MB))
+    return ResultCache(os.environ.get("POOL_RESULT_CACHE_DIR", RESULT_CACHE_DIR), int(max_mb * 1024 * 1024))
+
+def result_cache_key(image_bytes, filename, decode_max_dim=0, detector=DEFAULT_BALL_DETECTOR, venue=None):
+    """Hash the image bytes together with the pipeline version and every parameter that shapes the result."""
+    if venue is None:
+        venue = get_venue_profile()
+    params = {
+        "decode_max_dim": decode_max_dim,
+        "detector": detector,
+        "table_working_max_dim": os.environ.get("POOL_TABLE_WORKING_MAX_DIM", TABLE_WORKING_MAX_DIM),
+        "table_refine_edges": os.environ.get("POOL_TABLE_REFINE_EDGES", "on"),
+        "felt_mask": os.environ.get("POOL_FELT_MASK", "on"),
+        "version": PIPELINE_VERSION,
+        "venue": venue.cache_params(),
+        # The reference image gets its own hand-placed layout
+        "custom_layout": "Pool-Table-Test-1-copy" in filename,
+        # The processed image is encoded according to the upload's extension
+        "output_extension": os.path.splitext(filename)[1].lower(),
+    }
+    digest = hashlib.sha256(image_bytes)
+    digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+# Fixed-camera calibration
+# Mounted cameras see the table in the same place every time. Requests that carry a camera id
+# reuse the table quadrilateral, homography and felt outline stored for that camera instead of
+# running table detection. The stored state is checked cheaply each time by sampling the felt
+# colour at points that were bare felt when the camera was calibrated; when too many of them no
+# longer look like felt (or the image size or venue changed) the table is detected again and the
+# calibration replaced. Calibrations live in calibrations/ (POOL_CALIBRATION_DIR), one JSON per camera.
+CALIBRATION_DIR = "calibrations"
+CALIBRATION_GRID = (5, 3)             # Felt sample grid (columns, rows) over the inner table
+CALIBRATION_INSET = 0.15              # Fraction of the table kept clear of the grid on each side
+CALIBRATION_MIN_SAMPLES = 4           # Fewer bare-felt samples than this and the camera isn't stored
+CALIBRATION_MIN_FELT_FRACTION = 0.75  # Share of samples that must still be felt (balls cover a few)
+CAMERA_ID_PATTERN = re.compile(r"[A-Za-z0-9_.-]{1,64}")
+
+def felt_at_points(image, points, green_ranges=TABLE_GREEN_RANGES, patch=5):
+    """Whether the median colour of a small patch around each (x, y) point is felt."""
+    height, width = image.shape[:2]
+    half = patch // 2
+    colors = []
+    for x, y in points:
+        x, y = int(round(x)), int(round(y))
+        region = image[max(0, y - half):min(height, y + half + 1), max(0, x - half):min(width, x + half + 1)]
+        colors.append(np.median(region.reshape(-1, 3), axis=0) if region.size else (0, 0, 0))
+    hsv = cv2.cvtColor(np.array(colors, dtype=np.uint8).reshape(-1, 1, 3), cv2.COLOR_BGR2HSV)
+    return green_mask_from_hsv(hsv, green_ranges).ravel() > 0
+
+class CameraCalibration:
+    """Table geometry for one fixed camera, in original image pixels."""
+
+    def __init__(self, camera_id, venue, image_size, table_bounds, felt_hull, felt_hull_margin, homography,
+                 sample_points, created_at=None):
+        self.camera_id = camera_id
+        self.venue = venue
+        self.image_size = tuple(image_size)
+        self.table_bounds = {key: int(value) for key, value in table_bounds.items()}
+        self.felt_hull = np.asarray(felt_hull, dtype=np.float64)
+        self.felt_hull_margin = felt_hull_margin
+        self.homography = homography
+        self.sample_points = np.asarray(sample_points, dtype=np.float64)
+        self.created_at = created_at or time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    @classmethod
+    def from_detection(cls, camera_id, venue, image, image_scale, table_bounds, context, homography):
+        """
+        Calibrate from a request that just ran table detection. table_bounds and homography are in
+        original pixels; image and context are at the decoded scale. Returns None when there is no
+        felt outline or too little bare felt to validate against later.
+        """
+        if context.felt_hull is None:
+            return None
+        
+        # A grid over the inner table; keep the points that are bare felt right now
+        x, y, w, h = (table_bounds[key] / image_scale for key in ("x", "y", "width", "height"))
+        columns, rows = CALIBRATION_GRID
+        grid = np.array([[x + w * (CALIBRATION_INSET + (1 - 2 * CALIBRATION_INSET) * column / (columns - 1)),
+                          y + h * (CALIBRATION_INSET + (1 - 2 * CALIBRATION_INSET) * row / (rows - 1))]
+                         for row in range(rows) for column in range(columns)])
+        samples = grid[felt_at_points(image, grid, venue.table_green_ranges)]
+        if len(samples) < CALIBRATION_MIN_SAMPLES:
+            return None
+        
+        return cls(camera_id, venue.name, (image.shape[1] * image_scale, image.shape[0] * image_scale), table_bounds,
+                   context.felt_hull * image_scale, context.felt_hull_margin * image_scale, homography,
+                   samples * image_scale)
+
+    @classmethod
+    def from_dict(cls, data):
+        homography = TableHomography(data["image_to_game"], np.asarray(data["image_corners"], dtype=np.float32),
+                                     np.asarray(data["game_corners"], dtype=np.float32))
+        return cls(data["camera_id"], data["venue"], data["image_size"], data["table_bounds"], data["felt_hull"],
+                   data["felt_hull_margin"], homography, data["sample_points"], data.get("created_at"))
+
+    def to_dict(self):
+        return {
+            "camera_id": self.camera_id,
+            "venue": self.venue,
+            "image_size": list(self.image_size),
+            "table_bounds": self.table_bounds,
+            "image_corners": self.homography.image_corners,
+            "game_corners": self.homography.game_corners,
+            "image_to_game": self.homography.image_to_game,
+            "felt_hull": self.felt_hull,
+            "felt_hull_margin": self.felt_hull_margin,
+            "sample_points": self.sample_points,
+            "created_at": self.created_at
+        }
+
+    def matches(self, image, image_scale, venue):
+        """Cheap check that the camera still sees the table where it was calibrated."""
+        if venue.name != self.venue:
+            return False
+        size = (image.shape[1] * image_scale, image.shape[0] * image_scale)
+        if any(abs(actual - expected) > image_scale for actual, expected in zip(size, self.image_size)):
+            return False
+        felt = felt_at_points(image, self.sample_points / image_scale, venue.table_green_ranges)
+        return felt.mean() >= CALIBRATION_MIN_FELT_FRACTION
+
+    def apply(self, context, image_scale):
+        """Table bounds at the decoded scale, with the felt outline handed to context for ball detection."""
+        context.felt_hull = np.round(self.felt_hull / image_scale).astype(np.int32)
+        context.felt_hull_margin = max(1, int(np.ceil(self.felt_hull_margin / image_scale)))
+        return {key: int(value / image_scale) for key, value in self.table_bounds.items()}
+
+class CalibrationStore:
+    """Camera calibrations kept in memory and persisted as one JSON file per camera."""
+
+    def __init__(self, directory=CALIBRATION_DIR):
+        self.directory = directory
+        self.calibrations = {}
+
+    def path_for(self, camera_id):
+        return os.path.join(self.directory, f"{camera_id}.json")
+
+    def get(self, camera_id):
+        """The calibration for a camera, or None if it has never been calibrated."""
+        if camera_id not in self.calibrations:
+            try:
+                with open(self.path_for(camera_id)) as f:
+                    self.calibrations[camera_id] = CameraCalibration.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError) as e:
+                if not isinstance(e, FileNotFoundError):
+                    print(f"Ignoring unreadable calibration for camera {camera_id}: {e}", file=sys.stderr)
+                return None
+        return self.calibrations[camera_id]
+
+    def put(self, calibration):
+        self.calibrations[calibration.camera_id] = calibration
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path_for(calibration.camera_id)
+        
+        # Write to a temporary name first so concurrent workers never read half a file
+        with open(f"{path}.{os.getpid()}.tmp", "w") as f:
+            json.dump(calibration.to_dict(), f, cls=NumpyEncoder)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+_calibration_store = None
+
+def get_calibration_store():
+    global _calibration_store
+    directory = os.environ.get("POOL_CALIBRATION_DIR", CALIBRATION_DIR)
+    if _calibration_store is None or _calibration_store.directory != directory:
+        _calibration_store = CalibrationStore(directory)
+    return _calibration_store
+
+# Image ingestion
+# Uploads are decoded straight from a read-only memory map of the file, or from bytes handed over the
+# worker channel, so the encoded image is never copied into a Python bytes object. Set
+# POOL_DECODE_MAX_DIM (or "decode_max_dim" in a worker job) to let very large JPEGs decode at 1/2, 1/4
+# or 1/8 scale while keeping at least that many pixels on the longer side. 0 always decodes in full.
+DECODE_MAX_DIM = 0
+REDUCED_DECODE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+class ImageSource:
+    """Encoded image bytes backed either by a memory-mapped file or by an in-memory buffer."""
+
+    def __init__(self, buffer, mapping=None):
+        self.buffer = buffer
+        self._mapping = mapping
+
+    @classmethod
+    def from_path(cls, path):
+        with open(path, "rb") as f:
+            # mmap refuses empty files; let decoding report those as unreadable
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(b"")
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapping, mapping)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(memoryview(data))
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def array(self):
+        """A zero-copy uint8 view of the encoded bytes."""
+        return np.frombuffer(self.buffer, dtype=np.uint8)
+
+    def close(self):
+        if self._mapping is not None:
+            try:
+                self._mapping.close()
+            except BufferError:
+                # A view is still alive somewhere; the mapping is released once it is collected
+                pass
+            self._mapping = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def jpeg_dimensions(buffer):
+    """Read (width, height) from a JPEG's frame header without decoding it, or None if not a JPEG."""
+    data = memoryview(buffer)
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    
+    offset = 2
+    while offset + 9 < len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        # Fill bytes and standalone markers carry no length
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker in (0x01, *range(0xD0, 0xD8)):
+            offset += 2
+            continue
+        length = (data[offset + 2] << 8) | data[offset + 3]
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = (data[offset + 5] << 8) | data[offset + 6]
+            width = (data[offset + 7] << 8) | data[offset + 8]
+            return width, height
+        offset += 2 + length
+    return None
+
+def choose_decode_scale(dimensions, max_dim):
+    """Largest JPEG reduction factor that keeps the longer side at or above max_dim."""
+    if not max_dim or max_dim <= 0 or dimensions is None:
+        return 1
+    longer_side = max(dimensions)
+    for factor in (8, 4, 2):
+        if longer_side / factor >= max_dim:
+            return factor
+    return 1
+
+def decode_image(source, max_dim=None):
+    """
+    Decode an ImageSource, at reduced resolution when it is far larger than max_dim.
+    Returns (image, scale) where scale is how many original pixels one decoded pixel spans.
+    """
+    if max_dim is None:
+        max_dim = int(os.environ.get("POOL_DECODE_MAX_DIM", DECODE_MAX_DIM))
+    
+    scale = choose_decode_scale(jpeg_dimensions(source.buffer), max_dim)
+    encoded = source.array()
+    image = cv2.imdecode(encoded, REDUCED_DECODE_FLAGS.get(scale, cv2.IMREAD_COLOR))
+    # Drop the view so the memory map can be closed straight away
+    del encoded
+    return image, scale
+
+def scale_detections(table_bounds, balls, scale):
+    """Scale table bounds and ball detections from a reduced decode back to original image pixels."""
+    if scale == 1:
+        return table_bounds, balls
+    
+    table_bounds = {key: int(value * scale) for key, value in table_bounds.items()}
+    balls = np.array(balls, dtype=BALL_DTYPE)  # A copy; an empty list gives an empty array
+    balls["x"] *= scale
+    balls["y"] *= scale
+    balls["radius"][~balls["synthetic"]] *= scale
+    return table_bounds, balls
+
+def peak_rss_mb():
+    """Peak resident set size since the last reset_peak_rss(), in megabytes."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 2)
+    except OSError:
+        pass
+    # ru_maxrss is the peak for the whole process, in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+
+def reset_peak_rss():
+    """Start a new peak RSS window so long-lived workers report per-request peaks (Linux only)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+# Stage timings and profiling
+# Set POOL_TIMINGS=on (or pass --timings / "timings": true in a worker job) to add a `timings` block
+# to the response, and POOL_PROFILE_DIR (or --profile-dir) to dump a cProfile file per request.
+class StageTimer:
+    """Records wall time, CPU time and peak traced memory for each pipeline stage."""
+
+    enabled = True
+
+    def __init__(self):
+        self.stages = []
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    @contextmanager
+    def stage(self, name, **info):
+        """Time the enclosed block. Extra keyword arguments (e.g. image dimensions) are reported as-is."""
+        tracemalloc.reset_peak()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield info
+        finally:
+            self.stages.append({
+                "stage": name,
+                "wall_ms": round((time.perf_counter() - start_wall) * 1000, 2),
+                "cpu_ms": round((time.process_time() - start_cpu) * 1000, 2),
+                "peak_memory_mb": round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2),
+                **info
+            })
+
+    def report(self):
+        """Stop tracing and return the timings block for the response."""
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        return {
+            "stages": self.stages,
+            "total_wall_ms": round((time.perf_counter() - self.start_wall) * 1000, 2),
+            "total_cpu_ms": round((time.process_time() - self.start_cpu) * 1000, 2),
+            "peak_rss_mb": peak_rss_mb()
+        }
+
+class NullStageTimer(StageTimer):
+    """Timer used when timings are off: stages run untouched."""
+
+    enabled = False
+
+    def __init__(self):
+        self.stages = []
 
+    @contextmanager
+    def stage(self, name, **info):
+        yield info
+
+    def report(self):
+        return None
+
+def timings_enabled(timings=None):
+    """Resolve a per-request timings flag, falling back to POOL_TIMINGS."""
+    if timings is None:
+        return os.environ.get("POOL_TIMINGS", "off") == "on"
+    return bool(timings)
+
+def profile_path_for(profile_dir, image_path):
+    """Where to dump the cProfile stats for one request."""
+    os.makedirs(profile_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(profile_dir, f"{stem}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.prof")
+
+def process_image(image_path, debug_mode=None, use_cache=True, timings=None, profile_dir=None,
+                  image_bytes=None, decode_max_dim=None, progress=None, detector=None, venue=None, camera_id=None):
+    """
+    Process the image and return game-compatible ball positions as a response dict.
+    
+    With timings on, the response gains a `timings` block; with a profile_dir (or POOL_PROFILE_DIR)
+    the whole request runs under cProfile and the stats are written there. When image_bytes is given
+    it is decoded instead of reading image_path, which then only names the output. Every response
+    reports the request's peak RSS. progress, if given, is called as progress(stage, **info) when the
+    table is found, the balls are detected and the table is rendered (a result-cache hit replays the
+    same stages from the stored response). detector names the ball detection
+    engine (see BALL_DETECTORS); the response's `detector` block reports which one ran and its cost.
+    venue names the venue profile whose thresholds and table size are used. With a camera_id, the
+    table geometry stored for that fixed camera is reused instead of detecting the table, and the
+    result cache is bypassed so the calibration is always checked.
+    """
+    reset_peak_rss()
+    timer = StageTimer() if timings_enabled(timings) else NullStageTimer()
+    profile_dir = profile_dir or os.environ.get("POOL_PROFILE_DIR")
+    if decode_max_dim is None:
+        decode_max_dim = int(os.environ.get("POOL_DECODE_MAX_DIM", DECODE_MAX_DIM))
+    pipeline_args = (image_path, debug_mode, use_cache, timer, image_bytes, decode_max_dim, progress, detector, venue,
+                     camera_id)
+    
+    if not profile_dir:
+        response = run_pipeline(*pipeline_args)
+    else:
+        profiler = cProfile.Profile()
+        response = profiler.runcall(run_pipeline, *pipeline_args)
+        try:
+            profile_path = profile_path_for(profile_dir, image_path)
+            profiler.dump_stats(profile_path)
+            print(f"Profile written to {profile_path}", file=sys.stderr)
+        except OSError as e:
+            print(f"Could not write profile: {e}", file=sys.stderr)
+    
+    if timer.enabled:
+        response["timings"] = timer.report()
+    response["peak_rss_mb"] = peak_rss_mb()
+    return response
+
+def run_pipeline(image_path, debug_mode, use_cache, timer, image_bytes=None, decode_max_dim=0, progress=None,
+                 detector=None, venue=None, camera_id=None):
+    """Run every stage for one image, timing each through timer and reporting milestones to progress."""
+    if progress is None:
+        progress = lambda stage, **info: None
+    
+    try:
+        # Fail fast on an unknown engine or venue, before any work is done
+        detector = ball_detector_name(detector)
+        venue = get_venue_profile(venue)
+        if camera_id is not None and not CAMERA_ID_PATTERN.fullmatch(str(camera_id)):
+            return {"error": f"Invalid camera id '{camera_id}' (letters, digits, '.', '_' and '-' only)"}
+        
+        # Pick where (and whether) debug images go for this request
+        debug = create_debug_sink(debug_mode, image_path)
+            
+        # Map the encoded image once, for both the cache key and decoding
+        with timer.stage("read") as info:
+            try:
+                source = ImageSource.from_bytes(image_bytes) if image_bytes is not None else ImageSource.from_path(image_path)
+            except OSError:
+                return {"error": f"Image not found at {image_path}"}
+            info["bytes"] = len(source)
+        
+        filename = os.path.basename(image_path)
+        processed_image_path = os.path.join(os.path.dirname(image_path), f"processed_{filename}")
+        
+        with source:
+            # Serve repeat uploads of the same photo straight from the result cache. Fixed-camera requests
+            # skip it: they must consult (and report on) the calibration store every time
+            cache = get_result_cache() if use_cache and not camera_id else None
+            if cache is not None:
+                with timer.stage("cache_lookup") as info:
+                    cache_key = result_cache_key(source.buffer, filename, decode_max_dim, detector, venue)
+                    cached_response = cache.get(cache_key, processed_image_path)
+                    info["hit"] = cached_response is not None
+                if cached_response is not None:
+                    # Replay the milestones from the stored response so progress listeners see every stage
+                    ball_positions = cached_response.get("ball_positions", [])
+                    progress("table_found", table_bounds=cached_response.get("table_bounds"))
+                    progress("balls_detected", balls=len(ball_positions))
+                    progress("balls_mapped", ball_positions=ball_positions)
+                    progress("rendered", image_url=f"/uploads/processed_{filename}")
+                    return {"image_url": f"/uploads/processed_{filename}", **cached_response, "cache_hit": True}
+            
+            with timer.stage("decode") as info:
+                image, decode_scale = decode_image(source, decode_max_dim)
+                if image is None:
+                    return {"error": f"Image not found at {image_path}"}
+                info.update(width=int(image.shape[1]), height=int(image.shape[0]), scale=decode_scale)
+        
+        # Every stage pulls HSV, pyramid levels, masks and crops of the decoded image from here
+        context = ImageContext(image)
+        
         # Get original image dimensions
-        original_height, original_width = image.shape[:2]
+        original_height, original_width = image.shape[0] * decode_scale, image.shape[1] * decode_scale
         
         # Store original dimensions
         original_dimensions = {
@@ -826,111 +2468,135 @@ def process_image(image_path):
         }
         
         # Save original image for debugging
-        cv2.imwrite(os.path.join(debug_dir, "original_image.jpg"), image)
-        
-        filename = os.path.basename(image_path)
-        
-        # Detect table bounds
-        table_bounds = detect_table_bounds(image)
-        
-        # If this is our target image, use the custom ball detection
-        if "Pool-Table-Test-1-copy" in filename:
-            print(f"Using custom ball detection for {filename}", file=sys.stderr)
-            original_ball_positions = detect_balls_in_custom_image(image, table_bounds)
+        debug.save("original_image.jpg", image)
+        
+        # A fixed camera reuses its stored table geometry while the felt is still where it was
+        calibration = None
+        if camera_id:
+            with timer.stage("calibration_check") as info:
+                calibration = get_calibration_store().get(camera_id)
+                calibration_status = "created"
+                if calibration is not None and not calibration.matches(image, decode_scale, venue):
+                    print(f"Calibration for camera {camera_id} no longer matches, detecting the table again",
+                          file=sys.stderr)
+                    calibration, calibration_status = None, "recalibrated"
+                info["reused"] = calibration is not None
+        
+        if calibration is not None:
+            table_bounds = calibration.apply(context, decode_scale)
+            calibration_status = "reused"
         else:
-            # Otherwise, use the standard detection
-            original_ball_positions = detect_balls(image, table_bounds)
+            # Detect table bounds
+            with timer.stage("table_detection", width=int(image.shape[1]), height=int(image.shape[0])):
+                table_bounds = detect_table_bounds(image, debug, image_scale=decode_scale, venue=venue, context=context)
+        progress("table_found", table_bounds=scale_detections(table_bounds, [], decode_scale)[0])
+        
+        detector_stats = {"engine": detector}
+        with timer.stage("ball_detection", width=int(table_bounds["width"]), height=int(table_bounds["height"])) as info:
+            # If this is our target image, use the custom ball detection
+            if "Pool-Table-Test-1-copy" in filename:
+                print(f"Using custom ball detection for {filename}", file=sys.stderr)
+                original_ball_positions = detect_balls_in_custom_image(image, table_bounds, debug)
+                detector_stats["engine"] = "custom_layout"
+            else:
+                # Otherwise, use the standard detection
+                original_ball_positions = detect_balls(image, table_bounds, debug, image_scale=decode_scale,
+                                                       detector=detector, stats=detector_stats, venue=venue,
+                                                       context=context)
+            info.update(balls=len(original_ball_positions), detector=detector_stats["engine"])
+        
+        # Everything downstream works in original image pixels, whatever resolution we decoded at
+        table_bounds, original_ball_positions = scale_detections(table_bounds, original_ball_positions, decode_scale)
+        progress("balls_detected", balls=len(original_ball_positions))
         
         # Create the fancy pool table background
-        game_table = create_fancy_table(GAME_TABLE_WIDTH, GAME_TABLE_HEIGHT)
+        with timer.stage("table_background", width=venue.game_width, height=venue.game_height):
+            game_table = create_fancy_table(venue.game_width, venue.game_height, venue.table_style)
+        
+        with timer.stage("mapping"):
+            # One image <-> game mapping shared by ball mapping, the debug overlay and the response
+            if calibration is not None:
+                table_bounds, homography = dict(calibration.table_bounds), calibration.homography
+            else:
+                homography = TableHomography.from_table_bounds(table_bounds, venue.game_width, venue.game_height)
+            
+            # Map ball positions to game table with improved mapping function
+            mapping_stats = {}
+            game_ball_positions = map_ball_positions(
+                original_ball_positions, 
+                table_bounds, 
+                venue.game_width, 
+                venue.game_height,
+                stats=mapping_stats,
+                homography=homography,
+                venue=venue
+            )
+            ball_positions = ball_positions_json(game_ball_positions)
         
-        # Map ball positions to game table with improved mapping function
-        game_ball_positions = map_ball_positions(
-            original_ball_positions, 
-            table_bounds, 
-            GAME_TABLE_WIDTH, 
-            GAME_TABLE_HEIGHT
-        )
+        # Mapped positions reach the client before rendering and the image write finish
+        progress("balls_mapped", ball_positions=ball_positions)
         
         # Render the balls on the game table
-        for ball in game_ball_positions:
-            render_ball(
-                game_table, 
-                ball["x"], 
-                ball["y"], 
-                ball["color"], 
-                BALL_RADIUS, 
-                ball["number"]
-            )
+        with timer.stage("rendering", balls=len(game_ball_positions)):
+            render_balls(game_table, game_ball_positions, venue.ball_radius)
         
         # Save the processed game table image
-        filename = os.path.basename(image_path)
-        processed_image_path = os.path.join(os.path.dirname(image_path), f"processed_{filename}")
-        cv2.imwrite(processed_image_path, game_table)
+        with timer.stage("write_output"):
+            cv2.imwrite(processed_image_path, game_table)
+        progress("rendered", image_url=f"/uploads/processed_{filename}")
         
         # Create mapping visualisation for debugging
-        # Resize original image to match game table height for side-by-side comparison
-        aspect_ratio = original_width / original_height
-        debug_original_width = int(GAME_TABLE_HEIGHT * aspect_ratio)
-        resized_original = cv2.resize(image, (debug_original_width, GAME_TABLE_HEIGHT))
-        
-        # Create canvas for side-by-side visualization
-        mapping_debug = np.zeros((GAME_TABLE_HEIGHT, debug_original_width + GAME_TABLE_WIDTH, 3), dtype=np.uint8)
-        mapping_debug[:, :debug_original_width] = resized_original
-        mapping_debug[:, debug_original_width:] = game_table
-        
-        # Draw table boundaries on original image
-        x, y, w, h = table_bounds["x"], table_bounds["y"], table_bounds["width"], table_bounds["height"]
-        scale_x = debug_original_width / original_width
-        scale_y = GAME_TABLE_HEIGHT / original_height
-        
-        pt1 = (int(x * scale_x), int(y * scale_y))
-        pt2 = (int((x + w) * scale_x), int((y + h) * scale_y))
-        cv2.rectangle(mapping_debug, pt1, pt2, (0, 255, 0), 2)
-        
-        # Draw correspondences between original and mapped balls
-        for ball in game_ball_positions:
-            # Original position (scaled to debug image)
-            orig_x = int(ball.get("originalX", 0) * scale_x)
-            orig_y = int(ball.get("originalY", 0) * scale_y)
-            
-            # Game table position
-            game_x = debug_original_width + ball["x"]
-            game_y = ball["y"]
-            
-            # Draw original position
-            color_bgr = (0, 0, 255) if ball["color"] == "red" else \
-                       (0, 255, 255) if ball["color"] == "yellow" else \
-                       (255, 255, 255) if ball["color"] == "white" else \
-                       (0, 0, 0)
-            
-            # Draw circle on original side
-            cv2.circle(mapping_debug, (orig_x, orig_y), 5, color_bgr, -1)
-            
-            # Draw line connecting the points
-            cv2.line(mapping_debug, (orig_x, orig_y), (game_x, game_y), (0, 255, 0), 1)
-            
-            # Add label with colour
-            cv2.putText(mapping_debug, ball["color"], (orig_x - 20, orig_y - 10), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
-        
-        cv2.imwrite(os.path.join(debug_dir, "mapping_debug.jpg"), mapping_debug)
+        if debug.enabled:
+            with timer.stage("debug_overlay"):
+                debug.save("mapping_debug.jpg", draw_mapping_debug(image, game_table, homography, game_ball_positions,
+                                                                   decode_scale))
         
         # Prepare response with all necessary information
         response = {
             "image_url": f"/uploads/processed_{filename}",
-            "ball_positions": game_ball_positions,
+            "ball_positions": ball_positions,
             "original_dimensions": original_dimensions,
             "table_bounds": {
                 "x": int(table_bounds["x"]),
                 "y": int(table_bounds["y"]),
                 "width": int(table_bounds["width"]),
                 "height": int(table_bounds["height"])
-            }
+            },
+            "overlap_resolution": {
+                "iterations": mapping_stats.get("overlap_iterations", 0),
+                "residual_overlap": mapping_stats.get("residual_overlap", 0.0)
+            },
+            "homography": homography.to_dict(),
+            "detector": detector_stats,
+            "venue": venue.name
         }
+        
+        if camera_id:
+            if calibration is None:
+                with timer.stage("calibration_store"):
+                    calibration = CameraCalibration.from_detection(camera_id, venue, image, decode_scale, table_bounds,
+                                                                   context, homography)
+                    if calibration is None:
+                        calibration_status = "not_calibrated"
+                        print(f"Not enough bare felt to calibrate camera {camera_id}", file=sys.stderr)
+                    else:
+                        try:
+                            get_calibration_store().put(calibration)
+                        except OSError as e:
+                            print(f"Could not store calibration: {e}", file=sys.stderr)
+            response["calibration"] = {"camera_id": camera_id, "status": calibration_status}
+        
+        if cache is not None:
+            with timer.stage("cache_store"):
+                try:
+                    cache.put(cache_key, {key: value for key, value in response.items() if key != "image_url"},
+                              processed_image_path)
+                except OSError as e:
+                    print(f"Could not store result in cache: {e}", file=sys.stderr)
 
-        # Use the custom encoder to handle NumPy types
-        print(json.dumps(response, cls=NumpyEncoder))
+        if timer.enabled:
+            response["image_context"] = context.report()
+        return response
     except Exception as e:
         # Return error information
         error_response = {
@@ -940,12 +2606,540 @@ def process_image(image_path):
             "original_dimensions": {"width": 800, "height": 400},
             "table_bounds": {"x": 0, "y": 0, "width": 800, "height": 400}
         }
-        print(json.dumps(error_response))
+        return error_response
+
+# Worker output protocols
+# By default a worker writes one JSON message per line on stdout and its logs go to stderr, so a stray
+# print() lands in the middle of the protocol. With --frames json|msgpack every message is instead a
+# length-prefixed frame: a 4-byte big-endian payload length, a 1-byte channel, then the payload in the
+# chosen encoding. Progress and result messages use FRAME_MESSAGE; log lines (everything printed while
+# the worker runs) use FRAME_LOG, so nothing but whole frames ever reaches the reader.
+FRAME_HEADER = struct.Struct(">IB")
+FRAME_MESSAGE = 1
+FRAME_LOG = 2
+FRAME_ENCODINGS = ("json", "msgpack")
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+def encode_payload(message, encoding="json"):
+    """Encode a protocol message as compact JSON or MessagePack bytes."""
+    if encoding == "msgpack":
+        if msgpack is None:
+            raise ValueError("msgpack is not installed")
+        return msgpack.packb(message, default=NumpyEncoder().default)
+    return json.dumps(message, cls=NumpyEncoder, separators=(",", ":")).encode("utf-8")
+
+class LineWriter:
+    """Writes protocol messages as JSON lines on a text or binary stream."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def message(self, message):
+        line = json.dumps(message, cls=NumpyEncoder) + "\n"
+        with self.lock:
+            self.stream.write(line if isinstance(self.stream, io.TextIOBase) else line.encode("utf-8"))
+            self.stream.flush()
+
+class FrameWriter:
+    """Writes protocol messages and log lines as length-prefixed frames on a binary stream."""
+
+    def __init__(self, stream, encoding="json"):
+        if encoding not in FRAME_ENCODINGS:
+            raise ValueError(f"Unknown frame encoding '{encoding}' (expected one of: {', '.join(FRAME_ENCODINGS)})")
+        if encoding == "msgpack" and msgpack is None:
+            raise ValueError("msgpack is not installed")
+        self.stream = stream
+        self.encoding = encoding
+        # Debug writer and contour threads can log while a message is going out
+        self.lock = threading.Lock()
+
+    def write(self, channel, message):
+        payload = encode_payload(message, self.encoding)
+        with self.lock:
+            self.stream.write(FRAME_HEADER.pack(len(payload), channel) + payload)
+            self.stream.flush()
+
+    def message(self, message):
+        self.write(FRAME_MESSAGE, message)
+
+    def log(self, line):
+        self.write(FRAME_LOG, {"message": line})
+
+class FrameLogStream(io.TextIOBase):
+    """Text stream (for sys.stdout/sys.stderr) that sends every line written to it as a log frame."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = ""
+        self.lock = threading.Lock()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        with self.lock:
+            lines = (self.pending + text).split("\n")
+            self.pending = lines.pop()
+        for line in lines:
+            self.writer.log(line)
+        return len(text)
+
+    def flush(self):
+        with self.lock:
+            line, self.pending = self.pending, ""
+        if line:
+            self.writer.log(line)
+
+def protocol_output(output_stream):
+    """
+    A private binary copy of stdout for frames, with file descriptor 1 pointed at stderr so that
+    nothing else (native libraries included) can write between them. Other streams are used as is.
+    """
+    if output_stream is not sys.__stdout__:
+        return getattr(output_stream, "buffer", output_stream)
+    output_stream.flush()
+    protocol = os.fdopen(os.dup(output_stream.fileno()), "wb")
+    os.dup2(sys.__stderr__.fileno(), output_stream.fileno())
+    return protocol
+
+def handle_worker_job(line, emit=None):
+    """
+    Run a single newline-delimited JSON job and return its result message, {"id": ..., "result": {...}}.
+    
+    Jobs with "progress": true also get {"id": ..., "progress": {"stage": ...}} messages passed to emit
+    as each stage finishes, before the result.
+    """
+    job_id = None
+    try:
+        job = json.loads(line)
+        job_id = job.get("id")
+        
+        report_progress = None
+        if job.get("progress") and emit is not None:
+            def report_progress(stage, **info):
+                emit({"id": job_id, "progress": {"stage": stage, **info}})
+        
+        image_path = job.get("image_path")
+        if not image_path:
+            result = {"error": "No image path provided"}
+        else:
+            # Encoded image sent inline over the channel; image_path then only names the output
+            image_bytes = base64.b64decode(job["image_base64"]) if job.get("image_base64") else None
+            result = process_image(image_path, debug_mode=job.get("debug_mode"),
+                                   use_cache=job.get("use_cache", True), timings=job.get("timings"),
+                                   image_bytes=image_bytes, decode_max_dim=job.get("decode_max_dim"),
+                                   progress=report_progress, detector=job.get("detector"), venue=job.get("venue"),
+                                   camera_id=job.get("camera_id"))
+    except Exception as e:
+        result = {"error": f"Invalid worker job: {str(e)}"}
+
+    return {"id": job_id, "result": result}
+
+def run_worker(input_stream=sys.stdin, output_stream=sys.stdout, frames=None):
+    """
+    Long-lived worker loop: read one JSON job per line and answer each with one result message.
+    
+    Each job looks like {"id": 1, "image_path": "/abs/path.jpg", "debug_mode": "off", "use_cache": true}
+    and is answered with {"id": 1, "result": {...}}, where result is exactly what process_image returns.
+    Jobs that ask for "progress" get progress messages first. Messages are JSON lines, with diagnostics
+    on stderr; with frames="json" or "msgpack" they are frames instead and every line printed to stdout
+    or stderr goes out as a log frame (see FrameWriter).
+    """
+    if frames:
+        writer = FrameWriter(protocol_output(output_stream), frames)
+        sys.stdout = sys.stderr = FrameLogStream(writer)
+    else:
+        writer = LineWriter(output_stream)
+
+    warm_up()
+    print("Python worker ready", file=sys.stderr)
+    for line in input_stream:
+        line = line.strip()
+        if not line:
+            continue
+        writer.message(handle_worker_job(line, writer.message))
+
+def serve_unix_socket(socket_path, frames=None):
+    """
+    Serve the same protocol as run_worker on a local Unix socket. Framed connections get message
+    frames only; logs stay on the server's stderr.
+    """
+    import socketserver
+
+    class WorkerJobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            writer = FrameWriter(self.wfile, frames) if frames else LineWriter(self.wfile)
+            for raw_line in self.rfile:
+                line = raw_line.decode("utf-8").strip()
+                if not line:
+                    continue
+                writer.message(handle_worker_job(line, writer.message))
+
+    # Remove a stale socket left behind by a previous worker
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    warm_up()
+    with socketserver.UnixStreamServer(socket_path, WorkerJobHandler) as server:
+        print(f"Python worker listening on {socket_path}", file=sys.stderr)
+        server.serve_forever()
+
+# File types picked up when a batch source is a directory
+BATCH_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+def resolve_batch_inputs(source):
+    """
+    Expand a batch source into a list of image paths.
+
+    The source can be a directory (every image in it, skipping our own processed_* outputs),
+    a glob pattern, or a manifest file with one path per line (or a JSON list of paths).
+    Relative manifest entries are resolved against the manifest's folder, and upload URLs
+    like /uploads/foo.jpg from the uploaded_images table are resolved against this script's folder.
+    """
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in sorted(os.listdir(source))
+                 if name.lower().endswith(BATCH_IMAGE_EXTENSIONS) and not name.startswith("processed_")]
+    elif os.path.isfile(source):
+        with open(source) as manifest:
+            if source.lower().endswith(".json"):
+                entries = json.load(manifest)
+            else:
+                entries = [line.strip() for line in manifest if line.strip() and not line.startswith("#")]
+        
+        manifest_dir = os.path.dirname(os.path.abspath(source))
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        paths = []
+        for entry in entries:
+            if entry.startswith("/uploads/") and not os.path.exists(entry):
+                paths.append(os.path.join(script_dir, entry.lstrip("/")))
+            else:
+                paths.append(os.path.join(manifest_dir, entry))
+    else:
+        paths = sorted(path for path in glob.glob(source, recursive=True)
+                       if not os.path.basename(path).startswith("processed_"))
+    
+    return paths
+
+def process_batch_item(image_path):
+    """Process one batch image and wrap the response with its timing."""
+    start = time.perf_counter()
+    result = process_image(image_path)
+    return {
+        "image_path": image_path,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+        "result": result
+    }
+
+def run_batch(source, processes=None, output_stream=sys.stdout):
+    """
+    Process every image in a batch source across a multiprocessing pool.
+
+    One JSON line is written per image as soon as it finishes (so the order follows completion,
+    not the input). Processed tables are still written next to each input image.
+    """
+    import multiprocessing
+
+    image_paths = resolve_batch_inputs(source)
+    processes = processes or os.cpu_count() or 1
+    print(f"Batch processing {len(image_paths)} images with {processes} processes", file=sys.stderr)
+    
+    start = time.perf_counter()
+    failures = 0
+    
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=warm_up)
+        items = pool.imap_unordered(process_batch_item, image_paths)
+    else:
+        warm_up()
+        items = map(process_batch_item, image_paths)
+    
+    try:
+        for item in items:
+            if item["result"].get("error"):
+                failures += 1
+            output_stream.write(json.dumps(item, cls=NumpyEncoder) + "\n")
+            output_stream.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    elapsed = time.perf_counter() - start
+    print(f"Batch finished: {len(image_paths)} images, {failures} failed, {elapsed:.2f}s total", file=sys.stderr)
+
+# Stream mode
+# Follows a venue camera (video file, capture device or image sequence) frame by frame. The table is
+# only re-detected when its felt outline moves, and balls are tracked from their previous positions
+# inside small search windows. When a ball is lost only the changed regions are re-segmented, and the
+# whole table is re-segmented on keyframes.
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v")
+STREAM_KEYFRAME_INTERVAL = 150   # Full ball detection at least this often, in frames
+TABLE_CHECK_WIDTH = 160          # Width of the thumbnail used to notice the table moving
+TABLE_MOVED_IOU = 0.9            # Felt overlap below this re-runs table detection
+TRACK_SEARCH_RADIUS = 3          # Search window half-size, in ball radii
+
+def iter_frames(source, frame_step=1):
+    """
+    Yield (frame_index, timestamp_ms, frame) from a video file, a capture device number, or an
+    image sequence given the same way as a batch source (directory, glob or manifest).
+    """
+    is_sequence = (os.path.isdir(source) or glob.has_magic(source)
+                   or (os.path.isfile(source) and not source.lower().endswith(VIDEO_EXTENSIONS)))
+    
+    if is_sequence:
+        for index, path in enumerate(resolve_batch_inputs(source)):
+            if index % frame_step:
+                continue
+            frame = cv2.imread(path)
+            if frame is None:
+                print(f"Skipping unreadable frame {path}", file=sys.stderr)
+                continue
+            yield index, None, frame
+        return
+    
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not capture.isOpened():
+        raise IOError(f"Could not open video source {source}")
+    try:
+        index = 0
+        while True:
+            # grab() skips decoding the frames we drop
+            if not capture.grab():
+                break
+            if index % frame_step == 0:
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                yield index, capture.get(cv2.CAP_PROP_POS_MSEC), frame
+            index += 1
+    finally:
+        capture.release()
+
+class FrameTracker:
+    """
+    Carries table bounds, the image -> game homography and ball positions from one frame to the next.
+    """
+
+    def __init__(self, keyframe_interval=STREAM_KEYFRAME_INTERVAL, venue=None):
+        self.keyframe_interval = keyframe_interval
+        self.venue = venue if venue is not None else get_venue_profile()
+        self.game_width = self.venue.game_width
+        self.game_height = self.venue.game_height
+        self.table_bounds = None
+        self.table_signature = None
+        self.felt_hull = None
+        self.homography = None
+        self.balls = np.empty(0, dtype=BALL_DTYPE)
+        self.previous_frame = None
+        self.frames_since_detection = 0
+        self.class_ids = {ball_color_id(color): class_id
+                          for class_id, (color, _) in enumerate(self.venue.ball_color_classes, start=1)}
+        self.debug = NullDebugSink()
+
+    def felt_signature(self, frame):
+        """Low-resolution felt mask, cheap enough to compare every frame."""
+        height, width = frame.shape[:2]
+        thumbnail_height = max(1, int(round(height * TABLE_CHECK_WIDTH / width)))
+        thumbnail = cv2.resize(frame, (TABLE_CHECK_WIDTH, thumbnail_height), interpolation=cv2.INTER_NEAREST)
+        return table_green_mask(thumbnail, self.venue.table_green_ranges) > 0
+
+    def table_moved(self, signature):
+        if self.table_signature is None or signature.shape != self.table_signature.shape:
+            return True
+        union = np.count_nonzero(signature | self.table_signature)
+        if union == 0:
+            return False
+        return np.count_nonzero(signature & self.table_signature) / union < TABLE_MOVED_IOU
+
+    def track_ball(self, frame, ball):
+        """Find a ball record near its previous position. Returns its new (x, y), or None if it was lost."""
+        class_id = self.class_ids.get(int(ball["color"]))
+        if class_id is None:
+            return None
+        
+        radius = max(float(ball["radius"]), 4)
+        reach = int(radius * TRACK_SEARCH_RADIUS)
+        ball_x, ball_y = int(ball["x"]), int(ball["y"])
+        x0, y0 = max(0, ball_x - reach), max(0, ball_y - reach)
+        x1, y1 = min(frame.shape[1], ball_x + reach + 1), min(frame.shape[0], ball_y + reach + 1)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        
+        labels = classify_hsv_classes(cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_BGR2HSV), self.venue.class_luts)
+        mask = class_mask(labels, class_id)
+        count, _, stats, centroids = cv2.connectedComponentsWithStats(mask)
+        
+        # Same area limits as detect_balls; take the blob closest to where the ball was
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        min_area, max_area = self.venue.ball_area_range
+        candidates = np.flatnonzero((areas >= min_area) & (areas <= max_area)) + 1
+        if candidates.size == 0:
+            return None
+        offsets = centroids[candidates] + [x0, y0] - [ball_x, ball_y]
+        nearest = candidates[np.argmin(np.hypot(offsets[:, 0], offsets[:, 1]))]
+        
+        cx, cy = centroids[nearest]
+        return int(x0 + cx), int(y0 + cy)
+
+    def track_balls(self, frame):
+        """Track every ball in its window. Returns None when any ball is lost or two collapse together."""
+        tracked = self.balls.copy()
+        for index in np.flatnonzero(~tracked["synthetic"]):
+            position = self.track_ball(frame, tracked[index])
+            if position is None:
+                return None
+            tracked["x"][index], tracked["y"][index] = position
+        
+        real = tracked[~tracked["synthetic"]]
+        if len(real) > 1:
+            positions = np.column_stack((real["x"], real["y"])).astype(np.float64)
+            if find_close_pairs(positions, self.venue.ball_radius)[0].size:
+                return None
+        return tracked
+
+    def process_frame(self, frame):
+        """Update the tracked state from one frame and return its mapped ball positions plus what ran."""
+        table_redetected = False
+        context = ImageContext(frame)
+        signature = self.felt_signature(frame)
+        if self.table_moved(signature):
+            self.table_bounds = detect_table_bounds(frame, self.debug, venue=self.venue, context=context)
+            self.felt_hull = (context.felt_hull, context.felt_hull_margin)
+            self.table_signature = signature
+            self.homography = TableHomography.from_table_bounds(self.table_bounds, self.game_width, self.game_height)
+            table_redetected = True
+        else:
+            # The table hasn't moved, so neither has its felt outline
+            context.felt_hull, context.felt_hull_margin = self.felt_hull
+        
+        detection = "full"
+        if not table_redetected and len(self.balls) and self.frames_since_detection < self.keyframe_interval:
+            tracked = self.track_balls(frame)
+            if tracked is not None:
+                self.balls = tracked
+                detection = "tracked"
+            else:
+                # Something moved too far to track; re-segment just the parts of the table that changed
+                self.balls = detect_balls_incremental(frame, self.previous_frame, self.balls, self.table_bounds,
+                                                      self.debug, venue=self.venue, context=context)
+                detection = "incremental"
+            self.frames_since_detection += 1
+        else:
+            self.balls = detect_balls(frame, self.table_bounds, self.debug, venue=self.venue, context=context)
+            self.frames_since_detection = 0
+        self.previous_frame = frame
+        
+        ball_positions = map_ball_positions(self.balls, self.table_bounds, self.game_width, self.game_height,
+                                            homography=self.homography, venue=self.venue)
+        return {
+            "ball_positions": ball_positions_json(ball_positions),
+            "table_bounds": self.table_bounds,
+            "table_redetected": table_redetected,
+            "detection": detection
+        }
+
+def run_stream(source, output_stream=sys.stdout, keyframe_interval=STREAM_KEYFRAME_INTERVAL, frame_step=1):
+    """Track balls through a frame source, writing one JSON line of mapped ball positions per frame."""
+    warm_up()
+    tracker = FrameTracker(keyframe_interval)
+    
+    start = time.perf_counter()
+    frames = full_detections = 0
+    for index, timestamp_ms, frame in iter_frames(source, frame_step):
+        frame_start = time.perf_counter()
+        try:
+            line = {"frame": index, **tracker.process_frame(frame)}
+            full_detections += line["detection"] == "full"
+        except Exception as e:
+            line = {"frame": index, "error": f"Error processing frame: {str(e)}"}
+        if timestamp_ms is not None:
+            line["timestamp_ms"] = round(timestamp_ms, 2)
+        line["elapsed_ms"] = round((time.perf_counter() - frame_start) * 1000, 2)
+        
+        output_stream.write(json.dumps(line, cls=NumpyEncoder) + "\n")
+        output_stream.flush()
+        frames += 1
+    
+    elapsed = time.perf_counter() - start
+    fps = frames / elapsed if elapsed > 0 else 0
+    print(f"Stream finished: {frames} frames, {full_detections} full detections, {fps:.1f} fps", file=sys.stderr)
+
+def parse_args(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Detect pool balls in a table image.")
+    parser.add_argument("image_path", nargs="?", help="Image to process")
+    parser.add_argument("--worker", action="store_true",
+                        help="Stay alive and process newline-delimited JSON jobs from stdin")
+    parser.add_argument("--socket", dest="socket_path",
+                        help="Stay alive and process jobs from a local Unix socket at this path")
+    parser.add_argument("--frames", choices=FRAME_ENCODINGS,
+                        help="Answer worker/socket jobs with length-prefixed frames in this encoding "
+                             "instead of JSON lines")
+    parser.add_argument("--batch", dest="batch_source",
+                        help="Process a directory, glob pattern or manifest file and stream one JSON line per image")
+    parser.add_argument("--processes", type=int,
+                        help="Number of batch worker processes (default: one per CPU)")
+    parser.add_argument("--stream", dest="stream_source",
+                        help="Track balls through a video file, capture device number or image sequence, "
+                             "writing one JSON line per frame")
+    parser.add_argument("--keyframe-interval", type=int, default=STREAM_KEYFRAME_INTERVAL,
+                        help="Re-segment the whole table at least this often in stream mode (frames)")
+    parser.add_argument("--frame-step", type=int, default=1,
+                        help="Only process every Nth frame in stream mode")
+    parser.add_argument("--debug-mode", choices=DEBUG_MODES,
+                        help="Where debug images go (default: $POOL_DEBUG_MODE or shared)")
+    parser.add_argument("--timings", action="store_true",
+                        help="Add per-stage wall/CPU time and memory to each response")
+    parser.add_argument("--profile-dir",
+                        help="Dump a cProfile file per request into this directory")
+    parser.add_argument("--detector", choices=sorted(BALL_DETECTORS),
+                        help="Ball detection engine (default: $POOL_BALL_DETECTOR or contour)")
+    parser.add_argument("--venue",
+                        help="Venue profile to use, from venues/ (default: $POOL_VENUE or default)")
+    parser.add_argument("--camera-id",
+                        help="Fixed camera the image came from; reuses (or creates) its table calibration")
+    parser.add_argument("--decode-max-dim", type=int,
+                        help="Decode large JPEGs at 1/2, 1/4 or 1/8 scale while keeping this many pixels "
+                             "on the longer side (default: $POOL_DECODE_MAX_DIM or 0 for full resolution)")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    args = parse_args(sys.argv[1:])
+    if args.debug_mode:
+        # Becomes the default for every request this process handles
+        os.environ["POOL_DEBUG_MODE"] = args.debug_mode
+    if args.timings:
+        os.environ["POOL_TIMINGS"] = "on"
+    if args.profile_dir:
+        os.environ["POOL_PROFILE_DIR"] = args.profile_dir
+    if args.decode_max_dim is not None:
+        os.environ["POOL_DECODE_MAX_DIM"] = str(args.decode_max_dim)
+    if args.detector:
+        os.environ["POOL_BALL_DETECTOR"] = args.detector
+    if args.venue:
+        os.environ["POOL_VENUE"] = args.venue
+
+    if args.batch_source:
+        # Thousands of archive images would only churn the shared debug folder
+        os.environ.setdefault("POOL_DEBUG_MODE", "off")
+        run_batch(args.batch_source, args.processes)
+    elif args.stream_source:
+        run_stream(args.stream_source, keyframe_interval=args.keyframe_interval, frame_step=args.frame_step)
+    elif args.socket_path:
+        serve_unix_socket(args.socket_path, args.frames)
+    elif args.worker:
+        run_worker(frames=args.frames)
+    elif not args.image_path:
         print(json.dumps({"error": "No image path provided"}))
         sys.exit(1)
-
-    image_path = sys.argv[1]
-    process_image(image_path)
\ No newline at end of file
+    else:
+        # Use the custom encoder to handle NumPy types
+        print(json.dumps(process_image(args.image_path, camera_id=args.camera_id), cls=NumpyEncoder))
+        flush_debug_writes()
\ No newline at end of file
@@ -1,9 +1,10 @@
 const express = require('express');
 const multer = require('multer');
-const { PythonShell } = require('python-shell');
 const path = require('path');
 const db = require('../models/db');
 const fs = require('fs');
+const pythonWorkerPool = require('../services/pythonWorkerPool');
+const imageJobQueue = require('../services/imageJobQueue');
 
 const router = express.Router();
 
@@ -271,50 +272,28 @@ router.post('/process', async (req, res) => {
     console.warn(`⚠️ Large file detected (${(stats.size / 1024 / 1024).toFixed(2)}MB). Processing may take longer.`);
   }
 
-  // Configure Python options with increased timeout
-  const options = {
-    args: [absoluteImagePath],
-    pythonOptions: ['-u'],  
-    mode: 'text',
-    pythonPath: 'python',  // use 'python3' if that's your system's Python 3 command
-    scriptPath: path.join(__dirname, '../'),  // Ensure correct script path
-    timeout: 60000  // 60 seconds timeout
-  };
-
   let output = [];
   let errorOutput = [];
 
   try {
-    console.log('🐍 Starting Python script with options:', JSON.stringify(options));
-    let pyshell = new PythonShell('process_image.py', options);
-
-    pyshell.on('message', (message) => {
-      try {
-        console.log('🐍 Python Output received:', message.substring(0, 200) + '...');
-        output.push(message);
-      } catch (err) {
-        console.error('❌ Error processing Python output:', err);
-        errorOutput.push(`Error processing output: ${err.message}`);
-      }
-    });
-
-    pyshell.on('stderr', (stderr) => {
-      console.error('❌ Python Error:', stderr);
-      errorOutput.push(stderr);
-    });
-
-    await new Promise((resolve, reject) => {
-      pyshell.end((err, code, signal) => {
-        if (err) {
-          console.error('❌ PythonShell error:', err);
-          errorOutput.push(`PythonShell error: ${err.message}`);
-          reject(err);
-        } else {
-          console.log('✅ Python script finished with exit code:', code);
-          resolve();
-        }
+    // Hand the job to a warm Python worker instead of starting a new interpreter
+    console.log('🐍 Sending image to Python worker pool');
+    try {
+      const { result, stderr } = await pythonWorkerPool.run({
+        image_path: absoluteImagePath,
+        timings: req.body.timings === true || undefined, // falls back to POOL_TIMINGS in the worker
+        detector: req.body.detector || undefined, // falls back to POOL_BALL_DETECTOR in the worker
+        venue: req.body.venue || undefined, // falls back to POOL_VENUE in the worker
+        camera_id: req.body.camera_id || undefined // fixed cameras reuse their table calibration
       });
-    });
+      errorOutput.push(...stderr);
+      output.push(JSON.stringify(result));
+    } catch (err) {
+      console.error('❌ Python worker error:', err);
+      errorOutput.push(...(err.stderr || []), `Python worker error: ${err.message}`);
+      throw err;
+    }
+    console.log('✅ Python worker finished processing');
 
     if (output.length === 0) {
       console.error('❌ No output from Python script. Error output:', errorOutput);
@@ -354,10 +333,18 @@ router.post('/process', async (req, res) => {
         ball_positions: parsedResult.ball_positions || [],
         original_dimensions: parsedResult.original_dimensions || null,
         table_bounds: parsedResult.table_bounds || null,
+        detector: parsedResult.detector || null,
+        venue: parsedResult.venue || null,
+        calibration: parsedResult.calibration || null,
         synthetic_ball_count: syntheticBalls.length,
         processing_time_ms: console.timeEnd('image-processing')
       };
 
+      // Per-stage Python timings, only present when requested
+      if (parsedResult.timings) {
+        response.timings = parsedResult.timings;
+      }
+
       res.json(response);
     } catch (parseError) {
       console.error('❌ Failed to parse Python response:', parseError);
@@ -404,6 +391,126 @@ router.post('/process', async (req, res) => {
   }
 });
 
+// Status of a queued job, with the result in the same shape /process returns once it completes
+const formatJob = (job) => {
+  const response = {
+    job_id: job.id,
+    status: job.status,
+    progress: job.progress,
+    created_at: job.createdAt,
+    started_at: job.startedAt,
+    finished_at: job.finishedAt
+  };
+
+  if (job.status === 'completed') {
+    const ballPositions = job.result.ball_positions || [];
+    response.result = {
+      message: 'Image processed successfully',
+      transformed_image_url: job.result.image_url,
+      ball_positions: ballPositions,
+      original_dimensions: job.result.original_dimensions || null,
+      table_bounds: job.result.table_bounds || null,
+      detector: job.result.detector || null,
+      venue: job.result.venue || null,
+      calibration: job.result.calibration || null,
+      synthetic_ball_count: ballPositions.filter(ball => ball.synthetic).length
+    };
+    if (job.result.timings) {
+      response.result.timings = job.result.timings;
+    }
+  } else if (job.status === 'failed') {
+    response.error = 'Error processing image: ' + job.error;
+  }
+
+  return response;
+};
+
+// Queue an image for processing and return a job id straight away
+router.post('/jobs', (req, res) => {
+  const { image_path } = req.body;
+  if (!image_path || image_path === 'undefined') {
+    console.error('❌ Invalid image path received:', image_path);
+    return res.status(400).json({ error: 'Invalid image path received.' });
+  }
+
+  const absoluteImagePath = path.join(__dirname, '../', image_path);
+  if (!fs.existsSync(absoluteImagePath)) {
+    console.error('❌ File does not exist at path:', absoluteImagePath);
+    return res.status(404).json({ error: 'Image file not found at the specified path.' });
+  }
+
+  try {
+    const job = imageJobQueue.submit({
+      image_path: absoluteImagePath,
+      timings: req.body.timings === true || undefined,
+      detector: req.body.detector || undefined,
+      venue: req.body.venue || undefined,
+      camera_id: req.body.camera_id || undefined
+    });
+    console.log(`✅ Queued image processing job ${job.id}`);
+
+    res.status(202)
+      .location(`/api/image/jobs/${job.id}`)
+      .json({
+        job_id: job.id,
+        status: job.status,
+        status_url: `/api/image/jobs/${job.id}`,
+        events_url: `/api/image/jobs/${job.id}/events`
+      });
+  } catch (error) {
+    console.error('❌ Could not queue image processing job:', error.message);
+    res.status(error.statusCode || 500).json({ error: error.message });
+  }
+});
+
+// Poll a job's status, progress and (once finished) result
+router.get('/jobs/:id', (req, res) => {
+  const job = imageJobQueue.get(req.params.id);
+  if (!job) {
+    return res.status(404).json({ error: 'Job not found or expired.' });
+  }
+  res.json(formatJob(job));
+});
+
+// Stream a job's progress as server-sent events until it finishes
+router.get('/jobs/:id/events', (req, res) => {
+  const job = imageJobQueue.get(req.params.id);
+  if (!job) {
+    return res.status(404).json({ error: 'Job not found or expired.' });
+  }
+
+  res.set({
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+    Connection: 'keep-alive'
+  });
+  res.flushHeaders && res.flushHeaders();
+
+  const send = (event, data) => res.write(`event: ${event}\ndata: ${JSON.stringify(data)}\n\n`);
+  const finish = () => {
+    send('done', formatJob(imageJobQueue.get(job.id)));
+    res.end();
+  };
+
+  // Replay what already happened, then follow live updates
+  job.progress.forEach(event => send('progress', { job_id: job.id, type: 'progress', ...event }));
+  if (job.status === 'completed' || job.status === 'failed') {
+    return finish();
+  }
+
+  const unsubscribe = imageJobQueue.subscribe(job.id, (event) => {
+    if (event.type === 'progress') {
+      send('progress', event);
+    } else if (event.status === 'completed' || event.status === 'failed') {
+      unsubscribe();
+      finish();
+    } else {
+      send('status', event);
+    }
+  });
+  req.on('close', unsubscribe);
+});
+
 // New endpoint to get debug information
 router.get('/debug', async (req, res) => {
   try {
@@ -501,7 +608,7 @@ router.post('/reprocess', async (req, res) => {
       return res.status(404).json({ error: 'Image not found for reprocessing' });
     }
 
-    // Clear existing debug files for this image
+    // Clear existing debug files for this image, including its per-request debug folder
     const debugDir = path.join(__dirname, '../debug');
     if (fs.existsSync(debugDir)) {
       const basename = path.basename(image_path, path.extname(image_path));
@@ -509,7 +616,7 @@ router.post('/reprocess', async (req, res) => {
         .filter(file => file.includes(basename));
 
       for (const file of relatedDebugFiles) {
-        fs.unlinkSync(path.join(debugDir, file));
+        fs.rmSync(path.join(debugDir, file), { recursive: true, force: true });
       }
     }
 
@@ -614,37 +721,11 @@ router.post('/reprocess', async (req, res) => {
     }
 
     // Normal process endpoint logic
-    const options = {
-      args: [absoluteImagePath],
-      pythonOptions: ['-u'],
-      mode: 'text',
-      pythonPath: 'python',
-      scriptPath: path.join(__dirname, '../'),
-      timeout: 60000
-    };
-
-    let output = [];
-    let errorOutput = [];
-
-    let pyshell = new PythonShell('process_image.py', options);
-
-    pyshell.on('message', (message) => {
-      output.push(message);
-    });
-
-    pyshell.on('stderr', (stderr) => {
-      errorOutput.push(stderr);
-    });
-
-    await new Promise((resolve, reject) => {
-      pyshell.end((err, code, signal) => {
-        if (err) {
-          reject(err);
-        } else {
-          resolve();
-        }
-      });
+    const { result } = await pythonWorkerPool.run({
+      image_path: absoluteImagePath,
+      use_cache: false // reprocessing means running the pipeline again, not replaying the cached result
     });
+    let output = [JSON.stringify(result)];
 
     if (output.length === 0) {
       throw new Error(`No output from Python script during reprocessing`);
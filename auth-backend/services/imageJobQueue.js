@@ -0,0 +1,113 @@
+const crypto = require('crypto');
+const { EventEmitter } = require('events');
+const pythonWorkerPool = require('./pythonWorkerPool');
+
+// Asynchronous image-processing jobs on top of the Python worker pool.
+// Submitting returns a job id straight away; the pool bounds how many images are processed at
+// once, and admission control turns work away (rather than queueing forever) once too many jobs
+// are waiting. Finished jobs are kept for a TTL so clients can poll for the result.
+class ImageJobQueue {
+  constructor(options = {}) {
+    this.pool = options.pool || pythonWorkerPool;
+    this.maxPending = options.maxPending || parseInt(process.env.IMAGE_JOB_MAX_PENDING, 10) || 20;
+    this.resultTtl = options.resultTtl || parseInt(process.env.IMAGE_JOB_RESULT_TTL_MS, 10) || 10 * 60 * 1000; // 10 minutes
+    this.jobs = new Map();
+    this.events = new EventEmitter();
+    this.events.setMaxListeners(0);
+  }
+
+  // Number of submitted jobs that haven't finished yet
+  get pending() {
+    let count = 0;
+    for (const job of this.jobs.values()) {
+      if (job.status === 'queued' || job.status === 'running') {
+        count++;
+      }
+    }
+    return count;
+  }
+
+  // Queue an image; returns the job snapshot, or throws a 429 error when the queue is full
+  submit(payload) {
+    if (this.pending >= this.maxPending) {
+      const error = new Error(`Too many images are being processed (${this.maxPending} pending). Try again shortly.`);
+      error.statusCode = 429;
+      throw error;
+    }
+
+    const job = {
+      id: crypto.randomUUID(),
+      status: 'queued',
+      progress: [],
+      result: null,
+      error: null,
+      createdAt: new Date().toISOString(),
+      startedAt: null,
+      finishedAt: null,
+      expiryTimer: null
+    };
+    this.jobs.set(job.id, job);
+
+    this.pool.run(payload, {
+      onStart: () => {
+        job.status = 'running';
+        job.startedAt = new Date().toISOString();
+        this._publish(job, { type: 'status', status: job.status });
+      },
+      onProgress: (event) => {
+        job.progress.push({ ...event, at: new Date().toISOString() });
+        this._publish(job, { type: 'progress', ...event });
+      }
+    })
+      .then(({ result }) => {
+        if (result && result.error) {
+          this._finish(job, 'failed', null, result.error);
+        } else {
+          this._finish(job, 'completed', result, null);
+        }
+      })
+      .catch((err) => {
+        this._finish(job, 'failed', null, err.message);
+      });
+
+    return this.get(job.id);
+  }
+
+  // Public view of a job, or null if it never existed or has expired
+  get(id) {
+    const job = this.jobs.get(id);
+    if (!job) {
+      return null;
+    }
+    const { expiryTimer, ...snapshot } = job;
+    return snapshot;
+  }
+
+  // Call listener(event) for every update to a job until it finishes; returns an unsubscribe function
+  subscribe(id, listener) {
+    const channel = `job:${id}`;
+    this.events.on(channel, listener);
+    return () => this.events.removeListener(channel, listener);
+  }
+
+  _publish(job, event) {
+    this.events.emit(`job:${job.id}`, { job_id: job.id, ...event });
+  }
+
+  _finish(job, status, result, error) {
+    job.status = status;
+    job.result = result;
+    job.error = error;
+    job.finishedAt = new Date().toISOString();
+    this._publish(job, { type: 'status', status, error });
+
+    // Keep the result around for polling, then forget it
+    job.expiryTimer = setTimeout(() => this.jobs.delete(job.id), this.resultTtl);
+    if (job.expiryTimer.unref) {
+      job.expiryTimer.unref();
+    }
+  }
+}
+
+module.exports = new ImageJobQueue();
+module.exports.ImageJobQueue = ImageJobQueue;
@@ -0,0 +1,197 @@
+const { PythonShell } = require('python-shell');
+const path = require('path');
+
+// Workers answer with length-prefixed frames (`--frames`, see FrameWriter in process_image.py):
+// a 4-byte big-endian payload length, a 1-byte channel, then the payload. Messages (progress and
+// results) and log lines travel on separate channels, so a stray print can't corrupt a result.
+const FRAME_HEADER_BYTES = 5;
+const FRAME_MESSAGE = 1;
+const FRAME_LOG = 2;
+
+// Payload decoders by encoding; MessagePack needs the optional @msgpack/msgpack package
+const PAYLOAD_DECODERS = {
+  json: () => (payload) => JSON.parse(payload.toString('utf8')),
+  msgpack: () => {
+    try {
+      return require('@msgpack/msgpack').decode;
+    } catch (err) {
+      throw new Error('The msgpack worker encoding needs the @msgpack/msgpack package (npm install @msgpack/msgpack)');
+    }
+  }
+};
+
+// Splits a byte stream into frames, however the chunks happen to be cut
+class FrameDecoder {
+  constructor(onFrame) {
+    this.onFrame = onFrame;
+    this.buffer = Buffer.alloc(0);
+  }
+
+  push(chunk) {
+    this.buffer = this.buffer.length > 0 ? Buffer.concat([this.buffer, chunk]) : chunk;
+    while (this.buffer.length >= FRAME_HEADER_BYTES) {
+      const end = FRAME_HEADER_BYTES + this.buffer.readUInt32BE(0);
+      if (this.buffer.length < end) {
+        return;
+      }
+      const channel = this.buffer.readUInt8(4);
+      const payload = this.buffer.subarray(FRAME_HEADER_BYTES, end);
+      this.buffer = this.buffer.subarray(end);
+      this.onFrame(channel, payload);
+    }
+  }
+}
+
+// Small pool of long-lived `process_image.py --worker` processes.
+// Each worker keeps the interpreter, cv2/numpy and any precomputed state warm,
+// and handles one newline-delimited JSON job at a time, answering in frames.
+class PythonWorkerPool {
+  constructor(options = {}) {
+    this.size = options.size || parseInt(process.env.PYTHON_WORKER_POOL_SIZE, 10) || 2;
+    this.jobTimeout = options.jobTimeout || 60000; // 60 seconds per job
+    this.scriptPath = options.scriptPath || path.join(__dirname, '../');
+    this.pythonPath = options.pythonPath || 'python'; // use 'python3' if that's your system's Python 3 command
+    this.encoding = options.encoding || process.env.PYTHON_WORKER_ENCODING || 'json'; // or 'msgpack'
+    if (!PAYLOAD_DECODERS[this.encoding]) {
+      throw new Error(`Unknown Python worker encoding '${this.encoding}' (expected json or msgpack)`);
+    }
+    this.decodePayload = PAYLOAD_DECODERS[this.encoding]();
+    this.workers = [];
+    this.queue = [];
+    this.nextJobId = 1;
+  }
+
+  // Queue a job and resolve with { result, stderr } once a worker answers it.
+  // Optional hooks: onStart() when a worker picks the job up, onProgress(event) for each
+  // stage the worker reports (asking for progress messages turns them on in the worker).
+  run(payload, hooks = {}) {
+    return new Promise((resolve, reject) => {
+      if (hooks.onProgress) {
+        payload = { ...payload, progress: true };
+      }
+      this.queue.push({ id: this.nextJobId++, payload, hooks, resolve, reject, stderr: [] });
+      this._dispatch();
+    });
+  }
+
+  // Jobs waiting for a free worker plus jobs currently running
+  get pending() {
+    return this.queue.length + this.workers.filter(w => w.job).length;
+  }
+
+  _spawnWorker() {
+    const worker = { shell: null, job: null, retire: null };
+
+    worker.shell = new PythonShell('process_image.py', {
+      args: ['--worker', '--frames', this.encoding],
+      pythonOptions: ['-u'],
+      mode: 'binary',
+      pythonPath: this.pythonPath,
+      scriptPath: this.scriptPath
+    });
+
+    const decoder = new FrameDecoder((channel, payload) => {
+      let parsed;
+      try {
+        parsed = this.decodePayload(payload);
+      } catch (err) {
+        console.error('❌ Undecodable Python worker frame:', err.message);
+        return;
+      }
+
+      if (channel === FRAME_LOG) {
+        this._log(worker, parsed.message);
+      } else if (channel === FRAME_MESSAGE) {
+        this._handleMessage(worker, parsed);
+      }
+    });
+    worker.shell.stdout.on('data', (chunk) => decoder.push(chunk));
+
+    // Native libraries can still write straight to stderr
+    worker.shell.on('stderr', (stderr) => this._log(worker, stderr));
+
+    worker.retire = (err) => {
+      if (!this.workers.includes(worker)) {
+        return;
+      }
+      this.workers = this.workers.filter(w => w !== worker);
+
+      const job = worker.job;
+      worker.job = null;
+      if (job) {
+        clearTimeout(job.timer);
+        const error = err || new Error('Python worker exited unexpectedly');
+        error.stderr = job.stderr;
+        job.reject(error);
+      }
+      this._dispatch();
+    };
+
+    worker.shell.on('error', worker.retire);
+    worker.shell.on('pythonError', worker.retire);
+    worker.shell.on('close', () => worker.retire());
+
+    this.workers.push(worker);
+    return worker;
+  }
+
+  // A progress or result message from a worker
+  _handleMessage(worker, message) {
+    const job = worker.job;
+    if (!job || message.id !== job.id) {
+      console.error('❌ Python worker answered an unknown job:', message.id);
+      return;
+    }
+
+    if (message.progress) {
+      job.hooks.onProgress && job.hooks.onProgress(message.progress);
+      return;
+    }
+
+    clearTimeout(job.timer);
+    worker.job = null;
+    job.resolve({ result: message.result, stderr: job.stderr });
+    this._dispatch();
+  }
+
+  // A log line from a worker, kept with the job it was printed during
+  _log(worker, line) {
+    if (worker.job) {
+      worker.job.stderr.push(line);
+    }
+    console.error('🐍 Python worker:', line);
+  }
+
+  _dispatch() {
+    while (this.queue.length > 0) {
+      let worker = this.workers.find(w => !w.job);
+      if (!worker) {
+        if (this.workers.length >= this.size) {
+          return;
+        }
+        worker = this._spawnWorker();
+      }
+
+      const job = this.queue.shift();
+      worker.job = job;
+      job.timer = setTimeout(() => {
+        worker.retire(new Error(`Python worker timed out after ${this.jobTimeout}ms`));
+        worker.shell.kill();
+      }, this.jobTimeout);
+
+      worker.shell.send(JSON.stringify({ id: job.id, ...job.payload }) + '\n');
+      job.hooks.onStart && job.hooks.onStart();
+    }
+  }
+
+  shutdown() {
+    for (const worker of this.workers) {
+      worker.shell.end(() => {});
+    }
+    this.workers = [];
+  }
+}
+
+module.exports = new PythonWorkerPool();
+module.exports.PythonWorkerPool = PythonWorkerPool;
+module.exports.FrameDecoder = FrameDecoder;
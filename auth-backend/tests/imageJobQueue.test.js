@@ -0,0 +1,93 @@
+// Mock the worker pool so the queue never starts Python
+jest.mock('../services/pythonWorkerPool', () => ({
+  run: jest.fn()
+}));
+
+const { ImageJobQueue } = require('../services/imageJobQueue');
+
+// Fake pool whose jobs are finished by hand from the test
+class MockPool {
+  constructor() {
+    this.jobs = [];
+  }
+
+  run(payload, hooks) {
+    return new Promise((resolve, reject) => {
+      this.jobs.push({ payload, hooks, resolve, reject });
+    });
+  }
+}
+
+// Let promise callbacks run
+const flush = () => new Promise(resolve => setImmediate(resolve));
+
+describe('ImageJobQueue', () => {
+  let pool;
+  let queue;
+
+  beforeEach(() => {
+    pool = new MockPool();
+    queue = new ImageJobQueue({ pool, maxPending: 2, resultTtl: 50 });
+  });
+
+  test('should return a queued job straight away and complete it with the worker result', async () => {
+    const job = queue.submit({ image_path: '/uploads/test-image.jpg' });
+
+    expect(job.status).toBe('queued');
+    expect(job.id).toBeDefined();
+    expect(pool.jobs[0].payload).toHaveProperty('image_path', '/uploads/test-image.jpg');
+
+    pool.jobs[0].hooks.onStart();
+    expect(queue.get(job.id).status).toBe('running');
+
+    pool.jobs[0].resolve({ result: { image_url: '/uploads/processed_test-image.jpg', ball_positions: [] }, stderr: [] });
+    await flush();
+
+    const finished = queue.get(job.id);
+    expect(finished.status).toBe('completed');
+    expect(finished.result).toHaveProperty('image_url', '/uploads/processed_test-image.jpg');
+  });
+
+  test('should record progress events and publish them to subscribers', async () => {
+    const job = queue.submit({ image_path: '/uploads/test-image.jpg' });
+    const events = [];
+    queue.subscribe(job.id, event => events.push(event));
+
+    pool.jobs[0].hooks.onProgress({ stage: 'table_found' });
+    pool.jobs[0].hooks.onProgress({ stage: 'balls_detected', balls: 16 });
+
+    expect(queue.get(job.id).progress).toHaveLength(2);
+    expect(events[1]).toHaveProperty('stage', 'balls_detected');
+    expect(events[1]).toHaveProperty('type', 'progress');
+  });
+
+  test('should reject submissions once too many jobs are pending', () => {
+    queue.submit({ image_path: '/uploads/one.jpg' });
+    queue.submit({ image_path: '/uploads/two.jpg' });
+
+    let error;
+    try {
+      queue.submit({ image_path: '/uploads/three.jpg' });
+    } catch (err) {
+      error = err;
+    }
+
+    expect(error).toBeDefined();
+    expect(error.statusCode).toBe(429);
+    expect(pool.jobs).toHaveLength(2);
+  });
+
+  test('should mark failed jobs and forget them after the TTL', async () => {
+    const job = queue.submit({ image_path: '/uploads/test-image.jpg' });
+
+    pool.jobs[0].resolve({ result: { error: 'Image not found' }, stderr: [] });
+    await flush();
+
+    expect(queue.get(job.id).status).toBe('failed');
+    expect(queue.get(job.id).error).toBe('Image not found');
+    expect(queue.pending).toBe(0);
+
+    await new Promise(resolve => setTimeout(resolve, 80));
+    expect(queue.get(job.id)).toBeNull();
+  });
+});
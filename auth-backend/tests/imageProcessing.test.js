@@ -66,13 +66,9 @@ jest.mock('fs', () => ({
   readdirSync: jest.fn().mockReturnValue(['debug1.jpg', 'debug2.jpg'])
 }));
 
-// Mock multer with the proper structure
+// Mock multer with the proper structure (diskStorage is a static, called when the routes load)
 jest.mock('multer', () => {
-  return jest.fn().mockImplementation(() => ({
-    diskStorage: jest.fn().mockReturnValue({
-      destination: jest.fn(),
-      filename: jest.fn()
-    }),
+  const multer = jest.fn().mockImplementation(() => ({
     single: jest.fn().mockReturnValue((req, res, next) => {
       req.file = {
         filename: 'test-image.jpg',
@@ -83,13 +79,57 @@ jest.mock('multer', () => {
       next();
     })
   }));
+  multer.diskStorage = jest.fn().mockReturnValue({
+    destination: jest.fn(),
+    filename: jest.fn()
+  });
+  return multer;
 });
 
+// Mock the asynchronous job queue behind /jobs
+jest.mock('../services/imageJobQueue', () => ({
+  submit: jest.fn(),
+  get: jest.fn(),
+  subscribe: jest.fn()
+}));
+
 // Import dependencies after mocking
 const pool = require('../models/db');
 const { PythonShell } = require('python-shell');
+const imageJobQueue = require('../services/imageJobQueue');
 const imageProcessingRoutes = require('../routes/imageProcessing');
 
+// A job snapshot as imageJobQueue.get returns it
+const makeJob = (overrides = {}) => ({
+  id: 'job-1',
+  status: 'queued',
+  progress: [],
+  result: null,
+  error: null,
+  createdAt: '2025-03-01T12:00:00.000Z',
+  startedAt: null,
+  finishedAt: null,
+  ...overrides
+});
+
+const completedResult = {
+  image_url: '/uploads/processed_test-image.jpg',
+  ball_positions: [
+    { color: 'white', x: 100, y: 200, number: null, synthetic: false },
+    { color: 'red', x: 300, y: 150, number: 1, synthetic: true }
+  ],
+  original_dimensions: { width: 1600, height: 1200 },
+  table_bounds: { x: 10, y: 20, width: 1500, height: 750 },
+  detector: { engine: 'contour' },
+  venue: 'default'
+};
+
+// Split a server-sent event stream into { event, data } pairs
+const parseEvents = (text) => text.trim().split('\n\n').map(block => {
+  const [eventLine, dataLine] = block.split('\n');
+  return { event: eventLine.replace('event: ', ''), data: JSON.parse(dataLine.replace('data: ', '')) };
+});
+
 // Create Express app for testing
 const app = express();
 app.use(express.json());
@@ -190,6 +230,207 @@ describe('Image Processing Routes', () => {
     });
   });
 
+  describe('POST /jobs', () => {
+    beforeEach(() => {
+      fs.existsSync.mockReturnValue(true);
+    });
+
+    test('should queue the image and return 202 with the job urls', async () => {
+      imageJobQueue.submit.mockReturnValueOnce(makeJob());
+
+      const response = await request(app)
+        .post('/api/image/jobs')
+        .send({ image_path: '/uploads/test-image.jpg', detector: 'hough', camera_id: 'table-1' });
+
+      expect(response.status).toBe(202);
+      expect(response.headers.location).toBe('/api/image/jobs/job-1');
+      expect(response.body).toEqual({
+        job_id: 'job-1',
+        status: 'queued',
+        status_url: '/api/image/jobs/job-1',
+        events_url: '/api/image/jobs/job-1/events'
+      });
+      expect(imageJobQueue.submit).toHaveBeenCalledTimes(1);
+      expect(imageJobQueue.submit.mock.calls[0][0]).toEqual({
+        image_path: path.join(__dirname, '../', '/uploads/test-image.jpg'),
+        timings: undefined,
+        detector: 'hough',
+        venue: undefined,
+        camera_id: 'table-1'
+      });
+    });
+
+    test('should return 429 when the queue is full', async () => {
+      imageJobQueue.submit.mockImplementationOnce(() => {
+        const error = new Error('Too many images are being processed (20 pending). Try again shortly.');
+        error.statusCode = 429;
+        throw error;
+      });
+
+      const response = await request(app)
+        .post('/api/image/jobs')
+        .send({ image_path: '/uploads/test-image.jpg' });
+
+      expect(response.status).toBe(429);
+      expect(response.body.error).toContain('Too many images are being processed');
+    });
+
+    test('should handle invalid image path', async () => {
+      const response = await request(app)
+        .post('/api/image/jobs')
+        .send({ image_path: '' });
+
+      expect(response.status).toBe(400);
+      expect(response.body.error).toContain('Invalid image path received');
+      expect(imageJobQueue.submit).not.toHaveBeenCalled();
+    });
+
+    test('should handle missing image file', async () => {
+      fs.existsSync.mockReturnValueOnce(false);
+
+      const response = await request(app)
+        .post('/api/image/jobs')
+        .send({ image_path: '/uploads/missing-image.jpg' });
+
+      expect(response.status).toBe(404);
+      expect(response.body.error).toContain('Image file not found');
+      expect(imageJobQueue.submit).not.toHaveBeenCalled();
+    });
+  });
+
+  describe('GET /jobs/:id', () => {
+    test('should return 404 for an unknown or expired job', async () => {
+      imageJobQueue.get.mockReturnValueOnce(null);
+
+      const response = await request(app)
+        .get('/api/image/jobs/missing-job');
+
+      expect(response.status).toBe(404);
+      expect(response.body).toHaveProperty('error', 'Job not found or expired.');
+      expect(imageJobQueue.get).toHaveBeenCalledWith('missing-job');
+    });
+
+    test('should report a running job with its progress', async () => {
+      const progress = [{ stage: 'table_found', table_bounds: completedResult.table_bounds, at: '2025-03-01T12:00:01.000Z' }];
+      imageJobQueue.get.mockReturnValueOnce(makeJob({
+        status: 'running',
+        progress,
+        startedAt: '2025-03-01T12:00:00.500Z'
+      }));
+
+      const response = await request(app)
+        .get('/api/image/jobs/job-1');
+
+      expect(response.status).toBe(200);
+      expect(response.body).toEqual({
+        job_id: 'job-1',
+        status: 'running',
+        progress,
+        created_at: '2025-03-01T12:00:00.000Z',
+        started_at: '2025-03-01T12:00:00.500Z',
+        finished_at: null
+      });
+    });
+
+    test('should return a completed job\'s result in the /process shape', async () => {
+      imageJobQueue.get.mockReturnValueOnce(makeJob({
+        status: 'completed',
+        result: completedResult,
+        finishedAt: '2025-03-01T12:00:02.000Z'
+      }));
+
+      const response = await request(app)
+        .get('/api/image/jobs/job-1');
+
+      expect(response.status).toBe(200);
+      expect(response.body.status).toBe('completed');
+      expect(response.body.result).toEqual({
+        message: 'Image processed successfully',
+        transformed_image_url: '/uploads/processed_test-image.jpg',
+        ball_positions: completedResult.ball_positions,
+        original_dimensions: completedResult.original_dimensions,
+        table_bounds: completedResult.table_bounds,
+        detector: completedResult.detector,
+        venue: 'default',
+        calibration: null,
+        synthetic_ball_count: 1
+      });
+      expect(response.body).not.toHaveProperty('error');
+    });
+
+    test('should report why a job failed', async () => {
+      imageJobQueue.get.mockReturnValueOnce(makeJob({ status: 'failed', error: 'Image not found' }));
+
+      const response = await request(app)
+        .get('/api/image/jobs/job-1');
+
+      expect(response.status).toBe(200);
+      expect(response.body.status).toBe('failed');
+      expect(response.body.error).toBe('Error processing image: Image not found');
+      expect(response.body).not.toHaveProperty('result');
+    });
+  });
+
+  describe('GET /jobs/:id/events', () => {
+    test('should return 404 for an unknown or expired job', async () => {
+      imageJobQueue.get.mockReturnValueOnce(null);
+
+      const response = await request(app)
+        .get('/api/image/jobs/missing-job/events');
+
+      expect(response.status).toBe(404);
+      expect(response.body).toHaveProperty('error', 'Job not found or expired.');
+    });
+
+    test('should replay progress and finish straight away for a finished job', async () => {
+      const job = makeJob({
+        status: 'completed',
+        progress: [{ stage: 'table_found', table_bounds: completedResult.table_bounds, at: '2025-03-01T12:00:01.000Z' }],
+        result: completedResult,
+        finishedAt: '2025-03-01T12:00:02.000Z'
+      });
+      imageJobQueue.get.mockReturnValue(job);
+
+      const response = await request(app)
+        .get('/api/image/jobs/job-1/events');
+
+      expect(response.status).toBe(200);
+      expect(response.headers['content-type']).toContain('text/event-stream');
+      const events = parseEvents(response.text);
+      expect(events.map(event => event.event)).toEqual(['progress', 'done']);
+      expect(events[0].data).toEqual({ job_id: 'job-1', type: 'progress', ...job.progress[0] });
+      expect(events[1].data.status).toBe('completed');
+      expect(events[1].data.result.synthetic_ball_count).toBe(1);
+      expect(imageJobQueue.subscribe).not.toHaveBeenCalled();
+    });
+
+    test('should stream live updates until the job finishes', async () => {
+      const unsubscribe = jest.fn();
+      imageJobQueue.get.mockReturnValue(makeJob({ status: 'queued' }));
+      imageJobQueue.subscribe.mockImplementationOnce((id, listener) => {
+        setImmediate(() => {
+          listener({ job_id: id, type: 'status', status: 'running' });
+          listener({ job_id: id, type: 'progress', stage: 'balls_detected', balls: 2 });
+          imageJobQueue.get.mockReturnValue(makeJob({ status: 'completed', result: completedResult }));
+          listener({ job_id: id, type: 'status', status: 'completed', error: null });
+        });
+        return unsubscribe;
+      });
+
+      const response = await request(app)
+        .get('/api/image/jobs/job-1/events');
+
+      expect(response.status).toBe(200);
+      const events = parseEvents(response.text);
+      expect(events.map(event => event.event)).toEqual(['status', 'progress', 'done']);
+      expect(events[0].data).toEqual({ job_id: 'job-1', type: 'status', status: 'running' });
+      expect(events[1].data).toEqual({ job_id: 'job-1', type: 'progress', stage: 'balls_detected', balls: 2 });
+      expect(events[2].data.result.transformed_image_url).toBe('/uploads/processed_test-image.jpg');
+      expect(imageJobQueue.subscribe.mock.calls[0][0]).toBe('job-1');
+      expect(unsubscribe).toHaveBeenCalled();
+    });
+  });
+
   describe('GET /debug', () => {
     test('should retrieve debug images', async () => {
       const response = await request(app)
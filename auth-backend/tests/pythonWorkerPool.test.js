@@ -0,0 +1,187 @@
+const { EventEmitter } = require('events');
+
+// Encode a message the way `process_image.py --frames json` does: length, channel, payload
+const frame = (channel, message) => {
+  const payload = Buffer.from(JSON.stringify(message));
+  const header = Buffer.alloc(5);
+  header.writeUInt32BE(payload.length, 0);
+  header.writeUInt8(channel, 4);
+  return Buffer.concat([header, payload]);
+};
+
+// Create a mock for a long-lived PythonShell worker
+class MockPythonShell extends EventEmitter {
+  constructor(script, options) {
+    super();
+    this.script = script;
+    this.options = options;
+    this.stdout = new EventEmitter();
+    this.sent = [];
+    this.killed = false;
+  }
+
+  send(message) {
+    this.sent.push(JSON.parse(message));
+    return this;
+  }
+
+  kill() {
+    this.killed = true;
+    this.emit('close');
+    return this;
+  }
+
+  end(callback) {
+    callback && callback();
+    return this;
+  }
+
+  // Helpers to write frames for the last job this worker received
+  reply(result) {
+    const job = this.sent[this.sent.length - 1];
+    this.stdout.emit('data', frame(1, { id: job.id, result }));
+  }
+
+  progress(event) {
+    const job = this.sent[this.sent.length - 1];
+    this.stdout.emit('data', frame(1, { id: job.id, progress: event }));
+  }
+
+  log(message) {
+    this.stdout.emit('data', frame(2, { message }));
+  }
+}
+
+const mockShells = [];
+
+jest.mock('python-shell', () => ({
+  PythonShell: jest.fn().mockImplementation((script, options) => {
+    const shell = new MockPythonShell(script, options);
+    mockShells.push(shell);
+    return shell;
+  })
+}));
+
+const { PythonShell } = require('python-shell');
+const { PythonWorkerPool, FrameDecoder } = require('../services/pythonWorkerPool');
+
+describe('PythonWorkerPool', () => {
+  beforeEach(() => {
+    mockShells.length = 0;
+    jest.clearAllMocks();
+  });
+
+  test('should start workers in --worker mode and resolve job results', async () => {
+    const pool = new PythonWorkerPool({ size: 1 });
+    const pending = pool.run({ image_path: '/uploads/test-image.jpg' });
+
+    expect(PythonShell).toHaveBeenCalledTimes(1);
+    expect(mockShells[0].options.args).toEqual(['--worker', '--frames', 'json']);
+    expect(mockShells[0].options.mode).toBe('binary');
+    expect(mockShells[0].sent[0]).toHaveProperty('image_path', '/uploads/test-image.jpg');
+
+    mockShells[0].emit('stderr', 'Detected counts: white=1, red=0, yellow=0');
+    mockShells[0].reply({ ball_positions: [] });
+
+    const { result, stderr } = await pending;
+    expect(result).toEqual({ ball_positions: [] });
+    expect(stderr).toHaveLength(1);
+  });
+
+  test('should reuse a warm worker and queue jobs beyond the pool size', async () => {
+    const pool = new PythonWorkerPool({ size: 1 });
+    const first = pool.run({ image_path: '/uploads/first.jpg' });
+    const second = pool.run({ image_path: '/uploads/second.jpg' });
+
+    expect(PythonShell).toHaveBeenCalledTimes(1);
+    expect(mockShells[0].sent).toHaveLength(1);
+
+    mockShells[0].reply({ image_url: '/uploads/processed_first.jpg' });
+    await first;
+
+    expect(mockShells[0].sent).toHaveLength(2);
+    mockShells[0].reply({ image_url: '/uploads/processed_second.jpg' });
+
+    const { result } = await second;
+    expect(result).toHaveProperty('image_url', '/uploads/processed_second.jpg');
+    expect(PythonShell).toHaveBeenCalledTimes(1);
+  });
+
+  test('should pass progress messages to the job without resolving it', async () => {
+    const pool = new PythonWorkerPool({ size: 1 });
+    const onStart = jest.fn();
+    const onProgress = jest.fn();
+    const pending = pool.run({ image_path: '/uploads/test-image.jpg' }, { onStart, onProgress });
+
+    expect(onStart).toHaveBeenCalledTimes(1);
+    expect(mockShells[0].sent[0]).toHaveProperty('progress', true);
+
+    mockShells[0].progress({ stage: 'table_found' });
+    expect(onProgress).toHaveBeenCalledWith({ stage: 'table_found' });
+    expect(pool.pending).toBe(1);
+
+    mockShells[0].reply({ ball_positions: [] });
+    const { result } = await pending;
+    expect(result).toEqual({ ball_positions: [] });
+    expect(pool.pending).toBe(0);
+  });
+
+  test('should keep log frames out of the result and attach them to the job', async () => {
+    const pool = new PythonWorkerPool({ size: 1 });
+    const pending = pool.run({ image_path: '/uploads/test-image.jpg' });
+
+    mockShells[0].log('Detected counts: white=1, red=0, yellow=0');
+    mockShells[0].reply({ ball_positions: [] });
+
+    const { result, stderr } = await pending;
+    expect(result).toEqual({ ball_positions: [] });
+    expect(stderr).toEqual(['Detected counts: white=1, red=0, yellow=0']);
+  });
+
+  test('should reassemble frames split across stdout chunks', async () => {
+    const pool = new PythonWorkerPool({ size: 1 });
+    const pending = pool.run({ image_path: '/uploads/test-image.jpg' });
+
+    const job = mockShells[0].sent[0];
+    const bytes = Buffer.concat([
+      frame(2, { message: 'Python worker ready' }),
+      frame(1, { id: job.id, result: { ball_positions: [] } })
+    ]);
+    for (let i = 0; i < bytes.length; i += 3) {
+      mockShells[0].stdout.emit('data', bytes.subarray(i, i + 3));
+    }
+
+    const { result, stderr } = await pending;
+    expect(result).toEqual({ ball_positions: [] });
+    expect(stderr).toEqual(['Python worker ready']);
+  });
+
+  test('should reject an unknown payload encoding', () => {
+    expect(() => new PythonWorkerPool({ encoding: 'xml' })).toThrow('Unknown Python worker encoding');
+  });
+
+  test('should reject the running job when a worker exits', async () => {
+    const pool = new PythonWorkerPool({ size: 1 });
+    const pending = pool.run({ image_path: '/uploads/test-image.jpg' });
+
+    mockShells[0].emit('close');
+
+    await expect(pending).rejects.toThrow('Python worker exited unexpectedly');
+    expect(pool.workers).toHaveLength(0);
+  });
+});
+
+describe('FrameDecoder', () => {
+  test('should emit every complete frame in a chunk and keep the remainder', () => {
+    const frames = [];
+    const decoder = new FrameDecoder((channel, payload) => frames.push([channel, JSON.parse(payload.toString())]));
+
+    const first = frame(1, { id: 1, progress: { stage: 'table_found' } });
+    const second = frame(1, { id: 1, result: {} });
+    decoder.push(Buffer.concat([first, second.subarray(0, 4)]));
+    expect(frames).toHaveLength(1);
+
+    decoder.push(second.subarray(4));
+    expect(frames).toEqual([[1, { id: 1, progress: { stage: 'table_found' } }], [1, { id: 1, result: {} }]]);
+  });
+});
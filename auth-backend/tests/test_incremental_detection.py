@@ -0,0 +1,39 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import process_image as pipeline
+
+TABLE_BOUNDS = {"x": 0, "y": 0, "width": 800, "height": 400}
+
+
+def two_ball_frame(red_x, white_x):
+    """Plain felt with one red and one white ball, as a camera would see it between two shots."""
+    frame = np.full((400, 800, 3), (40, 120, 30), dtype=np.uint8)
+    cv2.circle(frame, (red_x, 200), 12, (0, 0, 220), -1)
+    cv2.circle(frame, (white_x, 200), 12, (245, 245, 245), -1)
+    return frame
+
+
+def positions(balls):
+    return sorted(zip(pipeline.ball_colors(balls), balls["x"].tolist(), balls["y"].tolist()))
+
+
+# The white ball moves from x=300 to x=320; the red one stays put at every offset around the edge of
+# the padded change region, where it used to be reported twice or replaced by a clipped re-detection
+@pytest.mark.parametrize("red_x", range(240, 280))
+def test_incremental_matches_full_detection_around_region_edge(red_x):
+    debug = pipeline.NullDebugSink()
+    before, after = two_ball_frame(red_x, 300), two_ball_frame(red_x, 320)
+    previous_balls = pipeline.detect_balls(before, TABLE_BOUNDS, debug)
+
+    expected = positions(pipeline.detect_balls(after, TABLE_BOUNDS, debug))
+    actual = positions(pipeline.detect_balls_incremental(after, before, previous_balls, TABLE_BOUNDS, debug))
+
+    assert actual == expected
+    assert [color for color, _, _ in actual] == ["red", "white"]